@@ -0,0 +1,322 @@
+"""
+This script analyzes a collection of local videos with the same stages as entry.run,
+without the Azure storage round trips or the visualizations. The videos are spread
+over a pool of worker processes that each load their own copy of the model, the
+results of every video are written to the output directory as soon as it finishes.
+Videos that already have a result file are skipped, so an interrupted run can be
+restarted with the same command.
+
+The input is either a directory, which is searched recursively for videos, or a
+manifest file with one video path per line (relative paths are relative to the
+manifest, empty lines and lines starting with # are ignored).
+
+Usage (from the root of the repository):
+    python backend/src/batch.py videos/ --output-dir results/ --workers 4
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm")
+RESULT_FILE_SUFFIX = ".json"
+
+# set in every worker process by _init_worker
+model = None
+input_size = None
+
+
+def find_videos(input_path):
+    """Lists the videos to analyze.
+
+    Args:
+        input_path: directory containing videos or a manifest file
+    Returns:
+        sorted list of (video_id, video_path) tuples, the video id is the path
+        relative to the directory or manifest with the separators replaced by '__'
+    """
+    if os.path.isdir(input_path):
+        root = input_path
+        video_paths = [
+            os.path.join(dir_path, file_name)
+            for dir_path, _, file_names in os.walk(input_path)
+            for file_name in file_names
+            if file_name.lower().endswith(VIDEO_EXTENSIONS)
+        ]
+    else:
+        root = os.path.dirname(input_path)
+        with open(input_path, "r") as file:
+            lines = [line.strip() for line in file]
+        video_paths = [
+            os.path.join(root, line)
+            for line in lines
+            if line and not line.startswith("#")
+        ]
+    videos = {}
+    for video_path in video_paths:
+        relative_path = os.path.relpath(os.path.normpath(video_path), root)
+        video_id = os.path.splitext(relative_path)[0].replace(os.sep, "__")
+        videos[video_id] = video_path
+    return sorted(videos.items())
+
+
+def result_file_path(output_dir, video_id):
+    return os.path.join(output_dir, f"{video_id}{RESULT_FILE_SUFFIX}")
+
+
+def pending_videos(videos, output_dir):
+    """Returns the videos that do not have a result file in output_dir yet."""
+    return [
+        (video_id, video_path)
+        for video_id, video_path in videos
+        if not os.path.exists(result_file_path(output_dir, video_id))
+    ]
+
+
+def write_result(output_dir, video_id, results):
+    """Writes the results of a video, atomically so a killed run never leaves a
+    partial file behind that would be skipped on resume."""
+    file_path = result_file_path(output_dir, video_id)
+    tmp_file_path = f"{file_path}.tmp"
+    with open(tmp_file_path, "w") as file:
+        json.dump(results, file)
+    os.replace(tmp_file_path, file_path)
+
+
+def _init_worker(model_backend, model_name, model_version, threads):
+    global model, input_size
+    import tensorflow as tf
+    from utils.model import load_model
+
+    # the workers share the cores, without a limit every worker starts a thread
+    # per core and they spend most of their time contending
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    model, input_size = load_model(
+        backend=model_backend, model_name=model_name, version=model_version
+    )
+
+
+def analyze_video(video_path, model, input_size, keypoints_file_path=None):
+    """Runs the preprocessing, inference and postprocessing of entry.run on a video.
+
+    Args:
+        video_path: path of the video
+        model: model object to use for inference
+        input_size: input size of the model
+        keypoints_file_path: also save the keypoint artifacts to this .npz file
+    Returns:
+        the results dict of the video
+    """
+    from entry import (
+        PIPELINE_CONFIG,
+        infer_keypoints,
+        create_frame_gate,
+        post_process_video,
+        build_results,
+    )
+    from utils.artifacts import save_keypoint_artifacts
+    import numpy as np
+
+    frame_gate = create_frame_gate()
+    skipped_frames = frame_gate.skipped_frames if frame_gate is not None else None
+    (
+        clip,
+        _,
+        all_keypoints,
+        crop_regions,
+        lowest_pedal_points,
+        adaptive_duration,
+    ) = infer_keypoints(
+        video_path, model, input_size, frame_gate=frame_gate, frame_retention="none"
+    )
+    fps = clip.fps
+    clip.close()
+    timestamps = np.arange(len(all_keypoints)) / fps
+    (
+        _,
+        hipkneeankleindices,
+        all_angles,
+        lowest_pedal_point_indices,
+        _,
+        angle_at_lowest_pedal_points_avg,
+        angle_at_lowest_pedal_points_std,
+        recommendation,
+    ) = post_process_video(
+        all_keypoints,
+        ideal_angle=PIPELINE_CONFIG["ideal_angle"],
+        min_angle=PIPELINE_CONFIG["min_angle"],
+        max_angle=PIPELINE_CONFIG["max_angle"],
+        lowest_pedal_point_indices=lowest_pedal_points.lowest_pedal_point_indices,
+        skipped_frames=skipped_frames,
+    )
+    results = build_results(
+        timestamps,
+        all_angles,
+        lowest_pedal_point_indices,
+        angle_at_lowest_pedal_points_avg,
+        angle_at_lowest_pedal_points_std,
+        recommendation,
+        PIPELINE_CONFIG["ideal_angle"],
+        stroke_boundaries=lowest_pedal_points.lowest_pedal_point_indices,
+        skipped_frames=skipped_frames,
+    )
+    if adaptive_duration is not None:
+        results["adaptive_duration"] = adaptive_duration
+    if keypoints_file_path is not None:
+        save_keypoint_artifacts(
+            keypoints_file_path,
+            all_keypoints,
+            crop_regions,
+            timestamps,
+            metadata={
+                "fps": fps,
+                "pipeline_config": PIPELINE_CONFIG,
+                "skipped_frames": skipped_frames,
+            },
+        )
+        results["keypoints_file_path"] = keypoints_file_path
+    results["pipeline_config"] = PIPELINE_CONFIG
+    return results
+
+
+def _analyze_job(job):
+    """Analyzes one video in a worker, errors are returned instead of raised so a
+    single broken video does not stop the batch."""
+    video_id, video_path, output_dir, save_keypoints = job
+    from entry import KEYPOINTS_FILE_SUFFIX
+
+    start = time.perf_counter()
+    try:
+        results = analyze_video(
+            video_path,
+            model,
+            input_size,
+            keypoints_file_path=os.path.join(
+                output_dir, f"{video_id}{KEYPOINTS_FILE_SUFFIX}"
+            )
+            if save_keypoints
+            else None,
+        )
+    except Exception as e:
+        logging.exception(f"Failed to analyze {video_path}")
+        return video_id, f"{type(e).__name__}: {e}"
+    results["video_path"] = video_path
+    results["processing_time_s"] = time.perf_counter() - start
+    write_result(output_dir, video_id, results)
+    return video_id, None
+
+
+def run_batch(
+    videos,
+    output_dir,
+    workers,
+    model_name,
+    model_version,
+    save_keypoints=False,
+    resume=True,
+    model_backend="tfhub",
+):
+    """Analyzes the videos in a process pool with one model per worker.
+
+    Args:
+        videos: list of (video_id, video_path) tuples
+        output_dir: directory the {video_id}.json result files are written to
+        workers: number of worker processes
+        model_name: name of the model every worker loads
+        model_version: version of the model every worker loads
+        save_keypoints: also write {video_id}_keypoints.npz for reanalysis
+        resume: skip the videos that already have a result file
+        model_backend: backend every worker loads the model from, see
+            MODEL_BACKENDS
+    Returns:
+        dict mapping the video id of every failed video to its error
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if resume:
+        todo = pending_videos(videos, output_dir)
+        logging.info(f"Skipping {len(videos) - len(todo)} already analyzed videos")
+    else:
+        todo = list(videos)
+    if not todo:
+        return {}
+    workers = max(1, min(workers, len(todo)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    jobs = [
+        (video_id, video_path, output_dir, save_keypoints)
+        for video_id, video_path in todo
+    ]
+    failures = {}
+    # tensorflow is not fork safe, start the workers from a fresh interpreter
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        workers,
+        initializer=_init_worker,
+        initargs=(model_backend, model_name, model_version, threads),
+    ) as pool:
+        # one video per task, videos take long enough that the overhead is negligible
+        # and the results are written as soon as each video finishes
+        for done, (video_id, error) in enumerate(
+            pool.imap_unordered(_analyze_job, jobs), start=1
+        ):
+            if error is not None:
+                failures[video_id] = error
+            logging.info(
+                f"[{done}/{len(jobs)}] {video_id}: {'FAILED ' + error if error else 'done'}"
+            )
+    return failures
+
+
+def main():
+    from entry import PIPELINE_CONFIG
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="directory of videos or manifest file")
+    parser.add_argument("--output-dir", default="batch_output")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--model-backend",
+        default=PIPELINE_CONFIG["model_backend"],
+        help="tfhub, or fake to run without network access and inference cost",
+    )
+    parser.add_argument("--model-name", default=PIPELINE_CONFIG["model_name"])
+    parser.add_argument(
+        "--model-version", type=int, default=PIPELINE_CONFIG["model_version"]
+    )
+    parser.add_argument(
+        "--save-keypoints",
+        action="store_true",
+        help="also save the keypoints of every video so it can be reanalyzed",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="analyze every video again, even if it already has a result file",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    videos = find_videos(args.input)
+    logging.info(f"Found {len(videos)} videos in {args.input}")
+    start = time.time()
+    failures = run_batch(
+        videos,
+        args.output_dir,
+        args.workers,
+        args.model_name,
+        args.model_version,
+        save_keypoints=args.save_keypoints,
+        resume=not args.no_resume,
+        model_backend=args.model_backend,
+    )
+    logging.info(f"Finished the batch in {time.time() - start:.2f} sec")
+    if failures:
+        logging.warning(f"Failed to analyze {len(failures)} videos: {failures}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+This script measures the import time of every top-level backend module in a fresh
+interpreter with `python -X importtime`, together with the packages that take the
+longest to import for each module. The timings are written as JSON, pass a previous
+output with --baseline to compare two commits; the script exits with a non-zero code
+when a module got slower to import.
+
+Usage (from the root of the repository):
+    python backend/src/benchmarks/benchmark_imports.py --output imports.json
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import platform
+import subprocess
+import numpy as np
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+MODULES = [
+    "utils.keypoints",
+    "utils.metrics",
+    "utils.utils",
+    "utils.cache",
+    "utils.artifacts",
+    "utils.profiling",
+    "utils.cropping",
+    "utils.mp4",
+    "utils.frames",
+    "utils.pipeline",
+    "utils.smoothing",
+    "utils.gating",
+    "utils.strokes",
+    "utils.postprocessing",
+    "utils.preprocessing",
+    "utils.visualizations",
+    "utils.azure",
+    "utils.model",
+    "entry",
+    "batch",
+    "live",
+]
+TOP_PACKAGES = 5
+
+
+def parse_importtime(stderr):
+    """Parses the output of -X importtime.
+
+    Returns:
+        list of (package, depth, self_us, cumulative_us) tuples
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, package = line[len("import time:") :].split("|")
+        # the package name is indented by two spaces per nesting level
+        name = package[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+def measure_import(module_name):
+    """Imports a module in a fresh interpreter, returns its timings in seconds."""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = parse_importtime(process.stderr)
+    cumulative = {name: cumulative_us for name, _, _, cumulative_us in imports}
+    # the packages imported directly by the module are one level deeper than it
+    direct_imports = [
+        (name, cumulative_us) for name, depth, _, cumulative_us in imports if depth == 1
+    ]
+    direct_imports.sort(key=lambda package: package[1], reverse=True)
+    return {
+        "import_time_s": cumulative[module_name] / 1e6,
+        "slowest_packages": {
+            name: cumulative_us / 1e6
+            for name, cumulative_us in direct_imports[:TOP_PACKAGES]
+        },
+    }
+
+
+def run_benchmarks(modules, repeats):
+    benchmarks = {}
+    for module_name in modules:
+        samples = [measure_import(module_name) for _ in range(repeats)]
+        times = [sample["import_time_s"] for sample in samples]
+        benchmarks[module_name] = {
+            "min": float(np.min(times)),
+            "median": float(np.median(times)),
+            "samples": times,
+            "slowest_packages": samples[int(np.argmin(times))]["slowest_packages"],
+        }
+        logging.info(f"{module_name}: {benchmarks[module_name]['median']:.3f}s")
+    return benchmarks
+
+
+def compare_to_baseline(benchmarks, baseline, tolerance):
+    """Returns a description of every module whose median got slower than tolerance."""
+    regressions = []
+    for module_name, summary in benchmarks.items():
+        previous = baseline["benchmarks"].get(module_name)
+        if previous is None or previous["median"] == 0:
+            continue
+        ratio = summary["median"] / previous["median"]
+        if ratio > 1 + tolerance:
+            regressions.append(
+                f"{module_name}: {previous['median']:.3f}s -> "
+                f"{summary['median']:.3f}s ({ratio:.2f}x)"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="imports_output.json")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--baseline", help="JSON output of a previous run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative slowdown of an import compared to the baseline",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    output = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": args.repeats,
+        "benchmarks": run_benchmarks(args.modules, args.repeats),
+    }
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    logging.info(f"Wrote import benchmark results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            regressions = compare_to_baseline(
+                output["benchmarks"], json.load(file), args.tolerance
+            )
+        for regression in regressions:
+            logging.warning(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+This script benchmarks every stage of entry.run separately on the test video and on
+synthetic clips of varying length and resolution. The model is replaced by a
+FakePoseModel, so the benchmark runs offline and measures the overhead of the
+pipeline itself.
+The timings are written as JSON, pass a previous output with --baseline to compare
+two commits; the script exits with a non-zero code when a stage regressed.
+
+Usage (from the root of the repository):
+    python backend/src/benchmarks/benchmark_pipeline.py --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+from moviepy.editor import VideoClip, VideoFileClip
+from utils.preprocessing import reduce_video_quality, load_frames_from_clip
+from utils.model import get_keypoints_from_video, FakePoseModel
+from utils.postprocessing import get_lowest_pedal_frames
+from entry import (
+    PIPELINE_CONFIG,
+    post_process_video,
+    build_results,
+    create_visualizations,
+    create_video_visualization,
+)
+
+TEST_VIDEO_PATH = os.path.join(os.path.dirname(__file__), "../test/test_video.mp4")
+# (width, height, duration in seconds) of the generated clips
+SYNTHETIC_CLIPS = [(640, 360, 5), (1280, 720, 10), (1920, 1080, 20)]
+SYNTHETIC_FPS = 30
+STAGES = [
+    "decode",
+    "reduce_video_quality",
+    "load_frames_from_clip",
+    "get_keypoints_from_video",
+    "post_process_video",
+    "create_visualizations",
+    "create_video_visualization",
+]
+
+
+def create_synthetic_clip(output_file_path, width, height, duration, fps):
+    """Writes a clip with moving content so the encoder produces realistic frames."""
+    grid_y, grid_x = np.mgrid[0:height, 0:width]
+
+    def make_frame(t):
+        phase = 2 * np.pi * t
+        frame = np.empty((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = 127 + 127 * np.sin(grid_x / 40 + phase)
+        frame[..., 1] = 127 + 127 * np.sin(grid_y / 30 - phase)
+        frame[..., 2] = 127 + 127 * np.sin((grid_x + grid_y) / 50 + phase / 2)
+        return frame
+
+    clip = VideoClip(make_frame, duration=duration)
+    clip.write_videofile(
+        output_file_path, fps=fps, audio=False, verbose=False, logger=None
+    )
+
+
+def _timed(timings, stage, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[stage] = time.perf_counter() - start
+    return result
+
+
+def benchmark_video(video_path, output_dir):
+    """Runs every stage of the pipeline once, returns {stage: seconds} and #frames."""
+    timings = {}
+    file_name = os.path.join(output_dir, "benchmark")
+
+    def decode():
+        clip = VideoFileClip(video_path, audio=False)
+        for _ in clip.iter_frames():
+            pass
+        clip.close()
+
+    _timed(timings, "decode", decode)
+    clip = _timed(
+        timings,
+        "reduce_video_quality",
+        reduce_video_quality,
+        video_path,
+        max_pixels=PIPELINE_CONFIG["max_pixels"],
+        max_fps=PIPELINE_CONFIG["max_fps"],
+        max_duration=PIPELINE_CONFIG["max_duration"],
+    )
+    tensors = _timed(timings, "load_frames_from_clip", load_frames_from_clip, clip)
+    all_keypoints = _timed(
+        timings,
+        "get_keypoints_from_video",
+        get_keypoints_from_video,
+        tensors,
+        FakePoseModel(fps=clip.fps),
+        256,
+        crop_backend=PIPELINE_CONFIG["crop_backend"],
+    )
+    (
+        facing_direction,
+        hipkneeankleindices,
+        all_angles,
+        lowest_pedal_point_indices,
+        angles_at_lowest_pedal_points,
+        angle_at_lowest_pedal_points_avg,
+        angle_at_lowest_pedal_points_std,
+        recommendation,
+    ) = _timed(timings, "post_process_video", post_process_video, all_keypoints)
+    results = build_results(
+        np.arange(len(all_keypoints)) / clip.fps,
+        all_angles,
+        lowest_pedal_point_indices,
+        angle_at_lowest_pedal_points_avg,
+        angle_at_lowest_pedal_points_std,
+        recommendation,
+        PIPELINE_CONFIG["ideal_angle"],
+        stroke_boundaries=get_lowest_pedal_frames(all_keypoints, hipkneeankleindices),
+    )
+    results, _ = _timed(
+        timings,
+        "create_visualizations",
+        create_visualizations,
+        file_name,
+        tensors,
+        all_keypoints,
+        hipkneeankleindices,
+        facing_direction,
+        all_angles,
+        lowest_pedal_point_indices,
+        angles_at_lowest_pedal_points,
+        results,
+    )
+    _timed(
+        timings,
+        "create_video_visualization",
+        create_video_visualization,
+        file_name,
+        tensors,
+        all_keypoints,
+        hipkneeankleindices,
+        facing_direction,
+        all_angles,
+        lowest_pedal_point_indices,
+        results,
+        clip,
+    )
+    return timings, len(all_keypoints)
+
+
+def summarize(samples):
+    return {
+        "min": float(np.min(samples)),
+        "median": float(np.median(samples)),
+        "mean": float(np.mean(samples)),
+        "samples": [float(sample) for sample in samples],
+    }
+
+
+def run_benchmarks(videos, repeats):
+    """Benchmarks every video repeats times.
+
+    Args:
+        videos: list of (name, path) tuples
+        repeats: number of times every video is benchmarked
+    Returns:
+        list of dicts with the video properties and a summary per stage
+    """
+    benchmarks = []
+    for name, video_path in videos:
+        source = VideoFileClip(video_path, audio=False)
+        properties = {
+            "name": name,
+            "width": source.w,
+            "height": source.h,
+            "fps": source.fps,
+            "duration": source.duration,
+        }
+        source.close()
+        samples = {stage: [] for stage in STAGES}
+        for _ in range(repeats):
+            with tempfile.TemporaryDirectory() as output_dir:
+                timings, num_frames = benchmark_video(video_path, output_dir)
+            for stage in STAGES:
+                samples[stage].append(timings[stage])
+        benchmarks.append(
+            {
+                **properties,
+                "analyzed_frames": num_frames,
+                "stages": {stage: summarize(samples[stage]) for stage in STAGES},
+            }
+        )
+        logging.info(f"Benchmarked {name}")
+    return benchmarks
+
+
+def compare_to_baseline(benchmarks, baseline, tolerance):
+    """Returns a description of every stage whose median got slower than tolerance."""
+    baseline = {benchmark["name"]: benchmark for benchmark in baseline["benchmarks"]}
+    regressions = []
+    for benchmark in benchmarks:
+        if benchmark["name"] not in baseline:
+            continue
+        for stage, summary in benchmark["stages"].items():
+            previous = baseline[benchmark["name"]]["stages"].get(stage)
+            if previous is None or previous["median"] == 0:
+                continue
+            ratio = summary["median"] / previous["median"]
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    f"{benchmark['name']} {stage}: {previous['median']:.3f}s -> "
+                    f"{summary['median']:.3f}s ({ratio:.2f}x)"
+                )
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--no-synthetic", action="store_true", help="only benchmark the test video"
+    )
+    parser.add_argument("--baseline", help="JSON output of a previous run")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed relative slowdown of a stage median compared to the baseline",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as clip_dir:
+        videos = [("test_video", TEST_VIDEO_PATH)]
+        if not args.no_synthetic:
+            for width, height, duration in SYNTHETIC_CLIPS:
+                name = f"synthetic_{width}x{height}_{duration}s"
+                video_path = os.path.join(clip_dir, f"{name}.mp4")
+                create_synthetic_clip(
+                    video_path, width, height, duration, SYNTHETIC_FPS
+                )
+                videos.append((name, video_path))
+        benchmarks = run_benchmarks(videos, args.repeats)
+
+    output = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeats": args.repeats,
+        "benchmarks": benchmarks,
+    }
+    with open(args.output, "w") as file:
+        json.dump(output, file, indent=2)
+    logging.info(f"Wrote benchmark results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            regressions = compare_to_baseline(
+                benchmarks, json.load(file), args.tolerance
+            )
+        for regression in regressions:
+            logging.warning(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,17 +15,34 @@ import json
 import os
 import logging
 import shutil
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
-from moviepy.editor import VideoFileClip, ImageSequenceClip, clips_array
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.azure import (
     delete_blob_from_storage_account,
     download_video_from_storageaccount,
+    download_video_window_from_storageaccount,
+    stream_video_from_storageaccount,
     upload_results_to_storageaccount,
 )
-from utils.preprocessing import reduce_video_quality, load_tensors_from_clip
-from utils.model import load_model_from_tfhub, get_keypoints_from_video
+from utils.preprocessing import (
+    reduce_video_quality,
+    load_frames_from_clip,
+    frame_count,
+    create_decode_pool,
+    decode_video_segments,
+    extract_frames,
+    open_video_stream,
+)
+from utils.model import (
+    load_model,
+    warmup_model,
+    get_keypoints_from_video,
+)
+from utils.smoothing import KeypointSmoother
+from utils.gating import FrameGate, DuplicateFrameDetector
+from utils.strokes import segment_strokes
 from utils.postprocessing import (
     find_camera_facing_side,
     get_front_leg_keypoint_indices,
@@ -34,6 +51,8 @@ from utils.postprocessing import (
     calc_knee_angle,
     filter_bad_angles,
     make_recommendation,
+    LowestPedalPointDetector,
+    AngleConvergence,
 )
 from utils.visualizations import (
     draw_angle_on_image,
@@ -43,32 +62,331 @@ from utils.visualizations import (
     plot_y_values,
     draw_plot_of_angles,
 )
-from utils.utils import timeit
+from utils.cache import ResultCache, hash_video, compute_cache_key
+from utils.artifacts import save_keypoint_artifacts, load_keypoint_artifacts
+from utils.metrics import (
+    request_metrics,
+    registry,
+    increment,
+    set_rss_sample_interval,
+)
+from utils.profiling import profile_request
+from utils.pipeline import StageGraph
+from utils.frames import FrameStore, FRAME_RETENTION_POLICIES, retain_frames
+from utils.utils import timeit, import_modules_in_background
+
+# Every setting that influences the results, also used as part of the result cache key
+PIPELINE_CONFIG = {
+    # "fake" replaces the model by a FakePoseModel, for tests and benchmarks offline
+    "model_backend": os.getenv("MODEL_BACKEND", "tfhub"),
+    "model_name": "movenet_thunder",
+    "model_version": 4,
+    "max_pixels": 256,
+    "max_fps": 15,
+    "max_duration": 10,
+    "ideal_angle": 145,
+    "min_angle": 130,
+    "max_angle": 170,
+    # One-Euro filter on the keypoints used to track the cyclist between frames
+    "smoothing_min_cutoff": 1.0,
+    "smoothing_beta": 10.0,
+    # After a frame without a visible torso, inference is skipped for at most
+    # max_skipped_frames frames that differ less than skip_motion_threshold from the
+    # last inferred frame, 0 disables skipping
+    "skip_motion_threshold": 0.005,
+    "max_skipped_frames": 4,
+    # The frame of the angle image is decoded again with this many pixels on its
+    # shortest side, the model frames are used when this is not more than max_pixels
+    "keyframe_max_pixels": int(os.getenv("KEYFRAME_MAX_PIXELS", 720)),
+    # How frames are cropped and resized for the model, see CROP_BACKENDS
+    "crop_backend": os.getenv("CROP_BACKEND", "numpy"),
+    # Reuse the keypoints of the previous frame for identical frames, which resampling
+    # a variable frame rate video to max_fps produces
+    "skip_duplicate_frames": os.getenv("SKIP_DUPLICATE_FRAMES", "true").lower()
+    in ["1", "true"],
+    # Instead of the max_duration window, analyze from the middle of a window of
+    # max_adaptive_duration until the 95% confidence interval of the knee angle is
+    # narrower than +-angle_ci_threshold degrees (after at least min_strokes strokes
+    # and min_adaptive_duration seconds)
+    "adaptive_duration": os.getenv("ADAPTIVE_DURATION", "false").lower()
+    in ["1", "true"],
+    "min_adaptive_duration": 5,
+    "max_adaptive_duration": 60,
+    "angle_ci_threshold": 1.0,
+    "min_strokes": 6,
+    # Decode mp4 videos that have their index in front while they are downloaded,
+    # other videos are downloaded to disk first
+    "stream_decode": os.getenv("STREAM_DECODE", "false").lower() in ["1", "true"],
+}
+KEYPOINTS_FILE_SUFFIX = "_keypoints.npz"
+RESULT_CACHE_DIR = os.getenv(
+    "RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bikefitting-cache")
+)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 1024 ** 3))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 100))
+# Download only the bytes of the frames that are analyzed with ranged reads, for
+# mp4 videos when they are not decoded while they are downloaded. The decoded frames
+# are the same as for a full download, so this is not part of PIPELINE_CONFIG
+RANGED_DOWNLOAD = os.getenv("RANGED_DOWNLOAD", "false").lower() in ["1", "true"]
+# Threads the stages of a request run on, see StageGraph
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", 4))
+# What happens to the frames of a request once the model ran on them, "memory"
+# keeps them in their FrameStore for the renderers and "none" drops them, see
+# retain_frames. Without the frames a request has no angle image and video
+FRAME_RETENTION = os.getenv("FRAME_RETENTION", "memory")
+# Size in bytes of the decoded frames of a request above which they are decoded
+# into a memory-mapped file instead of memory, see FrameStore. 0 keeps the frames
+# of every request on disk
+FRAME_STORE_MAX_MEMORY_BYTES = int(
+    os.getenv("FRAME_STORE_MAX_MEMORY_BYTES", 512 * 1024 ** 2)
+)
+# Processes the frames of a video are decoded in, in segments. 1 decodes the video
+# in the request with a single reader
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", 1))
+# Minimum number of frames of a segment, shorter videos are decoded in fewer
+# segments or with a single reader. Starting a segment costs about as much as
+# decoding 100 frames
+DECODE_MIN_SEGMENT_FRAMES = int(os.getenv("DECODE_MIN_SEGMENT_FRAMES", 100))
+# (height, width) of landscape and portrait 16:9 videos after reduce_video_quality
+WARMUP_FRAME_SHAPES = [(256, 455), (455, 256)]
+# Modules that are only imported when they are first used, preloaded during init
+LAZY_MODULES = [
+    "scipy.signal",
+    "scipy.stats",
+    "pandas",
+    "matplotlib.pyplot",
+    "seaborn",
+    "moviepy.video.compositing.CompositeVideoClip",
+]
+# File for the prometheus node exporter textfile collector, disabled when empty
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "")
+# Time in milliseconds between two samples of the RSS while metrics spans are open,
+# the peak RSS of a stage misses peaks shorter than this
+METRICS_RSS_INTERVAL_MS = float(os.getenv("METRICS_RSS_INTERVAL_MS", 50))
+# Profile every request, a single request can be profiled with {"profile": true}
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "false").lower() in ["1", "true"]
 
 
+@timeit
 def pre_process_video(file_path):
-    clip = reduce_video_quality(file_path, max_pixels=256, max_fps=15, max_duration=10)
-    tensors = load_tensors_from_clip(clip)
-    return clip, tensors
+    if decode_pool is not None:
+        return decode_video_segments(
+            file_path,
+            max_pixels=PIPELINE_CONFIG["max_pixels"],
+            max_fps=PIPELINE_CONFIG["max_fps"],
+            max_duration=PIPELINE_CONFIG["max_duration"],
+            executor=decode_pool,
+            workers=DECODE_WORKERS,
+            max_memory_bytes=FRAME_STORE_MAX_MEMORY_BYTES,
+            min_segment_frames=DECODE_MIN_SEGMENT_FRAMES,
+        )
+    clip = reduce_video_quality(
+        file_path,
+        max_pixels=PIPELINE_CONFIG["max_pixels"],
+        max_fps=PIPELINE_CONFIG["max_fps"],
+        max_duration=PIPELINE_CONFIG["max_duration"],
+    )
+    frames = load_frames_from_clip(clip, FRAME_STORE_MAX_MEMORY_BYTES)
+    return clip, frames
+
+
+def _decode_frames(clip, store):
+    """Yields the frames of the clip while keeping them in the FrameStore"""
+    for frame in clip.iter_frames():
+        store.append(frame)
+        yield frame
+
+
+def infer_keypoints(
+    file_path,
+    model,
+    input_size,
+    on_lowest_pedal_points=None,
+    frame_gate=None,
+    streamed_video=None,
+    frame_retention="memory",
+):
+    """Preprocesses the video and runs the model on its frames while the lowest pedal
+    points are detected. With adaptive_duration or a streamed video the frames are
+    decoded while the model runs, with adaptive_duration inference stops as soon as
+    the knee angle estimate has converged.
+
+    Args:
+        file_path: path of the video
+        model: model object to use for inference
+        input_size: input size of the model
+        on_lowest_pedal_points: optional function called as
+            on_lowest_pedal_points(frames, confirmed, facing_direction) as soon as
+            lowest pedal points are confirmed, see LowestPedalPointDetector.update
+        frame_gate: optional FrameGate to skip inference on frames without cyclist
+        streamed_video: optional StreamedVideo of the video that is still being
+            downloaded, file_path is then not read
+        frame_retention: what happens to the frames once the model ran on them,
+            one of FRAME_RETENTION_POLICIES
+    Returns:
+        the clip (only its fps and size are used, a streamed video returns the
+        StreamedVideo), the analyzed frames (None when they are not retained), the
+        keypoints and crop region of every frame, the LowestPedalPointDetector and
+        a dict describing the adaptive duration (None when disabled)
+    """
+    lowest_pedal_points = LowestPedalPointDetector()
+    convergence = None
+    if streamed_video is not None or PIPELINE_CONFIG["adaptive_duration"]:
+        clip = streamed_video or reduce_video_quality(
+            file_path,
+            max_pixels=PIPELINE_CONFIG["max_pixels"],
+            max_fps=PIPELINE_CONFIG["max_fps"],
+            max_duration=PIPELINE_CONFIG["max_adaptive_duration"],
+        )
+        store = FrameStore(
+            (frame_count(clip), clip.h, clip.w, 3), FRAME_STORE_MAX_MEMORY_BYTES
+        )
+        video = _decode_frames(clip, store)
+    else:
+        store = None
+        clip, frames = pre_process_video(file_path)
+        video = frames
+    if PIPELINE_CONFIG["adaptive_duration"]:
+        convergence = AngleConvergence(
+            threshold=PIPELINE_CONFIG["angle_ci_threshold"],
+            min_strokes=PIPELINE_CONFIG["min_strokes"],
+            min_angle=PIPELINE_CONFIG["min_angle"],
+            max_angle=PIPELINE_CONFIG["max_angle"],
+        )
+        min_frames = PIPELINE_CONFIG["min_adaptive_duration"] * clip.fps
+
+    def on_frame(frame_idx, keypoints):
+        confirmed = lowest_pedal_points.update(
+            keypoints, valid=frame_gate is None or not frame_gate.skipped
+        )
+        if confirmed and on_lowest_pedal_points is not None:
+            on_lowest_pedal_points(
+                store.frames if store is not None else frames,
+                confirmed,
+                lowest_pedal_points.facing_direction,
+            )
+        if convergence is None:
+            return False
+        for _, _, (_, knee_angle) in confirmed:
+            convergence.update(knee_angle)
+        return convergence.converged and frame_idx + 1 >= min_frames
+
+    try:
+        all_keypoints, crop_regions = get_keypoints_from_video(
+            video,
+            model,
+            input_size,
+            return_crop_regions=True,
+            smoother=create_smoother(clip.fps),
+            on_frame=on_frame,
+            frame_gate=frame_gate,
+            duplicate_detector=create_duplicate_detector(),
+            crop_backend=PIPELINE_CONFIG["crop_backend"],
+        )
+    finally:
+        if streamed_video is not None:
+            streamed_video.close()
+        if store is not None:
+            store.close()
+    if store is not None:
+        frames = store.frames
+    confirmed = lowest_pedal_points.flush()
+    if confirmed and on_lowest_pedal_points is not None:
+        on_lowest_pedal_points(frames, confirmed, lowest_pedal_points.facing_direction)
+    if streamed_video is None and convergence is None:
+        return (
+            clip,
+            retain_frames(frames, frame_retention),
+            all_keypoints,
+            crop_regions,
+            lowest_pedal_points,
+            None,
+        )
+
+    increment("frames_decoded", len(frames))
+    duration = min(len(frames) / clip.fps, clip.duration)
+    adaptive_duration = None
+    if convergence is not None:
+        adaptive_duration = {
+            "analyzed_duration_s": duration,
+            "available_duration_s": clip.duration,
+            "converged": bool(convergence.converged),
+            "angle_ci_half_width": float(convergence.half_width)
+            if convergence.num_angles > 1
+            else None,
+        }
+        logging.info(f"Adaptive duration: {adaptive_duration}")
+    # a StreamedVideo has the fps and size of the clip as well
+    if streamed_video is None:
+        clip = clip.subclip(0, duration)
+    return (
+        clip,
+        retain_frames(frames, frame_retention),
+        all_keypoints,
+        crop_regions,
+        lowest_pedal_points,
+        adaptive_duration,
+    )
+
+
+def create_smoother(fps):
+    return KeypointSmoother(
+        fps,
+        min_cutoff=PIPELINE_CONFIG["smoothing_min_cutoff"],
+        beta=PIPELINE_CONFIG["smoothing_beta"],
+    )
+
+
+def create_frame_gate(record_frames=True):
+    if PIPELINE_CONFIG["max_skipped_frames"] == 0:
+        return None
+    return FrameGate(
+        motion_threshold=PIPELINE_CONFIG["skip_motion_threshold"],
+        max_skipped_frames=PIPELINE_CONFIG["max_skipped_frames"],
+        record_frames=record_frames,
+    )
+
+
+def create_duplicate_detector(record_frames=True):
+    if not PIPELINE_CONFIG["skip_duplicate_frames"]:
+        return None
+    return DuplicateFrameDetector(record_frames=record_frames)
 
 
 @timeit
-def post_process_video(all_keypoints, ideal_angle=145):
+def post_process_video(
+    all_keypoints,
+    ideal_angle=145,
+    min_angle=130,
+    max_angle=170,
+    lowest_pedal_point_indices=None,
+    skipped_frames=None,
+):
+    """skipped_frames optionally are the indices of the frames the model did not run
+    on, their keypoints are copies of those of the previous frame, so their angles
+    are NaN and they are left out of the lowest pedal points and statistics"""
+    skipped_frames = set(skipped_frames or ())
     facing_direction = find_camera_facing_side(all_keypoints[0])
     hipkneeankleindices = get_front_leg_keypoint_indices(facing_direction)
     all_angles = [
         calc_knee_angle(get_hipkneeankle_coords(kp, hipkneeankleindices))
-        for kp in all_keypoints
+        if i not in skipped_frames
+        else (np.nan, np.nan)
+        for i, kp in enumerate(all_keypoints)
     ]
 
-    lowest_pedal_point_indices = get_lowest_pedal_frames(
-        all_keypoints, hipkneeankleindices
-    )
+    if lowest_pedal_point_indices is None:
+        lowest_pedal_point_indices = get_lowest_pedal_frames(
+            all_keypoints, hipkneeankleindices, invalid_frames=skipped_frames
+        )
     angles_at_lowest_pedal_points = [
         all_angles[i][1] for i in lowest_pedal_point_indices
     ]
     angles_at_lowest_pedal_points, lowest_pedal_point_indices = filter_bad_angles(
-        angles_at_lowest_pedal_points, lowest_pedal_point_indices
+        angles_at_lowest_pedal_points,
+        lowest_pedal_point_indices,
+        min_angle=min_angle,
+        max_angle=max_angle,
     )
     angle_at_lowest_pedal_points_avg, angle_at_lowest_pedal_points_std = np.mean(
         angles_at_lowest_pedal_points
@@ -88,6 +406,47 @@ def post_process_video(all_keypoints, ideal_angle=145):
     )
 
 
+def build_results(
+    timestamps,
+    all_angles,
+    lowest_pedal_point_indices,
+    angle_at_lowest_pedal_points_avg,
+    angle_at_lowest_pedal_points_std,
+    recommendation,
+    ideal_angle,
+    stroke_boundaries=None,
+    skipped_frames=None,
+):
+    """stroke_boundaries optionally are the unfiltered lowest pedal points, the
+    strokes between them are then summarized under 'strokes'. skipped_frames are the
+    indices of the frames the model did not run on, their timestamps are listed
+    under 'skipped_timestamps' instead of under 'timestamped_angles'"""
+    skipped = set(skipped_frames or ())
+    results = {
+        "recommendation": recommendation,
+        "angle": angle_at_lowest_pedal_points_avg,
+        "std": angle_at_lowest_pedal_points_std,
+        "ideal_angle": ideal_angle,
+        "difference": angle_at_lowest_pedal_points_avg - ideal_angle,
+        "timestamped_angles": [
+            (float(timestamps[i]), all_angles[i][1])
+            for i in range(len(all_angles))
+            if i not in skipped
+        ],
+        "used_timestamped_angles": [
+            (float(timestamps[i]), all_angles[i][1]) for i in lowest_pedal_point_indices
+        ],
+    }
+    if skipped_frames is not None:
+        results["skipped_timestamps"] = [float(timestamps[i]) for i in skipped_frames]
+    if stroke_boundaries is not None:
+        results["strokes"] = segment_strokes(
+            [angles[1] for angles in all_angles], stroke_boundaries, timestamps
+        )
+    return results
+
+
+@timeit
 def create_visualizations(
     file_name,
     tensors,
@@ -98,7 +457,10 @@ def create_visualizations(
     lowest_pedal_point_indices,
     angles_at_lowest_pedal_points,
     results,
+    keyframes=None,
 ):
+    """keyframes optionally maps frame indices to higher resolution versions of the
+    frames, which are drawn on instead"""
     # ankle y values
     y_value_plot_file_path = f"{file_name}_yvalues.png"
     plot_y_values(
@@ -123,12 +485,21 @@ def create_visualizations(
         angles_at_lowest_pedal_points, output_normal_graph_file_path
     )
     results["output_normal_graph_file_path"] = output_normal_graph_file_path
+    blobs_to_upload = [
+        output_normal_graph_file_path,
+        y_value_plot_file_path,
+        angle_value_plot_file_path,
+    ]
+    # the frames are not available when reanalyzing saved keypoints
+    if tensors is None:
+        return results, blobs_to_upload
 
     # plot frame with angle on most average angle
     angle_image_file_path = f"{file_name}.png"
     frame_idx = lowest_pedal_point_indices[0]
+    keyframes = keyframes or {}
     draw_angle_on_image(
-        tensors[frame_idx],
+        keyframes[frame_idx] if frame_idx in keyframes else tensors[frame_idx],
         get_hipkneeankle_coords(all_keypoints[frame_idx], hipkneeankleindices),
         all_angles[frame_idx][0],
         all_angles[frame_idx][1],
@@ -137,15 +508,11 @@ def create_visualizations(
         output_file_path=angle_image_file_path,
     )
     results["angle_image_file_path"] = angle_image_file_path
-    blobs_to_upload = [
-        angle_image_file_path,
-        output_normal_graph_file_path,
-        y_value_plot_file_path,
-        angle_value_plot_file_path,
-    ]
+    blobs_to_upload.insert(0, angle_image_file_path)
     return results, blobs_to_upload
 
 
+@timeit
 def create_video_visualization(
     file_name,
     tensors,
@@ -156,14 +523,36 @@ def create_video_visualization(
     lowest_pedal_point_indices,
     results,
     clip,
+    rendered_frames=None,
 ):
+    """rendered_frames optionally maps frame indices to frames that already have
+    the angle drawn on them"""
+    from moviepy.video.VideoClip import VideoClip
+    from moviepy.video.compositing.CompositeVideoClip import clips_array
+
     # Angle video
     angle_video_file_path = f"{file_name}_anglevideo.mp4"
-    # right side of video
-    frames_with_angle = [
-        np.uint8(tensors[i])
-        if i not in lowest_pedal_point_indices
-        else draw_angle_on_image(
+    # right side of video, every frame is read and drawn on when it is written, so
+    # the (memory-mapped) frames are not all copied into memory at once
+    rendered_frames = rendered_frames or {}
+    lowest_pedal_point_indices = set(lowest_pedal_point_indices)
+    # the frame ImageSequenceClip showed at a time, from its float32 start times, so
+    # the angle video is unchanged
+    eps = np.finfo(np.float32).eps
+    frame_starts = np.float64(
+        (np.arange(len(all_keypoints)) / clip.fps).astype(np.float32) - eps
+    )
+
+    def frame_index(t):
+        return int(np.searchsorted(frame_starts, t, side="right")) - 1
+
+    def frame_with_angle(t):
+        i = frame_index(t)
+        if i not in lowest_pedal_point_indices:
+            return np.uint8(tensors[i])
+        if i in rendered_frames:
+            return rendered_frames[i]
+        return draw_angle_on_image(
             tensors[i],
             get_hipkneeankle_coords(all_keypoints[i], hipkneeankleindices),
             all_angles[i][0],
@@ -171,14 +560,18 @@ def create_video_visualization(
             facing_direction,
             pie_slice_width=100,
         )
-        for i in range(len(all_keypoints))
-    ]
-    # left side of video
-    frames_plots = draw_plot_of_angles(results, clip)
+
+    # left side of video, the plot of every frame is drawn when it is written as well
+    def plot_of_angles(t):
+        return draw_plot_of_angles(results, clip, frame_index(t))
 
     # combining videos
-    clip_right = ImageSequenceClip(frames_with_angle, fps=clip.fps)
-    clip_left = ImageSequenceClip(frames_plots, fps=clip.fps)
+    clip_right = VideoClip(
+        frame_with_angle, duration=len(all_keypoints) / clip.fps
+    ).set_fps(clip.fps)
+    clip_left = VideoClip(
+        plot_of_angles, duration=len(all_keypoints) / clip.fps
+    ).set_fps(clip.fps)
     clip_array = clips_array([[clip_left, clip_right]])
     clip_array.write_videofile(angle_video_file_path)
     results["angle_video_file_path"] = angle_video_file_path
@@ -186,6 +579,7 @@ def create_video_visualization(
     return results, blobs_to_upload
 
 
+@timeit
 def upload_results(file_name, results, blobs_to_upload):
     if results is not None:
         json_file_path = f"{file_name}.json"
@@ -200,8 +594,11 @@ def upload_results(file_name, results, blobs_to_upload):
     )
 
 
+@timeit
 def cleanup(file_path, blobs_to_upload):
-    os.remove(file_path)
+    # a streamed video is never written to disk
+    if os.path.exists(file_path):
+        os.remove(file_path)
     for blob_name in blobs_to_upload:
         os.remove(blob_name)
     delete_blob_from_storage_account(
@@ -211,32 +608,26 @@ def cleanup(file_path, blobs_to_upload):
     )
 
 
-def init():
-    global model, input_size
-    logging.getLogger("azure").setLevel(logging.ERROR)
-    model, input_size = load_model_from_tfhub(model_name="movenet_thunder")
-
-
-def run(Inputs):
-    logging.info(f"STARTED INFERENCE ON {Inputs}")
-    start = time.time()
-    data = json.loads(Inputs)
-    file_path = data["file_name"]
-
-    download_video_from_storageaccount(
-        account_name=os.getenv("AZURE_STORAGE_CONNECTION_ACCOUNT"),
-        container="videos",
-        file_path=file_path,
-    )
-    file_name, extension = file_path.split(".")
-
-    # Preprocess video
-    clip, tensors = pre_process_video(file_path)
-
-    # Inference on model
-    all_keypoints = get_keypoints_from_video(tensors, model, input_size)
+def reanalyze(keypoints_file_path, render=True, **config):
+    """Recalculates the results of a video from its saved keypoint artifacts.
+    The model is not needed, so changing the ideal angle or the filtering thresholds
+    only costs the postprocessing (and optionally the plots).
 
-    # Post process keypoints
+    Args:
+        keypoints_file_path: path to a {file_name}_keypoints.npz file saved by run
+        render: whether to recreate the plots next to the keypoints file
+        config: overrides of 'ideal_angle', 'min_angle' and/or 'max_angle'
+    Returns:
+        the results dict and the list of created files
+    """
+    artifacts = load_keypoint_artifacts(keypoints_file_path)
+    config = {
+        **PIPELINE_CONFIG,
+        **artifacts["metadata"].get("pipeline_config", {}),
+        **config,
+    }
+    all_keypoints = artifacts["keypoints"]
+    skipped_frames = artifacts["metadata"].get("skipped_frames")
     (
         facing_direction,
         hipkneeankleindices,
@@ -246,51 +637,490 @@ def run(Inputs):
         angle_at_lowest_pedal_points_avg,
         angle_at_lowest_pedal_points_std,
         recommendation,
-    ) = post_process_video(all_keypoints)
-
-    # Save Results
-    sec_per_frame = 1 / clip.fps
-    results = {
-        "recommendation": recommendation,
-        "angle": angle_at_lowest_pedal_points_avg,
-        "std": angle_at_lowest_pedal_points_std,
-        "ideal_angle": 145,
-        "difference": angle_at_lowest_pedal_points_avg - 145,
-        "timestamped_angles": [
-            (i * sec_per_frame, all_angles[i][1]) for i in range(len(all_angles))
-        ],
-        "used_timestamped_angles": [
-            (i * sec_per_frame, all_angles[i][1]) for i in lowest_pedal_point_indices
-        ],
-    }
-    # VISUALIZATIONS 1
-    results, blobs_to_upload = create_visualizations(
-        file_name,
-        tensors,
+    ) = post_process_video(
         all_keypoints,
-        hipkneeankleindices,
-        facing_direction,
+        ideal_angle=config["ideal_angle"],
+        min_angle=config["min_angle"],
+        max_angle=config["max_angle"],
+        skipped_frames=skipped_frames,
+    )
+    results = build_results(
+        artifacts["timestamps"],
         all_angles,
         lowest_pedal_point_indices,
-        angles_at_lowest_pedal_points,
-        results,
+        angle_at_lowest_pedal_points_avg,
+        angle_at_lowest_pedal_points_std,
+        recommendation,
+        config["ideal_angle"],
+        stroke_boundaries=get_lowest_pedal_frames(
+            all_keypoints, hipkneeankleindices, invalid_frames=skipped_frames or ()
+        ),
+        skipped_frames=skipped_frames,
     )
-    upload_results(file_name, results, blobs_to_upload)
-
-    # VISUALIZATIONS 2
-    results, blobs_to_upload = create_video_visualization(
-        file_name,
-        tensors,
+    if not render:
+        return results, []
+    return create_visualizations(
+        keypoints_file_path[: -len(KEYPOINTS_FILE_SUFFIX)],
+        None,
         all_keypoints,
         hipkneeankleindices,
         facing_direction,
         all_angles,
         lowest_pedal_point_indices,
+        angles_at_lowest_pedal_points,
         results,
-        clip,
     )
-    upload_results(file_name, results=None, blobs_to_upload=blobs_to_upload)
+
+
+startup_metrics = {}
+# worker processes of decode_video_segments, started by init when DECODE_WORKERS > 1.
+# Without them (e.g. in batch.py) the video is decoded with a single reader
+decode_pool = None
+
+
+def init():
+    global model, input_size, result_cache, decode_pool, init_start
+    init_start = time.perf_counter()
+    logging.getLogger("azure").setLevel(logging.ERROR)
+    if FRAME_RETENTION not in FRAME_RETENTION_POLICIES:
+        raise ValueError(
+            f"Unsupported frame retention policy: {FRAME_RETENTION}, expected one "
+            f"of {FRAME_RETENTION_POLICIES}"
+        )
+    set_rss_sample_interval(METRICS_RSS_INTERVAL_MS / 1000)
+    preloading = import_modules_in_background(LAZY_MODULES)
+    model, input_size = load_model(
+        backend=PIPELINE_CONFIG["model_backend"],
+        model_name=PIPELINE_CONFIG["model_name"],
+        version=PIPELINE_CONFIG["model_version"],
+    )
+    startup_metrics["model_load_s"] = time.perf_counter() - init_start
+    # the model is only called with one frame at a time
+    warmup_durations = warmup_model(
+        model,
+        input_size,
+        frame_shapes=WARMUP_FRAME_SHAPES,
+        crop_backend=PIPELINE_CONFIG["crop_backend"],
+    )
+    startup_metrics["warmup_s"] = sum(warmup_durations)
+    startup_metrics["time_to_first_inference_s"] = (
+        startup_metrics["model_load_s"] + warmup_durations[0]
+    )
+    result_cache = (
+        ResultCache(
+            RESULT_CACHE_DIR,
+            max_bytes=RESULT_CACHE_MAX_BYTES,
+            max_entries=RESULT_CACHE_MAX_ENTRIES,
+        )
+        if RESULT_CACHE_MAX_BYTES > 0
+        else None
+    )
+    decode_pool = create_decode_pool(DECODE_WORKERS) if DECODE_WORKERS > 1 else None
+    preloading.join()
+    startup_metrics["time_to_ready_s"] = time.perf_counter() - init_start
+    for name, value in startup_metrics.items():
+        registry.set_gauge(f"startup_{name}", value)
+    logging.info(f"Ready to handle requests: {startup_metrics}")
+
+
+def run(Inputs):
+    data = json.loads(Inputs)
+    file_name = data["file_name"].split(".")[0]
+    profile_files = []
+    try:
+        with profile_request(
+            file_name, enabled=data.get("profile", PROFILE_REQUESTS)
+        ) as profile_files:
+            with request_metrics("run") as metrics:
+                message = _run(Inputs, metrics)
+    finally:
+        # the profile of a failed request is uploaded as well
+        if profile_files:
+            upload_profile(file_name, profile_files)
+    logging.info(f"Metrics: {json.dumps(metrics.summary())}")
+    if METRICS_PROMETHEUS_FILE:
+        registry.write_prometheus(METRICS_PROMETHEUS_FILE)
+    return message
+
+
+def upload_profile(file_name, profile_files):
+    """Uploads the profile files of a request and removes them, a failed upload is
+    logged so it does not hide the error of the request"""
+    try:
+        upload_results(file_name, results=None, blobs_to_upload=profile_files)
+    except Exception:
+        logging.exception(f"Failed to upload the profile of {file_name}")
+    finally:
+        for profile_file in profile_files:
+            os.remove(profile_file)
+
+
+def _run(Inputs, metrics):
+    logging.info(f"STARTED INFERENCE ON {Inputs}")
+    start = time.time()
+    first_request = "time_to_first_request_s" not in startup_metrics
+    if first_request:
+        startup_metrics["time_to_first_request_s"] = time.perf_counter() - init_start
+        registry.set_gauge(
+            "startup_time_to_first_request_s",
+            startup_metrics["time_to_first_request_s"],
+        )
+    data = json.loads(Inputs)
+    file_path = data["file_name"]
+
+    max_duration = (
+        PIPELINE_CONFIG["max_adaptive_duration"]
+        if PIPELINE_CONFIG["adaptive_duration"]
+        else PIPELINE_CONFIG["max_duration"]
+    )
+    streamed_video = None
+    if PIPELINE_CONFIG["stream_decode"]:
+        streamed_video = open_video_stream(
+            stream_video_from_storageaccount(
+                os.getenv("AZURE_STORAGE_CONNECTION_ACCOUNT"),
+                container="videos",
+                file_path=file_path,
+            ),
+            file_path,
+            max_pixels=PIPELINE_CONFIG["max_pixels"],
+            max_fps=PIPELINE_CONFIG["max_fps"],
+            max_duration=max_duration,
+        )
+    elif RANGED_DOWNLOAD:
+        try:
+            download_video_window_from_storageaccount(
+                os.getenv("AZURE_STORAGE_CONNECTION_ACCOUNT"),
+                container="videos",
+                file_path=file_path,
+                max_duration=max_duration,
+            )
+        except ValueError as e:
+            logging.warning(f"Downloading the whole video, no ranged download: {e}")
+            download_video_from_storageaccount(
+                account_name=os.getenv("AZURE_STORAGE_CONNECTION_ACCOUNT"),
+                container="videos",
+                file_path=file_path,
+            )
+    else:
+        download_video_from_storageaccount(
+            account_name=os.getenv("AZURE_STORAGE_CONNECTION_ACCOUNT"),
+            container="videos",
+            file_path=file_path,
+        )
+    file_name, extension = file_path.split(".")
+
+    # Return cached results if this video was already processed with the same config,
+    # a streamed video is only hashed once it is downloaded, it is looked up in the
+    # lookup_cache stage below
+    cache_key, cached = None, None
+    if streamed_video is None and result_cache is not None:
+        cache_key = compute_cache_key(
+            hash_video(file_path, max_duration), PIPELINE_CONFIG
+        )
+        cached = result_cache.get(cache_key)
+    if cached is not None:
+        results, blobs_to_upload = result_cache.restore(cached, file_name)
+        results["metrics"] = metrics.summary()
+        upload_results(file_name, results, blobs_to_upload)
+        cleanup(file_path, blobs_to_upload)
+        return (
+            f"Finished inference on {file_path} in {time.time()-start:.2f} sec (cached)"
+        )
+
+    # The rest of the request runs as a graph of stages, so the uploads overlap with
+    # the rendering of the angle video. Stages that draw with matplotlib are in the
+    # "render" group, as pyplot is not thread safe
+    graph = StageGraph(max_workers=STAGE_WORKERS)
+    # the lowest pedal points are found while the model runs on the next frames and
+    # their angles are drawn on a background thread
+    renderer = ThreadPoolExecutor(max_workers=1)
+    rendered_frames = {}
+    frame_gate = create_frame_gate()
+    skipped_frames = frame_gate.skipped_frames if frame_gate is not None else None
+    # the frames are only drawn on when they are retained for the renderers
+    retain = FRAME_RETENTION != "none"
+    keypoints_file_path = f"{file_name}{KEYPOINTS_FILE_SUFFIX}"
+
+    def render_lowest_pedal_points(frames, confirmed, facing_direction):
+        for frame_idx, coordinates, (start_angle, knee_angle) in confirmed:
+            rendered_frames[frame_idx] = renderer.submit(
+                draw_angle_on_image,
+                frames[frame_idx],
+                coordinates,
+                start_angle,
+                knee_angle,
+                facing_direction,
+                pie_slice_width=100,
+            )
+
+    # a streamed video is looked up while the model runs, once it is downloaded, and
+    # nothing is rendered or uploaded on a hit
+    def lookup_cache():
+        if streamed_video is None or result_cache is None:
+            return cache_key, None
+        key = compute_cache_key(streamed_video.hexdigest(), PIPELINE_CONFIG)
+        return key, result_cache.get(key)
+
+    # after save_keypoints, the cached keypoints replace the ones it saved
+    def upload_cached(lookup, _):
+        _, cached = lookup
+        if cached is None:
+            return []
+        results, blobs_to_upload = result_cache.restore(cached, file_name)
+        results["metrics"] = metrics.summary()
+        upload_results(file_name, results, blobs_to_upload)
+        return blobs_to_upload
+
+    # Preprocess video and inference on model
+    def infer():
+        inferred = infer_keypoints(
+            file_path,
+            model,
+            input_size,
+            on_lowest_pedal_points=render_lowest_pedal_points if retain else None,
+            frame_gate=frame_gate,
+            streamed_video=streamed_video,
+            frame_retention=FRAME_RETENTION,
+        )
+        clip, _, all_keypoints, _, _, _ = inferred
+        return (*inferred, np.arange(len(all_keypoints)) / clip.fps)
+
+    def save_keypoints(inferred):
+        clip, _, all_keypoints, crop_regions, _, _, timestamps = inferred
+        save_keypoint_artifacts(
+            keypoints_file_path,
+            all_keypoints,
+            crop_regions,
+            timestamps,
+            metadata={
+                "fps": clip.fps,
+                "pipeline_config": PIPELINE_CONFIG,
+                "skipped_frames": skipped_frames,
+            },
+        )
+
+    # Post process keypoints
+    def postprocess(inferred):
+        (
+            _,
+            _,
+            all_keypoints,
+            _,
+            lowest_pedal_points,
+            adaptive_duration,
+            timestamps,
+        ) = inferred
+        postprocessed = post_process_video(
+            all_keypoints,
+            ideal_angle=PIPELINE_CONFIG["ideal_angle"],
+            min_angle=PIPELINE_CONFIG["min_angle"],
+            max_angle=PIPELINE_CONFIG["max_angle"],
+            lowest_pedal_point_indices=lowest_pedal_points.lowest_pedal_point_indices,
+            skipped_frames=skipped_frames,
+        )
+        (
+            _,
+            _,
+            all_angles,
+            lowest_pedal_point_indices,
+            _,
+            angle_at_lowest_pedal_points_avg,
+            angle_at_lowest_pedal_points_std,
+            recommendation,
+        ) = postprocessed
+        results = build_results(
+            timestamps,
+            all_angles,
+            lowest_pedal_point_indices,
+            angle_at_lowest_pedal_points_avg,
+            angle_at_lowest_pedal_points_std,
+            recommendation,
+            PIPELINE_CONFIG["ideal_angle"],
+            stroke_boundaries=lowest_pedal_points.lowest_pedal_point_indices,
+            skipped_frames=skipped_frames,
+        )
+        results["keypoints_file_path"] = keypoints_file_path
+        if adaptive_duration is not None:
+            results["adaptive_duration"] = adaptive_duration
+        return postprocessed, results
+
+    # the frame of the angle image at a higher resolution, only that frame is decoded
+    def extract_keyframes(inferred, postprocessed_results):
+        _, tensors, _, _, _, _, _ = inferred
+        (_, _, _, lowest_pedal_point_indices, _, _, _, _), _ = postprocessed_results
+        if (
+            PIPELINE_CONFIG["keyframe_max_pixels"] <= PIPELINE_CONFIG["max_pixels"]
+            or not len(lowest_pedal_point_indices)
+            or tensors is None
+            # a streamed video is never written to disk
+            or not os.path.exists(file_path)
+        ):
+            return {}
+        frame_idx = lowest_pedal_point_indices[0]
+        try:
+            return extract_frames(
+                file_path,
+                {frame_idx: tensors[frame_idx]},
+                max_pixels=PIPELINE_CONFIG["keyframe_max_pixels"],
+                max_fps=PIPELINE_CONFIG["max_fps"],
+                max_duration=max_duration,
+            )
+        except IOError as e:
+            logging.warning(f"Drawing on the model frame, no keyframe: {e}")
+            return {}
+
+    # VISUALIZATIONS 1
+    def render_plots(inferred, postprocessed_results, keyframes, lookup):
+        if lookup[1] is not None:
+            return None
+        _, tensors, all_keypoints, _, _, _, _ = inferred
+        (
+            facing_direction,
+            hipkneeankleindices,
+            all_angles,
+            lowest_pedal_point_indices,
+            angles_at_lowest_pedal_points,
+            _,
+            _,
+            _,
+        ), results = postprocessed_results
+        return create_visualizations(
+            file_name,
+            tensors,
+            all_keypoints,
+            hipkneeankleindices,
+            facing_direction,
+            all_angles,
+            lowest_pedal_point_indices,
+            angles_at_lowest_pedal_points,
+            dict(results),
+            keyframes=keyframes,
+        )
+
+    def upload_plots(plots, _):
+        if plots is None:
+            return []
+        results, blobs_to_upload = plots
+        # the result json is uploaded before the video is rendered, so the embedded
+        # metrics cover the request up to here (the full summary is logged at the end)
+        results["metrics"] = metrics.summary()
+        if first_request:
+            results["metrics"]["startup"] = dict(startup_metrics)
+        blobs_to_upload = blobs_to_upload + [keypoints_file_path]
+        upload_results(file_name, results, blobs_to_upload)
+        return blobs_to_upload
+
+    # VISUALIZATIONS 2
+    def render_video(inferred, postprocessed_results, _, lookup):
+        clip, tensors, all_keypoints, _, _, _, _ = inferred
+        # without the frames there is no angle video
+        if lookup[1] is not None or tensors is None:
+            renderer.shutdown()
+            return None
+        (
+            facing_direction,
+            hipkneeankleindices,
+            all_angles,
+            lowest_pedal_point_indices,
+            _,
+            _,
+            _,
+            _,
+        ), results = postprocessed_results
+        video = create_video_visualization(
+            file_name,
+            tensors,
+            all_keypoints,
+            hipkneeankleindices,
+            facing_direction,
+            all_angles,
+            lowest_pedal_point_indices,
+            dict(results),
+            clip,
+            rendered_frames={i: frame.result() for i, frame in rendered_frames.items()},
+        )
+        renderer.shutdown()
+        return video
+
+    def upload_video(video):
+        if video is None:
+            return []
+        _, blobs_to_upload = video
+        upload_results(file_name, results=None, blobs_to_upload=blobs_to_upload)
+        return blobs_to_upload
+
+    # Cache
+    def cache(
+        inferred, postprocessed_results, plots, video, plot_paths, video_paths, lookup
+    ):
+        _, _, all_keypoints, _, _, _, _ = inferred
+        (_, _, all_angles, _, _, _, _, _), _ = postprocessed_results
+        # a request without the angle image and video is not cached, a later
+        # request with the frames retained would be missing them
+        if result_cache is not None and plots is not None and video is not None:
+            results = {**plots[0], **video[0]}
+            result_cache.put(
+                lookup[0],
+                file_name,
+                results,
+                all_keypoints,
+                all_angles,
+                [
+                    path
+                    for path in plot_paths + video_paths
+                    if not path.endswith(".json")
+                ],
+            )
 
     # Cleanup
-    cleanup(file_path, blobs_to_upload)
+    def clean(plot_paths, video_paths, _, cached_paths):
+        cleanup(file_path, plot_paths + video_paths + cached_paths)
+
+    graph.add("lookup_cache", lookup_cache)
+    graph.add("infer", infer)
+    graph.add("save_keypoints", save_keypoints, after=["infer"])
+    graph.add("upload_cached", upload_cached, after=["lookup_cache", "save_keypoints"])
+    graph.add("postprocess", postprocess, after=["infer"])
+    graph.add("extract_keyframes", extract_keyframes, after=["infer", "postprocess"])
+    graph.add(
+        "render_plots",
+        render_plots,
+        after=["infer", "postprocess", "extract_keyframes", "lookup_cache"],
+        group="render",
+    )
+    graph.add("upload_plots", upload_plots, after=["render_plots", "save_keypoints"])
+    # after the plots, so they are uploaded while the video is rendered
+    graph.add(
+        "render_video",
+        render_video,
+        after=["infer", "postprocess", "render_plots", "lookup_cache"],
+        group="render",
+    )
+    graph.add("upload_video", upload_video, after=["render_video"])
+    graph.add(
+        "cache",
+        cache,
+        after=[
+            "infer",
+            "postprocess",
+            "render_plots",
+            "render_video",
+            "upload_plots",
+            "upload_video",
+            "lookup_cache",
+        ],
+    )
+    graph.add(
+        "cleanup",
+        clean,
+        after=["upload_plots", "upload_video", "cache", "upload_cached"],
+    )
+    try:
+        stages = graph.run()
+    finally:
+        renderer.shutdown(wait=False)
+    if stages["lookup_cache"][1] is not None:
+        return (
+            f"Finished inference on {file_path} in {time.time()-start:.2f} sec (cached)"
+        )
     return f"Finished inference on {file_path} in {time.time()-start:.2f} sec"
@@ -0,0 +1,329 @@
+"""
+This script analyzes a live stream of frames, e.g. a camera pointed at a cyclist on
+a trainer while the saddle is being adjusted. The cyclist is tracked from frame to
+frame like in entry.run, and after every few pedal strokes a JSON line with the knee
+angle statistics of the last strokes and a recommendation is printed to stdout.
+
+Frames are read on a background thread and only the newest frame is analyzed, frames
+that arrive while the model is busy are dropped. This keeps the feedback at most one
+frame behind the stream, at the cost of fewer analyzed frames on slow hardware.
+
+The source is anything ffmpeg can open (a file, an rtsp:// or http:// stream or a
+camera with --input-format v4l2/avfoundation/dshow) or - for raw rgb24 frames of
+--size WIDTHxHEIGHT on stdin.
+
+Usage (from the root of the repository):
+    python backend/src/live.py rtsp://192.168.1.10:554/stream
+    python backend/src/live.py /dev/video0 --input-format v4l2
+    python backend/src/live.py backend/src/test/test_video.mp4
+    ffmpeg -i video.mp4 -f rawvideo -pix_fmt rgb24 -s 455x256 - \\
+        | python backend/src/live.py - --size 455x256
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+import numpy as np
+
+# add src dir to sys
+sys.path.append(os.path.dirname(__file__))
+from entry import (
+    PIPELINE_CONFIG,
+    create_smoother,
+    create_frame_gate,
+    create_duplicate_detector,
+)
+from utils.model import load_model, warmup_model, KeypointTracker
+from utils.postprocessing import (
+    LowestPedalPointDetector,
+    filter_bad_angles,
+    make_recommendation,
+)
+
+
+def ffmpeg_frames(source, fps, max_pixels, input_format=None, realtime=False):
+    """Decodes a video source with ffmpeg, reduced to the fps and resolution the
+    pipeline analyzes.
+
+    Args:
+        source: anything ffmpeg can open: a file, a stream url or a camera device
+        fps: frame rate the frames are sampled at
+        max_pixels: maximum size of the shortest side of the frames
+        input_format: ffmpeg input format, e.g. 'v4l2' for a linux camera
+        realtime: read the source at its native frame rate (for files)
+    Returns:
+        the (height, width) of the frames and a generator of [H, W, 3] uint8 frames
+    """
+    import imageio_ffmpeg
+
+    input_params = []
+    if input_format is not None:
+        input_params += ["-f", input_format]
+    if source.startswith("rtsp://"):
+        input_params += ["-rtsp_transport", "tcp"]
+    if realtime:
+        input_params += ["-re"]
+    # scale the shortest side to max_pixels (never up), -2 keeps the aspect ratio
+    scale = (
+        f"scale=w='if(gt(iw,ih),-2,min(iw,{max_pixels}))'"
+        f":h='if(gt(iw,ih),min(ih,{max_pixels}),-2)'"
+    )
+    reader = imageio_ffmpeg.read_frames(
+        source,
+        input_params=input_params,
+        output_params=["-vf", f"fps={fps},{scale}"],
+    )
+    width, height = next(reader)["size"]
+
+    def frames():
+        for frame in reader:
+            yield np.frombuffer(frame, dtype=np.uint8).reshape(height, width, 3)
+
+    return (height, width), frames()
+
+
+def raw_frames(stream, height, width):
+    """Reads raw rgb24 frames from a binary stream (e.g. stdin)."""
+    frame_size = height * width * 3
+    while True:
+        frame = stream.read(frame_size)
+        if len(frame) < frame_size:
+            return
+        yield np.frombuffer(frame, dtype=np.uint8).reshape(height, width, 3)
+
+
+class LatestFrameReader:
+    """Reads frames on a background thread and only keeps the newest one.
+
+    Iterating yields (frame index, frame, time the frame was read). Frames that are
+    replaced before they are taken are dropped, but keep their index so the time in
+    the stream stays frame index / fps.
+    """
+
+    def __init__(self, frames):
+        self.dropped = 0
+        self._latest = None
+        self._done = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._read, args=(frames,), name="frame-reader", daemon=True
+        )
+        self._thread.start()
+
+    def _read(self, frames):
+        try:
+            for frame_idx, frame in enumerate(frames):
+                with self._condition:
+                    self.dropped += self._latest is not None
+                    self._latest = (frame_idx, frame, time.perf_counter())
+                    self._condition.notify()
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify()
+
+    def __iter__(self):
+        while True:
+            with self._condition:
+                while self._latest is None and not self._done:
+                    self._condition.wait()
+                if self._latest is None:
+                    return
+                latest, self._latest = self._latest, None
+            yield latest
+
+
+class LiveAnalyzer:
+    """Keeps the tracking and lowest pedal point state of a stream and summarizes
+    the knee angles of the last strokes. Only counters and the state of the last
+    frames are kept, so memory stays bounded on an endless stream.
+
+    Frames dropped by the reader still count for the smoother and the lowest pedal
+    points: the smoother gets the time since the previous analyzed frame, and the
+    dropped frames get keypoints interpolated between the analyzed frames around
+    them (which never become a lowest pedal point), so the minimum distance between
+    two lowest pedal points stays in frames of the stream."""
+
+    def __init__(
+        self,
+        model,
+        input_size,
+        image_height,
+        image_width,
+        fps,
+        window=8,
+        report_every=3,
+    ):
+        """
+        Args:
+            model: model object to use for inference
+            input_size: input size of the model
+            image_height: height of the frames in pixels
+            image_width: width of the frames in pixels
+            fps: frame rate of the stream
+            window: number of most recent strokes the statistics are computed over
+            report_every: number of strokes between two reports
+        """
+        self.fps = fps
+        self.report_every = report_every
+        self.tracker = KeypointTracker(
+            model,
+            input_size,
+            image_height,
+            image_width,
+            smoother=create_smoother(fps),
+            frame_gate=create_frame_gate(record_frames=False),
+            duplicate_detector=create_duplicate_detector(record_frames=False),
+            crop_backend=PIPELINE_CONFIG["crop_backend"],
+        )
+        self.lowest_pedal_points = LowestPedalPointDetector()
+        # stream index of the first frame, the lowest pedal points count from it
+        self._first_frame_idx = None
+        # stream index and keypoints of the last analyzed frame
+        self._frame_idx = None
+        self._keypoints = None
+        self.strokes = 0
+        # (timestamp, knee angle) of the last strokes
+        self.window = deque(maxlen=window)
+
+    def update(self, frame_idx, frame):
+        """Analyzes the next frame.
+
+        Args:
+            frame_idx: index of the frame in the stream, frames dropped since the
+                previous call are not passed
+            frame: [H, W, 3] frame
+        Returns:
+            a report dict after every report_every strokes, None otherwise
+        """
+        if self._frame_idx is None:
+            self._first_frame_idx = frame_idx
+            gap = 1
+            keypoints = self.tracker.update(frame)
+        else:
+            gap = frame_idx - self._frame_idx
+            keypoints = self.tracker.update(frame, dt=gap / self.fps)
+        confirmed = []
+        for i in range(1, gap):
+            confirmed += self.lowest_pedal_points.update(
+                self._keypoints + (keypoints - self._keypoints) * i / gap, valid=False
+            )
+        frame_gate = self.tracker.frame_gate
+        confirmed += self.lowest_pedal_points.update(
+            keypoints, valid=frame_gate is None or not frame_gate.skipped
+        )
+        self._frame_idx, self._keypoints = frame_idx, keypoints
+        report = None
+        for peak_idx, _, (_, knee_angle) in confirmed:
+            stream_frame_idx = self._first_frame_idx + peak_idx
+            self.window.append((stream_frame_idx / self.fps, knee_angle))
+            self.strokes += 1
+            if self.strokes % self.report_every == 0:
+                report = self.report(frame_idx / self.fps)
+        return report
+
+    def report(self, timestamp):
+        """Summarizes the knee angles of the strokes in the window."""
+        timestamps, angles = zip(*self.window)
+        report = {
+            "timestamp": timestamp,
+            "strokes": self.strokes,
+            "cadence_rpm": 60 / np.median(np.diff(timestamps))
+            if len(timestamps) > 1
+            else None,
+        }
+        angles, _ = filter_bad_angles(
+            angles,
+            range(len(angles)),
+            min_angle=PIPELINE_CONFIG["min_angle"],
+            max_angle=PIPELINE_CONFIG["max_angle"],
+        )
+        if len(angles) == 0:
+            return {**report, "angle": None, "std": None, "recommendation": None}
+        return {
+            **report,
+            "angle": float(np.mean(angles)),
+            "std": float(np.std(angles)),
+            "recommendation": make_recommendation(
+                np.mean(angles), ideal_angle=PIPELINE_CONFIG["ideal_angle"]
+            ),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="file, stream url, camera device or -")
+    parser.add_argument("--input-format", help="ffmpeg input format of the source")
+    parser.add_argument("--size", help="WIDTHxHEIGHT of the raw frames on stdin")
+    parser.add_argument("--fps", type=float, default=PIPELINE_CONFIG["max_fps"])
+    parser.add_argument("--window", type=int, default=8, help="strokes per report")
+    parser.add_argument("--report-every", type=int, default=3)
+    parser.add_argument(
+        "--no-drop",
+        action="store_true",
+        help="analyze every frame, even when the analysis falls behind the source",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+    # the model is loaded before the source is opened, frames of a live source
+    # would otherwise pile up and be dropped while it loads
+    model, input_size = load_model(
+        backend=PIPELINE_CONFIG["model_backend"],
+        model_name=PIPELINE_CONFIG["model_name"],
+        version=PIPELINE_CONFIG["model_version"],
+    )
+    if args.source == "-":
+        width, height = [int(size) for size in args.size.split("x")]
+        frames = raw_frames(sys.stdin.buffer, height, width)
+    else:
+        # files are played at their own speed so they behave like a live source
+        (height, width), frames = ffmpeg_frames(
+            args.source,
+            args.fps,
+            PIPELINE_CONFIG["max_pixels"],
+            input_format=args.input_format,
+            realtime=os.path.isfile(args.source) and not args.no_drop,
+        )
+    warmup_model(
+        model,
+        input_size,
+        frame_shapes=[(height, width)],
+        crop_backend=PIPELINE_CONFIG["crop_backend"],
+    )
+    analyzer = LiveAnalyzer(
+        model,
+        input_size,
+        height,
+        width,
+        args.fps,
+        window=args.window,
+        report_every=args.report_every,
+    )
+
+    if args.no_drop:
+        reader = None
+        stream = ((i, frame, time.perf_counter()) for i, frame in enumerate(frames))
+    else:
+        reader = LatestFrameReader(frames)
+        stream = iter(reader)
+    for frame_idx, frame, read_at in stream:
+        report = analyzer.update(frame_idx, frame)
+        if report is not None:
+            report["latency_s"] = time.perf_counter() - read_at
+            report["dropped_frames"] = reader.dropped if reader is not None else 0
+            frame_gate = analyzer.tracker.frame_gate
+            if frame_gate is not None:
+                report["skipped_frames"] = frame_gate.num_skipped
+            duplicate_detector = analyzer.tracker.duplicate_detector
+            if duplicate_detector is not None:
+                report["duplicate_frames"] = duplicate_detector.num_duplicates
+            print(json.dumps(report), flush=True)
+
+
+if __name__ == "__main__":
+    main()
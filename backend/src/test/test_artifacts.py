@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from utils.artifacts import save_keypoint_artifacts, load_keypoint_artifacts
+from utils.cropping import init_crop_region
+
+
+class TestArtifacts(unittest.TestCase):
+    def test_save_load_keypoint_artifacts(self):
+        keypoints = np.random.rand(10, 17, 3)
+        crop_regions = [init_crop_region(144, 256)] * 10
+        timestamps = np.arange(10) / 15
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "video_keypoints.npz")
+            save_keypoint_artifacts(
+                file_path, keypoints, crop_regions, timestamps, metadata={"fps": 15}
+            )
+            artifacts = load_keypoint_artifacts(file_path)
+        self.assertEqual(artifacts["keypoints"].dtype, np.float32)
+        np.testing.assert_allclose(artifacts["keypoints"], keypoints, rtol=1e-6)
+        self.assertEqual(artifacts["crop_regions"].shape, (10, 4))
+        np.testing.assert_allclose(artifacts["timestamps"], timestamps, rtol=1e-6)
+        self.assertEqual(artifacts["metadata"], {"fps": 15})
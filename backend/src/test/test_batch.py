@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+from batch import find_videos, pending_videos, write_result, analyze_video
+from utils.model import FakePoseModel
+
+
+class TestBatch(unittest.TestCase):
+    def test_find_videos(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "customer"))
+            for file_name in ["a.mp4", "customer/b.MOV", "notes.txt"]:
+                open(os.path.join(tmp_dir, file_name), "w").close()
+            manifest_path = os.path.join(tmp_dir, "manifest.txt")
+            with open(manifest_path, "w") as file:
+                file.write("# archive\na.mp4\n\ncustomer/b.MOV\n")
+
+            from_dir = find_videos(tmp_dir)
+            from_manifest = find_videos(manifest_path)
+        self.assertEqual([video_id for video_id, _ in from_dir], ["a", "customer__b"])
+        self.assertEqual(from_dir, from_manifest)
+
+    def test_resume(self):
+        videos = [("a", "a.mp4"), ("b", "b.mp4")]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_result(tmp_dir, "a", {"angle": 145})
+            self.assertEqual(pending_videos(videos, tmp_dir), [("b", "b.mp4")])
+            self.assertEqual(os.listdir(tmp_dir), ["a.json"])
+
+    def test_analyze_video(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            keypoints_file_path = os.path.join(tmp_dir, "video_keypoints.npz")
+            results = analyze_video(
+                "backend/src/test/test_video.mp4",
+                FakePoseModel(),
+                256,
+                keypoints_file_path=keypoints_file_path,
+            )
+            self.assertTrue(os.path.exists(keypoints_file_path))
+        self.assertIn(results["recommendation"], ["UP", "DOWN", "NOOP"])
+        self.assertGreater(len(results["used_timestamped_angles"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
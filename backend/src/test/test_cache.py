@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import shutil
+import unittest
+from unittest import mock
+import numpy as np
+from utils.cache import ResultCache, compute_cache_key, hash_video_file
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "cache")
+        self.file_name = os.path.join(self.tmp_dir.name, "video")
+        self.artifact_path = f"{self.file_name}_yvalues.png"
+        with open(self.artifact_path, "wb") as file:
+            file.write(b"0" * 100)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _put(self, cache, key):
+        cache.put(
+            key,
+            self.file_name,
+            {"angle": 145.0, "y_value_plot_file_path": self.artifact_path},
+            np.zeros((5, 17, 3)),
+            np.zeros((5, 2)),
+            [self.artifact_path],
+        )
+
+    def test_compute_cache_key(self):
+        video_hash = hash_video_file("backend/src/test/test_video.mp4")
+        config = {"max_fps": 15, "ideal_angle": 145}
+        self.assertEqual(
+            compute_cache_key(video_hash, config),
+            compute_cache_key(video_hash, dict(reversed(list(config.items())))),
+        )
+        self.assertNotEqual(
+            compute_cache_key(video_hash, config),
+            compute_cache_key(video_hash, {"max_fps": 15, "ideal_angle": 140}),
+        )
+
+    def test_put_get_restore(self):
+        cache = ResultCache(self.cache_dir)
+        self.assertIsNone(cache.get("key"))
+        self._put(cache, "key")
+        entry = cache.get("key")
+        self.assertEqual(entry["keypoints"].shape, (5, 17, 3))
+        new_file_name = os.path.join(self.tmp_dir.name, "other")
+        results, restored = cache.restore(entry, new_file_name)
+        self.assertEqual(
+            results["y_value_plot_file_path"], f"{new_file_name}_yvalues.png"
+        )
+        self.assertEqual(restored, [f"{new_file_name}_yvalues.png"])
+        self.assertTrue(os.path.exists(restored[0]))
+
+    def test_get_evicted_concurrently(self):
+        cache = ResultCache(self.cache_dir)
+        self._put(cache, "key")
+        entry_path = os.path.join(self.cache_dir, "key")
+
+        def evict(path):
+            # another request evicts the entry while it is being read
+            shutil.rmtree(entry_path)
+            raise FileNotFoundError(path)
+
+        with mock.patch("os.listdir", side_effect=evict):
+            self.assertIsNone(cache.get("key"))
+
+    def test_evict(self):
+        cache = ResultCache(self.cache_dir, max_entries=2)
+        self._put(cache, "a")
+        self._put(cache, "b")
+        os.utime(os.path.join(self.cache_dir, "a"), (0, 0))
+        os.utime(os.path.join(self.cache_dir, "b"), (1, 1))
+        cache.get("a")
+        self._put(cache, "c")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
@@ -4,8 +4,14 @@ import sys
 # add src dir to sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 import unittest
-from utils.cropping import determine_crop_region
+from utils.cropping import (
+    determine_crop_region,
+    init_crop_region,
+    crop_and_resize,
+    crop_and_resize_numpy,
+)
 import numpy as np
+import tensorflow as tf
 
 
 class TestCropping(unittest.TestCase):
@@ -43,3 +49,25 @@ class TestCropping(unittest.TestCase):
                 "y_min": 0.0,
             },
         )
+
+    def test_crop_and_resize_numpy(self):
+        random_state = np.random.RandomState(0)
+        image = random_state.randint(0, 256, size=(254, 452, 3), dtype=np.uint8)
+        crop_regions = [
+            # padded to a square on both sides
+            init_crop_region(254, 452),
+            init_crop_region(452, 254),
+            {"y_min": 0.13, "x_min": -0.2, "y_max": 0.71, "x_max": 0.37},
+            {"y_min": -0.3, "x_min": 0.45, "y_max": 1.2, "x_max": 1.1},
+        ]
+        buffer = np.zeros((1, 192, 192, 3), dtype=np.int32)
+        for crop_region in crop_regions:
+            expected = tf.cast(
+                crop_and_resize(
+                    tf.expand_dims(image, axis=0), crop_region, crop_size=[192, 192]
+                ),
+                tf.int32,
+            ).numpy()
+            output = crop_and_resize_numpy(image, crop_region, (192, 192), out=buffer)
+            self.assertIs(output, buffer)
+            np.testing.assert_array_equal(output, expected)
@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+from unittest import mock
+import entry
+from utils.model import FakePoseModel
+
+VIDEO_FILE_PATH = os.path.abspath("backend/src/test/test_video.mp4")
+
+
+class TestEntry(unittest.TestCase):
+    def run_request(self, frame_retention):
+        """Runs a request on the test video, returns the uploaded results and the
+        names of the uploaded blobs"""
+        uploaded = {}
+
+        def download(account_name, container, file_path, **kwargs):
+            shutil.copyfile(VIDEO_FILE_PATH, file_path)
+
+        def upload(account_name, container, blobs):
+            for blob_name in blobs:
+                with open(blob_name, "rb") as file:
+                    uploaded[blob_name] = file.read()
+
+        cwd = os.getcwd()
+        # the model is only a global of entry once init ran
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.multiple(
+            entry,
+            create=True,
+            model=FakePoseModel(),
+            input_size=256,
+            result_cache=None,
+            FRAME_RETENTION=frame_retention,
+            download_video_from_storageaccount=download,
+            upload_results_to_storageaccount=upload,
+            delete_blob_from_storage_account=mock.DEFAULT,
+        ):
+            os.chdir(tmp_dir)
+            try:
+                entry.run(json.dumps({"file_name": "video.mp4", "profile": False}))
+                self.assertEqual(os.listdir(tmp_dir), [])
+            finally:
+                os.chdir(cwd)
+        return json.loads(uploaded["video.json"]), set(uploaded)
+
+    def test_run_memory(self):
+        results, uploaded = self.run_request("memory")
+        self.assertIn("video.png", uploaded)
+        self.assertIn("video_anglevideo.mp4", uploaded)
+        self.assertEqual(results["angle_image_file_path"], "video.png")
+
+    def test_run_none(self):
+        results, uploaded = self.run_request("none")
+        self.assertNotIn("video.png", uploaded)
+        self.assertNotIn("video_anglevideo.mp4", uploaded)
+        self.assertIn("video_keypoints.npz", uploaded)
+        self.assertNotIn("angle_image_file_path", results)
+        self.assertGreater(len(results["used_timestamped_angles"]), 0)
+
+    def test_post_process_skipped_frames(self):
+        random_state = np.random.RandomState(0)
+        all_keypoints = random_state.rand(60, 17, 3)
+        all_keypoints[:, :, 0] += np.sin(np.arange(60) / 2)[:, None]
+        skipped_frames = [5, 6, 7]
+        postprocessed = entry.post_process_video(
+            all_keypoints, min_angle=0, max_angle=180, skipped_frames=skipped_frames
+        )
+        all_angles, lowest_pedal_point_indices = postprocessed[2:4]
+        self.assertTrue(np.isnan(all_angles[6]).all())
+        self.assertFalse(np.isnan(postprocessed[5]))
+        self.assertFalse(set(lowest_pedal_point_indices) & set(skipped_frames))
+        results = entry.build_results(
+            np.arange(60) / 15,
+            all_angles,
+            lowest_pedal_point_indices,
+            *postprocessed[5:],
+            145,
+            stroke_boundaries=lowest_pedal_point_indices,
+            skipped_frames=skipped_frames,
+        )
+        self.assertEqual(len(results["timestamped_angles"]), 57)
+        self.assertEqual(results["skipped_timestamps"], [5 / 15, 6 / 15, 7 / 15])
+        json.dumps(results, allow_nan=False)
+
+    def test_init_frame_retention(self):
+        with mock.patch.object(entry, "FRAME_RETENTION", "spill"):
+            with self.assertRaises(ValueError):
+                entry.init()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import os
+import sys
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from utils.frames import FrameStore, retain_frames
+
+
+class TestFrames(unittest.TestCase):
+    def test_frame_store(self):
+        frames = np.random.default_rng(0).integers(
+            0, 256, (4, 12, 16, 3), dtype=np.uint8
+        )
+        in_memory = FrameStore((6, 12, 16, 3), max_memory_bytes=6 * 12 * 16 * 3)
+        self.assertFalse(in_memory.on_disk)
+        on_disk = FrameStore((6, 12, 16, 3), max_memory_bytes=6 * 12 * 16 * 3 - 1)
+        self.assertTrue(on_disk.on_disk)
+        for store in (in_memory, on_disk):
+            store.append(frames[0])
+            store.extend(frames[1:])
+            store.close()
+            np.testing.assert_array_equal(store.frames, frames)
+            self.assertFalse(store.frames.flags.writeable)
+        # the file is removed once closed, the frames stay readable
+        self.assertFalse(os.path.exists(on_disk.path))
+        self.assertIsInstance(retain_frames(on_disk.frames, "memory"), np.memmap)
+
+    def test_retain_frames(self):
+        frames = [np.zeros((4, 4, 3), dtype=np.uint8)] * 2
+        self.assertEqual(retain_frames(frames, "memory").shape, (2, 4, 4, 3))
+        self.assertIsNone(retain_frames(frames, "none"))
+        with self.assertRaises(ValueError):
+            retain_frames(frames, "spill")
+
+
+if __name__ == "__main__":
+    unittest.main()
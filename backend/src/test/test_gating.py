@@ -0,0 +1,110 @@
+import os
+import sys
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+import tensorflow as tf
+from utils.gating import DuplicateFrameDetector, FrameGate, thumbnail
+from utils.model import get_keypoints_from_video
+
+
+class _ConstantModel:
+    def __init__(self, score):
+        self.score = score
+        self.calls = 0
+
+    def __call__(self, input):
+        self.calls += 1
+        keypoints = np.full((1, 1, 17, 3), 0.5, dtype=np.float32)
+        keypoints[..., 2] = self.score
+        return {"output_0": tf.constant(keypoints)}
+
+
+class TestGating(unittest.TestCase):
+    def test_thumbnail(self):
+        frame = np.full((256, 455, 3), 255, dtype=np.uint8)
+        self.assertEqual(thumbnail(frame, size=32).shape, (32, 57))
+        self.assertEqual(thumbnail(frame).max(), 1.0)
+
+    def test_skips_static_frames_without_torso(self):
+        gate = FrameGate(motion_threshold=0.005, max_skipped_frames=2)
+        frame = np.zeros((64, 96, 3), dtype=np.uint8)
+        no_torso = np.zeros((17, 3))
+        skipped = [gate.update(frame, None)]
+        skipped += [gate.update(frame, no_torso) for _ in range(5)]
+        # at most max_skipped_frames in a row, then the model runs again
+        self.assertEqual(skipped, [False, True, True, False, True, True])
+        self.assertEqual(gate.skipped_frames, [1, 2, 4, 5])
+        self.assertTrue(gate.skipped)
+        gate.advance()
+        self.assertFalse(gate.skipped)
+
+    def test_runs_on_moving_frames_or_visible_torso(self):
+        gate = FrameGate(motion_threshold=0.005)
+        frame = np.zeros((64, 96, 3), dtype=np.uint8)
+        gate.update(frame, None)
+        self.assertFalse(gate.update(frame + 10, np.zeros((17, 3))))
+        self.assertFalse(gate.update(frame + 10, np.ones((17, 3))))
+
+    def test_get_keypoints_from_video_reuses_keypoints(self):
+        frames = np.zeros((10, 64, 96, 3), dtype=np.uint8)
+        model = _ConstantModel(score=0.0)
+        gate = FrameGate(max_skipped_frames=4)
+        all_keypoints = get_keypoints_from_video(frames, model, 192, frame_gate=gate)
+        self.assertEqual(len(all_keypoints), 10)
+        self.assertEqual(gate.skipped_frames, [1, 2, 3, 4, 6, 7, 8, 9])
+        self.assertEqual(model.calls, 2)
+        # a cyclist that is visible is never skipped
+        model = _ConstantModel(score=0.9)
+        gate = FrameGate(max_skipped_frames=4)
+        get_keypoints_from_video(frames, model, 192, frame_gate=gate)
+        self.assertEqual(gate.skipped_frames, [])
+        self.assertEqual(model.calls, 10)
+
+    def test_duplicate_frame_detector(self):
+        detector = DuplicateFrameDetector(step=16)
+        frame = np.random.default_rng(0).integers(0, 255, (64, 96, 3), dtype=np.uint8)
+        changed = frame.copy()
+        # a pixel between the pixels of the sparse grid
+        changed[1, 1, 0] += 1
+        duplicates = [
+            detector.update(f) for f in [frame, frame, frame.copy(), changed, frame]
+        ]
+        self.assertEqual(duplicates, [False, True, True, False, False])
+        self.assertEqual(detector.duplicate_frames, [1, 2])
+        self.assertEqual(detector.num_duplicates, 2)
+
+    def test_counts_without_recording_frames(self):
+        gate = FrameGate(max_skipped_frames=2, record_frames=False)
+        detector = DuplicateFrameDetector(record_frames=False)
+        frame = np.zeros((64, 96, 3), dtype=np.uint8)
+        gate.update(frame, None)
+        for _ in range(5):
+            gate.update(frame, np.zeros((17, 3)))
+            detector.update(frame)
+        self.assertIsNone(gate.skipped_frames)
+        self.assertEqual(gate.num_skipped, 4)
+        self.assertIsNone(detector.duplicate_frames)
+        self.assertEqual(detector.num_duplicates, 4)
+
+    def test_get_keypoints_from_video_reuses_keypoints_of_duplicates(self):
+        frames = np.zeros((6, 64, 96, 3), dtype=np.uint8)
+        frames[3:] = 100
+        model = _ConstantModel(score=0.0)
+        detector = DuplicateFrameDetector()
+        gate = FrameGate(max_skipped_frames=4)
+        all_keypoints = get_keypoints_from_video(
+            frames, model, 192, frame_gate=gate, duplicate_detector=detector
+        )
+        self.assertEqual(len(all_keypoints), 6)
+        self.assertEqual(detector.duplicate_frames, [1, 2, 4, 5])
+        self.assertEqual(model.calls, 2)
+        # the frame gate still counts the frames it did not check
+        self.assertEqual(gate.frame_idx, 5)
+        self.assertEqual(gate.skipped_frames, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
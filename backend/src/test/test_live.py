@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from live import LatestFrameReader, LiveAnalyzer, ffmpeg_frames
+from utils.model import FakePoseModel
+
+
+class TestLive(unittest.TestCase):
+    def test_latest_frame_reader_drops_old_frames(self):
+        def frames():
+            for i in range(20):
+                time.sleep(0.005)
+                yield np.full((2, 2, 3), i, np.uint8)
+
+        reader = LatestFrameReader(frames())
+        frame_indices = []
+        for frame_idx, frame, _ in reader:
+            self.assertEqual(frame[0, 0, 0], frame_idx)
+            frame_indices.append(frame_idx)
+            time.sleep(0.02)
+        self.assertEqual(frame_indices, sorted(frame_indices))
+        self.assertEqual(frame_indices[-1], 19)
+        self.assertEqual(len(frame_indices) + reader.dropped, 20)
+        self.assertGreater(reader.dropped, 0)
+
+    def test_live_analyzer(self):
+        (height, width), frames = ffmpeg_frames(
+            "backend/src/test/test_video.mp4", fps=15, max_pixels=256
+        )
+        analyzer = LiveAnalyzer(FakePoseModel(), 256, height, width, fps=15)
+        reports = [analyzer.update(i, frame) for i, frame in enumerate(frames)]
+        reports = [report for report in reports if report is not None]
+        self.assertEqual((height, width), (254, 452))
+        self.assertGreater(len(reports), 1)
+        self.assertEqual(reports[-1]["strokes"], 3 * len(reports))
+        self.assertAlmostEqual(reports[-1]["cadence_rpm"], 90, delta=5)
+        self.assertIn(reports[-1]["recommendation"], ["UP", "DOWN", "NOOP"])
+        # only the keypoints of frames that can still become a peak are kept
+        self.assertLess(len(analyzer.lowest_pedal_points._keypoints), 30)
+        self.assertIsNone(analyzer.tracker.frame_gate.skipped_frames)
+
+    def test_live_analyzer_dropped_frames(self):
+        (height, width), frames = ffmpeg_frames(
+            "backend/src/test/test_video.mp4", fps=15, max_pixels=256
+        )
+        analyzer = LiveAnalyzer(FakePoseModel(), 256, height, width, fps=15)
+        # about every other frame is dropped, the cyclist keeps pedaling meanwhile
+        reports = []
+        for i, frame in enumerate(frames):
+            if i % 2 == 0 or i % 7 == 0:
+                analyzer.tracker.model.calls = i
+                reports.append(analyzer.update(i, frame))
+        reports = [report for report in reports if report is not None]
+        self.assertGreater(len(reports), 1)
+        self.assertAlmostEqual(reports[-1]["cadence_rpm"], 90, delta=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
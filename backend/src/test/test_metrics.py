@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import threading
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from utils.metrics import (
+    MetricsRegistry,
+    request_metrics,
+    span,
+    increment,
+    current_metrics,
+)
+from utils.utils import timeit
+
+
+@timeit
+def _stage():
+    increment("frames_decoded", 3)
+    with span("inner"):
+        pass
+
+
+class TestMetrics(unittest.TestCase):
+    def test_request_metrics(self):
+        with request_metrics("run") as metrics:
+            _stage()
+            _stage()
+        summary = metrics.summary()
+        self.assertEqual(summary["counters"], {"frames_decoded": 6})
+        stages = summary["spans"]["children"]
+        self.assertEqual([stage["name"] for stage in stages], ["_stage", "_stage"])
+        self.assertEqual(stages[0]["children"][0]["name"], "inner")
+        self.assertGreaterEqual(summary["spans"]["wall_time_s"], 0)
+        self.assertEqual(
+            [name for name, _ in metrics.iter_spans()],
+            ["_stage", "_stage/inner", "_stage", "_stage/inner"],
+        )
+        self.assertIsNone(current_metrics())
+
+    def test_span_peak_rss(self):
+        with request_metrics("run"):
+            with span("large") as large:
+                frames = np.ones((256, 2 ** 20), dtype=np.uint8)
+                time.sleep(0.1)
+                del frames
+            with span("small") as small:
+                time.sleep(0.1)
+        # the peak of a span is not the high-water mark of the process
+        self.assertGreater(large.peak_rss - small.peak_rss, 128 * 2 ** 20)
+        self.assertGreater(large.rss_growth, 128 * 2 ** 20)
+
+    def test_span_cpu_time(self):
+        stop = threading.Event()
+
+        def spin():
+            while not stop.is_set():
+                pass
+
+        thread = threading.Thread(target=spin)
+        thread.start()
+        try:
+            with request_metrics("run"):
+                with span("sleep") as sleeping:
+                    time.sleep(0.2)
+        finally:
+            stop.set()
+            thread.join()
+        # the busy thread is not counted in the span
+        self.assertLess(sleeping.cpu_time, 0.05)
+
+    def test_no_request_metrics(self):
+        # timing outside of a request only logs
+        _stage()
+        self.assertIsNone(current_metrics())
+
+    def test_to_prometheus(self):
+        registry = MetricsRegistry(namespace="test")
+        with request_metrics("run") as metrics:
+            _stage()
+        registry.observe(metrics)
+        text = registry.to_prometheus()
+        self.assertIn("test_requests_total 1", text)
+        self.assertIn('test_stage_calls_total{stage="_stage/inner"} 1', text)
+        self.assertIn("test_frames_decoded_total 3", text)
+
+    def test_to_prometheus_waits_for_observe(self):
+        registry = MetricsRegistry(namespace="test")
+        texts = []
+        # a request that is being observed holds the lock
+        with registry._lock:
+            scrape = threading.Thread(
+                target=lambda: texts.append(registry.to_prometheus())
+            )
+            scrape.start()
+            scrape.join(0.1)
+            self.assertTrue(scrape.is_alive())
+            registry.requests = 1
+        scrape.join()
+        self.assertIn("test_requests_total 1", texts[0])
@@ -4,22 +4,104 @@ import numpy as np
 from moviepy.editor import VideoFileClip
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # add src dir to sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 from utils.model import load_model_from_tfhub
+from utils.model import load_fake_model, FakePoseModel
 from utils.model import get_keypoints_from_video
+from utils.model import warmup_model
+
+
+class _CountingModel:
+    def __init__(self):
+        self.input_shapes = []
+
+    def __call__(self, input):
+        self.input_shapes.append(tuple(input.shape))
+        keypoints = np.full((1, 1, 17, 3), 0.5, dtype=np.float32)
+        return {"output_0": tf.constant(keypoints)}
 
 
 class TestModel(unittest.TestCase):
+    def test_warmup_model(self):
+        model = _CountingModel()
+        durations = warmup_model(
+            model, 192, batch_sizes=(1,), frame_shapes=((64, 96), (96, 64))
+        )
+        # one direct inference and two frames per video shape
+        self.assertEqual(len(durations), 3)
+        self.assertEqual(len(model.input_shapes), 5)
+        self.assertEqual(model.input_shapes[0], (1, 192, 192, 3))
+
+    def test_get_keypoints_from_video_stops_early(self):
+        frames = (np.zeros((64, 96, 3), np.uint8) for _ in range(10))
+        stopped = []
+        all_keypoints = get_keypoints_from_video(
+            frames,
+            _CountingModel(),
+            192,
+            on_frame=lambda frame_idx, _: stopped.append(frame_idx) or frame_idx == 3,
+        )
+        self.assertEqual(len(all_keypoints), 4)
+        self.assertEqual(stopped, [0, 1, 2, 3])
+
     def test_load_model_from_tf_hub(self):
         _, size1 = load_model_from_tfhub(model_name="movenet_thunder")
         _, size2 = load_model_from_tfhub(model_name="movenet_lightning")
         self.assertEqual(size1, 256)
         self.assertEqual(size2, 192)
 
+    def test_fake_model(self):
+        model, input_size = load_fake_model(model_name="movenet_lightning")
+        self.assertEqual(input_size, 192)
+        images = np.zeros((4, input_size, input_size, 3), dtype=np.int32)
+        batched = model(input=tf.constant(images))["output_0"].numpy()
+        self.assertEqual(batched.shape, (4, 1, 17, 3))
+        # the same poses one frame at a time
+        single = FakePoseModel()
+        for keypoints in batched:
+            np.testing.assert_array_equal(
+                keypoints, single(input=images[:1])["output_0"].numpy()[0]
+            )
+        # every joint of the upper body has its own place, the shoulders are above
+        # and in front of the hips and the wrists reach forward to the handlebar
+        self.assertEqual(len(np.unique(FakePoseModel.UPPER_BODY, axis=0)), 11)
+        pose = batched[0, 0]
+        self.assertLess(pose[5, 0], pose[11, 0] - 0.1)
+        self.assertGreater(pose[5, 1], pose[11, 1])
+        self.assertGreater(pose[9, 1], pose[5, 1])
+        # thigh and shin keep their length while pedaling
+        for keypoints in batched[:, 0]:
+            for hip, knee, ankle in [(11, 13, 15), (12, 14, 16)]:
+                thigh = np.linalg.norm(keypoints[knee, :2] - keypoints[hip, :2])
+                shin = np.linalg.norm(keypoints[ankle, :2] - keypoints[knee, :2])
+                self.assertAlmostEqual(thigh, 0.21, delta=0.02)
+                self.assertAlmostEqual(shin, 0.21, delta=0.02)
+
+    def test_fake_model_keypoints_per_video(self):
+        model, input_size = load_fake_model(model_name="movenet_lightning")
+        warmup_model(model, input_size, batch_sizes=(1, 4))
+        frames = np.random.default_rng(0).integers(
+            0, 256, (30, 64, 113, 3), dtype=np.uint8
+        )
+        first = get_keypoints_from_video(frames, model, input_size)
+        second = get_keypoints_from_video(frames, model, input_size)
+        np.testing.assert_array_equal(first, second)
+        # concurrent videos do not advance the crank of each other
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            concurrent = list(
+                executor.map(
+                    lambda _: get_keypoints_from_video(frames, model, input_size),
+                    range(2),
+                )
+            )
+        for keypoints in concurrent:
+            np.testing.assert_array_equal(keypoints, first)
+
     def test_get_keypoints_from_video(self):
-        model, input_size = load_model_from_tfhub(model_name="movenet_thunder")
+        model, input_size = load_fake_model(model_name="movenet_thunder")
         clip = VideoFileClip("backend/src/test/test_video.mp4", audio=False)
         video_tensor = tf.convert_to_tensor(
             np.array(list(clip.iter_frames())), dtype=tf.uint8
@@ -0,0 +1,106 @@
+import os
+import sys
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import re
+import tempfile
+import threading
+import unittest
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+from utils.mp4 import (
+    fetch_video_window,
+    find_top_level_box,
+    parse_moov,
+    hash_video_window,
+)
+from utils.preprocessing import reduce_video_quality
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves the test video with support for single byte range requests"""
+
+    video_path = "./backend/src/test/test_video.mp4"
+
+    def do_GET(self):
+        with open(self.video_path, "rb") as file:
+            data = file.read()
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match is None:
+            self.send_response(200)
+        else:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            data = data[start : end + 1]
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMp4(unittest.TestCase):
+    def test_parse_moov(self):
+        with open("./backend/src/test/test_video.mp4", "rb") as file:
+            head = file.read(4096)
+        self.assertIsNone(find_top_level_box(head[:16]))
+        box_type, start, end = find_top_level_box(head)
+        self.assertEqual(box_type, b"moov")
+        info = parse_moov(head, start, end)
+        self.assertEqual((info["width"], info["height"]), (452, 254))
+        self.assertEqual(info["rotation"], 0)
+        self.assertAlmostEqual(info["duration"], 15)
+        self.assertAlmostEqual(info["fps"], 15)
+        self.assertEqual(info["num_frames"], 225)
+        self.assertEqual(info["sync_samples"].tolist(), list(range(0, 225, 30)))
+        np.testing.assert_allclose(info["sample_times"], np.arange(225) / 15)
+        # the samples follow each other in the mdat box
+        np.testing.assert_array_equal(
+            info["sample_offsets"][1:],
+            info["sample_offsets"][:-1] + info["sample_sizes"][:-1],
+        )
+
+    def test_fetch_video_window(self):
+        video_path = RangeHandler.video_path
+        size = os.path.getsize(video_path)
+        server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/test_video.mp4"
+        reads = []
+
+        def read_range(offset, length):
+            reads.append((offset, length))
+            request = urllib.request.Request(
+                url, headers={"Range": f"bytes={offset}-{offset + length - 1}"}
+            )
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.status, 206)
+                return response.read()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sparse_path = os.path.join(tmp_dir, "test_video.mp4")
+            fetched = fetch_video_window(read_range, size, sparse_path, 4)
+            self.assertEqual(fetched, sum(length for _, length in reads))
+            self.assertLess(fetched, size)
+            self.assertEqual(os.path.getsize(sparse_path), size)
+            frames = list(reduce_video_quality(sparse_path, 128, 15, 4).iter_frames())
+            # the cache key of the sparse file is the one of the complete video
+            sparse_hash = hash_video_window(sparse_path, 4)
+        self.assertEqual(sparse_hash, hash_video_window(video_path, 4))
+        self.assertNotEqual(sparse_hash, hash_video_window(video_path, 8))
+        expected = list(reduce_video_quality(video_path, 128, 15, 4).iter_frames())
+        np.testing.assert_array_equal(frames, expected)
+
+    def test_not_an_mp4(self):
+        with self.assertRaises(ValueError):
+            find_top_level_box(b"\x1aE\xdf\xa3" + bytes(60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import threading
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+from utils.pipeline import StageGraph
+from utils.metrics import request_metrics, increment
+
+
+class TestPipeline(unittest.TestCase):
+    def test_stages_overlap_and_get_results(self):
+        graph = StageGraph(max_workers=4)
+        started = threading.Barrier(2, timeout=5)
+
+        def slow(value):
+            # both stages have to run at the same time to pass the barrier
+            started.wait()
+            increment("stages")
+            return value
+
+        graph.add("source", lambda: 2)
+        graph.add("upload", lambda source: slow(source * 10), after=["source"])
+        graph.add("render", lambda source: slow(source + 1), after=["source"])
+        graph.add("combine", lambda a, b: a + b, after=["upload", "render"])
+        with request_metrics() as metrics:
+            results = graph.run()
+        self.assertEqual(results["combine"], 23)
+        # the stages run in the context of the request
+        self.assertEqual(metrics.counters, {"stages": 2})
+        path = [stage["name"] for stage in metrics.summary()["critical_path"]]
+        self.assertEqual(path[0], "source")
+        self.assertEqual(path[-1], "combine")
+
+    def test_group_runs_one_stage_at_a_time(self):
+        graph = StageGraph(max_workers=4)
+        running = []
+        order = []
+
+        def render(name):
+            running.append(name)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.02)
+            order.append(name)
+            running.remove(name)
+
+        graph.add("source", lambda: None)
+        graph.add("plots", lambda _: render("plots"), after=["source"], group="r")
+        graph.add("video", lambda _: render("video"), after=["source"], group="r")
+        graph.add("upload", lambda _: time.sleep(0.03), after=["source"])
+        graph.run()
+        # ready stages start in the order they were added
+        self.assertEqual(order, ["plots", "video"])
+        # the video waited for the plots, not for the upload
+        self.assertEqual(
+            [stage["name"] for stage in graph.critical_path()],
+            ["source", "plots", "video"],
+        )
+
+    def test_failing_stage(self):
+        graph = StageGraph()
+        calls = []
+        graph.add("fail", lambda: 1 / 0)
+        graph.add("other", lambda: calls.append("other"))
+        graph.add("after", lambda _: calls.append("after"), after=["fail"])
+        with self.assertRaises(ZeroDivisionError):
+            graph.run()
+        self.assertNotIn("after", calls)
+
+    def test_unknown_stage(self):
+        graph = StageGraph()
+        with self.assertRaises(ValueError):
+            graph.add("upload", lambda render: None, after=["render"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,6 +8,13 @@ from utils.postprocessing import calc_knee_angle
 from utils.postprocessing import find_camera_facing_side
 from utils.postprocessing import filter_bad_angles
 from utils.postprocessing import make_recommendation
+from utils.postprocessing import StreamingPeakDetector
+from utils.postprocessing import LowestPedalPointDetector
+from utils.postprocessing import AngleConvergence
+from utils.postprocessing import get_lowest_pedal_frames
+from utils.postprocessing import get_front_leg_keypoint_indices
+import numpy as np
+from scipy.signal import find_peaks
 
 
 class TestPostProcessing(unittest.TestCase):
@@ -137,3 +144,75 @@ class TestPostProcessing(unittest.TestCase):
         self.assertEqual(
             make_recommendation(inner_knee_angle=0, ideal_angle=170, buffer=5), "UP"
         )
+
+    def test_streaming_peak_detector(self):
+        random_state = np.random.RandomState(0)
+        for _ in range(200):
+            distance = random_state.randint(1, 20)
+            values = np.sin(np.arange(150) / random_state.uniform(1, 5))
+            values += random_state.normal(0, 0.1, len(values))
+            # flat peaks of two and three samples
+            values[[20, 40, 41]] = values[[21, 39, 42]] = 3
+            detector = StreamingPeakDetector(distance=distance)
+            peaks = []
+            for value in values:
+                peaks += detector.update(value)
+            # most peaks are confirmed before the end of the series
+            self.assertGreater(len(peaks), 0)
+            peaks += detector.flush()
+            self.assertEqual(peaks, list(find_peaks(values, distance=distance)[0]))
+
+    def test_lowest_pedal_point_detector(self):
+        random_state = np.random.RandomState(0)
+        all_keypoints = random_state.rand(100, 17, 3)
+        all_keypoints[:, :, 0] += np.sin(np.arange(100) / 2)[:, None]
+        detector = LowestPedalPointDetector()
+        confirmed = []
+        for keypoints in all_keypoints:
+            confirmed += detector.update(keypoints)
+        confirmed += detector.flush()
+        indices = get_front_leg_keypoint_indices(detector.facing_direction)
+        expected = get_lowest_pedal_frames(all_keypoints, indices)
+        self.assertEqual([i for i, _, _ in confirmed], list(expected))
+        self.assertEqual(
+            confirmed[0][2],
+            calc_knee_angle([all_keypoints[expected[0]][i][1::-1] for i in indices]),
+        )
+
+    def test_lowest_pedal_point_detector_invalid_frames(self):
+        random_state = np.random.RandomState(0)
+        all_keypoints = random_state.rand(100, 17, 3)
+        all_keypoints[:, :, 0] += np.sin(np.arange(100) / 2)[:, None]
+        detector = LowestPedalPointDetector()
+        indices = get_front_leg_keypoint_indices(
+            find_camera_facing_side(all_keypoints[0])
+        )
+        peaks = get_lowest_pedal_frames(all_keypoints, indices)
+        # the frames without a pose are never a lowest pedal point
+        invalid_frames = {peaks[1], peaks[2] + 1}
+        confirmed = []
+        for i, keypoints in enumerate(all_keypoints):
+            confirmed += detector.update(keypoints, valid=i not in invalid_frames)
+        confirmed += detector.flush()
+        expected = get_lowest_pedal_frames(
+            all_keypoints, indices, invalid_frames=invalid_frames
+        )
+        self.assertNotIn(peaks[1], expected)
+        self.assertEqual(len(expected), len(peaks) - 1)
+        self.assertEqual([i for i, _, _ in confirmed], list(expected))
+        self.assertEqual(detector.lowest_pedal_point_indices, list(expected))
+
+    def test_angle_convergence(self):
+        convergence = AngleConvergence(threshold=1.0, min_strokes=6)
+        # implausible angles are never counted
+        self.assertFalse(convergence.update(100))
+        self.assertEqual(convergence.num_angles, 0)
+        for angle in [150, 151, 149, 150.5, 149.5, 150, 150.5]:
+            self.assertFalse(convergence.update(angle))
+        self.assertLess(convergence.half_width, 1.0)
+        self.assertTrue(convergence.update(149.5))
+        self.assertEqual(convergence.num_angles, 6)
+        noisy = AngleConvergence(threshold=1.0, min_strokes=6)
+        for angle in [140, 160, 145, 155, 140, 160]:
+            noisy.update(angle)
+        self.assertFalse(noisy.converged)
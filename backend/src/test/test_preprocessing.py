@@ -1,10 +1,29 @@
 import unittest
 import os
 import sys
+import tempfile
+import subprocess
+from unittest import mock
+import numpy as np
+import imageio_ffmpeg
 
 # add src dir to sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
-from utils.preprocessing import reduce_video_quality
+from utils.preprocessing import (
+    reduce_video_quality,
+    open_video_stream,
+    create_decode_pool,
+    decode_video_segments,
+    extract_frames,
+)
+from utils.cache import hash_video_file, hash_video
+
+TEST_VIDEO_PATH = "./backend/src/test/test_video.mp4"
+
+
+def _chunks(file_path, chunk_size=64 * 1024):
+    with open(file_path, "rb") as file:
+        yield from iter(lambda: file.read(chunk_size), b"")
 
 
 class TestPreProcessing(unittest.TestCase):
@@ -19,3 +38,106 @@ class TestPreProcessing(unittest.TestCase):
         self.assertEqual(result.size[0], (size * 1.77))
         self.assertEqual(result.size[1], size)
         self.assertLessEqual(result.duration, duration)
+
+    def test_decode_video_segments(self):
+        executor = create_decode_pool(3)
+        self.addCleanup(executor.shutdown)
+        clip, frames = decode_video_segments(
+            TEST_VIDEO_PATH, 64, 10, 12, executor=executor, workers=3
+        )
+        expected = reduce_video_quality(TEST_VIDEO_PATH, 64, 10, 12)
+        self.assertEqual((clip.fps, clip.w, clip.h), (10, 113, 64))
+        np.testing.assert_array_equal(frames, list(expected.iter_frames()))
+        # the workers write into the memory-mapped file of the frame store
+        _, mapped = decode_video_segments(
+            TEST_VIDEO_PATH,
+            64,
+            10,
+            12,
+            executor=executor,
+            workers=3,
+            max_memory_bytes=0,
+        )
+        self.assertIsInstance(mapped, np.memmap)
+        np.testing.assert_array_equal(mapped, frames)
+        # a clip that starts more than 100 frames in, where the reader seeks
+        _, frames = decode_video_segments(
+            TEST_VIDEO_PATH, 64, 10, 1, executor=executor, workers=3
+        )
+        expected = reduce_video_quality(TEST_VIDEO_PATH, 64, 10, 1)
+        np.testing.assert_array_equal(frames, list(expected.iter_frames()))
+
+    def test_decode_video_segments_short_clip(self):
+        # too few frames for a segment per worker, decoded with a single reader
+        with mock.patch("utils.preprocessing._decode_segment") as decode_segment:
+            _, frames = decode_video_segments(
+                TEST_VIDEO_PATH,
+                64,
+                10,
+                12,
+                executor=None,
+                workers=3,
+                min_segment_frames=100,
+            )
+            # without worker processes, e.g. when entry.init did not run
+            _, unsegmented = decode_video_segments(
+                TEST_VIDEO_PATH, 64, 10, 12, executor=None, workers=3
+            )
+        decode_segment.assert_not_called()
+        expected = reduce_video_quality(TEST_VIDEO_PATH, 64, 10, 12)
+        np.testing.assert_array_equal(frames, list(expected.iter_frames()))
+        np.testing.assert_array_equal(unsegmented, frames)
+
+    def test_extract_frames(self):
+        # the frames of a low resolution clip, extracted at the full resolution
+        low_res = list(reduce_video_quality(TEST_VIDEO_PATH, 64, 10, 12).iter_frames())
+        frames = extract_frames(
+            TEST_VIDEO_PATH, {3: low_res[3], 90: low_res[90]}, 720, 10, 12
+        )
+        expected = list(
+            reduce_video_quality(TEST_VIDEO_PATH, 720, 10, 12).iter_frames()
+        )
+        self.assertEqual(sorted(frames), [3, 90])
+        np.testing.assert_array_equal(frames[3], expected[3])
+        np.testing.assert_array_equal(frames[90], expected[90])
+
+    def test_open_video_stream(self):
+        # the moov box of the test video comes before the mdat box
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, "video.mp4")
+            video = open_video_stream(_chunks(TEST_VIDEO_PATH), file_path, 100, 15, 4)
+            frames = np.array(list(video.iter_frames()))
+            self.assertFalse(os.path.exists(file_path))
+        clip = reduce_video_quality(TEST_VIDEO_PATH, 100, 15, 4)
+        expected = np.array(list(clip.iter_frames()))
+        self.assertEqual((video.fps, video.w, video.h), (clip.fps, clip.w, clip.h))
+        self.assertEqual(video.duration, clip.duration)
+        self.assertEqual(frames.shape, expected.shape)
+        # the same frames, only resampled differently
+        self.assertLess(np.mean(np.abs(frames - expected.astype(float))), 5)
+        self.assertEqual(video.hexdigest(), hash_video(TEST_VIDEO_PATH, 4))
+        video.close()
+
+    def test_open_video_stream_falls_back_to_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # ffmpeg writes the moov box at the end by default
+            moov_at_end_path = os.path.join(tmp_dir, "moov_at_end.mp4")
+            subprocess.run(
+                [
+                    imageio_ffmpeg.get_ffmpeg_exe(),
+                    "-loglevel",
+                    "error",
+                    "-i",
+                    TEST_VIDEO_PATH,
+                    "-c",
+                    "copy",
+                    moov_at_end_path,
+                ],
+                check=True,
+            )
+            file_path = os.path.join(tmp_dir, "video.mp4")
+            video = open_video_stream(_chunks(moov_at_end_path), file_path, 100, 15, 4)
+            self.assertIsNone(video)
+            self.assertEqual(
+                hash_video_file(file_path), hash_video_file(moov_at_end_path)
+            )
@@ -0,0 +1,59 @@
+import os
+import sys
+import pstats
+import tempfile
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+from utils.profiling import profile_request
+from utils.pipeline import StageGraph
+
+
+def _decode_stage():
+    return sum(range(1000))
+
+
+def _render_stage(decoded):
+    return decoded + 1
+
+
+class TestProfiling(unittest.TestCase):
+    def test_profile_request_disabled(self):
+        with profile_request("unused", enabled=False) as profile_files:
+            pass
+        self.assertEqual(profile_files, [])
+
+    def test_profile_request(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, "video")
+            with profile_request(prefix, enabled=True) as profile_files:
+                data = [list(range(100)) for _ in range(100)]
+            self.assertEqual(
+                profile_files,
+                [
+                    f"{prefix}_profile.prof",
+                    f"{prefix}_profile.txt",
+                    f"{prefix}_memory.txt",
+                ],
+            )
+            for profile_file in profile_files:
+                self.assertTrue(os.path.getsize(profile_file) > 0)
+            with open(f"{prefix}_memory.txt") as file:
+                self.assertIn("test_profiling.py", file.read())
+        self.assertEqual(len(data), 100)
+
+    def test_profile_stage_graph(self):
+        graph = StageGraph(max_workers=2)
+        graph.add("decode", _decode_stage)
+        graph.add("render", _render_stage, after=["decode"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, "video")
+            with profile_request(prefix, enabled=True):
+                results = graph.run()
+            stats = pstats.Stats(f"{prefix}_profile.prof")
+        # the stages run on the threads of the graph
+        functions = {function for _, _, function in stats.stats}
+        self.assertIn("_decode_stage", functions)
+        self.assertIn("_render_stage", functions)
+        self.assertEqual(results["render"], sum(range(1000)) + 1)
@@ -0,0 +1,54 @@
+import os
+import sys
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from utils.smoothing import KeypointSmoother
+from utils.cropping import MIN_CROP_KEYPOINT_SCORE
+
+
+class TestSmoothing(unittest.TestCase):
+    def test_removes_jitter_of_static_keypoints(self):
+        random_state = np.random.RandomState(0)
+        smoother = KeypointSmoother(fps=15)
+        keypoints = np.full((17, 3), 0.5)
+        raw, smoothed = [], []
+        for _ in range(100):
+            noisy = keypoints + random_state.normal(0, 0.01, keypoints.shape)
+            raw.append(noisy)
+            smoothed.append(smoother.update(noisy))
+        self.assertLess(np.std(smoothed[10:]), np.std(raw[10:]) / 2)
+
+    def test_follows_moving_keypoints(self):
+        smoother = KeypointSmoother(fps=15)
+        for frame_idx in range(30):
+            keypoints = np.full((17, 3), 0.8)
+            keypoints[:, 1] = 0.1 + 0.02 * frame_idx
+            smoothed = smoother.update(keypoints)
+        self.assertAlmostEqual(smoothed[0, 1], keypoints[0, 1], delta=0.03)
+
+    def test_time_since_previous_frame(self):
+        # a frame after a dropped frame is smoothed like at half the frame rate
+        smoother = KeypointSmoother(fps=15)
+        half_rate = KeypointSmoother(fps=7.5)
+        for frame_idx in range(0, 30, 2):
+            keypoints = np.full((17, 3), 0.8)
+            keypoints[:, 1] = 0.1 + 0.02 * frame_idx
+            np.testing.assert_allclose(
+                smoother.update(keypoints, dt=2 / 15), half_rate.update(keypoints)
+            )
+
+    def test_keeps_score_of_single_bad_frame(self):
+        smoother = KeypointSmoother(fps=15)
+        keypoints = np.full((17, 3), 0.8)
+        for _ in range(10):
+            smoother.update(keypoints)
+        dropout = keypoints.copy()
+        dropout[:, 2] = 0.0
+        self.assertGreater(smoother.update(dropout)[0, 2], MIN_CROP_KEYPOINT_SCORE)
+
+
+if __name__ == "__main__":
+    unittest.main()
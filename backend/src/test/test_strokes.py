@@ -0,0 +1,46 @@
+import os
+import sys
+
+# add src dir to sys
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+import unittest
+import numpy as np
+from utils.strokes import segment_strokes
+
+
+class TestStrokes(unittest.TestCase):
+    def test_segment_strokes(self):
+        fps = 15
+        timestamps = np.arange(60) / fps
+        # a stroke every 10 frames (90 rpm), the angle peaks halfway each stroke
+        knee_angles = 110 + 40 * np.sin(np.pi * (np.arange(60) % 10) / 10)
+        knee_angles[25] = 160
+        strokes = segment_strokes(knee_angles, [3, 13, 23, 33, 43], timestamps)
+        self.assertEqual(strokes["count"], 4)
+        self.assertAlmostEqual(strokes["cadence_rpm"], 90)
+        np.testing.assert_allclose(strokes["durations_s"], [10 / fps] * 4)
+        np.testing.assert_allclose(
+            strokes["start_times"], [3 / fps, 13 / fps, 23 / fps, 33 / fps]
+        )
+        self.assertEqual(strokes["max_angles"], [150, 150, 160, 150])
+        self.assertEqual(strokes["min_angles"], [110, 110, 110, 110])
+        self.assertAlmostEqual(strokes["variability"]["duration_cv"], 0)
+        self.assertAlmostEqual(
+            strokes["variability"]["max_angle_successive_diff"], 20 / 3
+        )
+
+    def test_skipped_frames(self):
+        # the angles of the frames without a pose are NaN and left out
+        knee_angles = [150, np.nan, 120, 160, np.nan, np.nan, 140]
+        strokes = segment_strokes(knee_angles, [0, 3, 6], np.arange(7) / 15)
+        self.assertEqual(strokes["min_angles"], [120, 160])
+        self.assertEqual(strokes["max_angles"], [150, 160])
+
+    def test_too_few_strokes(self):
+        strokes = segment_strokes([140, 150], [1], [0, 1 / 15])
+        self.assertEqual(strokes["count"], 0)
+        self.assertIsNone(strokes["cadence_rpm"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""""" """""" """""" """""
+KEYPOINT ARTIFACT FUNCTIONS
+""" """""" """""" """""" ""
+import json
+import logging
+import numpy as np
+from utils.utils import timeit
+
+CROP_REGION_KEYS = ["y_min", "x_min", "y_max", "x_max"]
+
+
+def crop_regions_to_array(crop_regions):
+    """Converts a list of crop region dicts to a [B, 4] float32 array.
+
+    Args:
+        crop_regions: list of {y_min, x_min, y_max, x_max, height, width} dicts
+    Returns:
+        [B, 4] array with the y_min, x_min, y_max and x_max of each crop region
+    """
+    return np.array(
+        [[region[key] for key in CROP_REGION_KEYS] for region in crop_regions],
+        dtype=np.float32,
+    ).reshape(-1, len(CROP_REGION_KEYS))
+
+
+@timeit
+def save_keypoint_artifacts(
+    output_file_path, all_keypoints, crop_regions, timestamps, metadata=None
+):
+    """Saves the model output of a video so it can be analyzed again without inference.
+
+    Args:
+        output_file_path: path of the .npz file to write
+        all_keypoints: [B, 17, 3] keypoints of every frame
+        crop_regions: list of B crop region dicts used to run inference on each frame
+        timestamps: B timestamps in seconds of every frame in the analyzed window
+        metadata: json serializable dict stored next to the arrays (e.g. fps, config)
+    """
+    np.savez(
+        output_file_path,
+        keypoints=np.asarray(all_keypoints, dtype=np.float32),
+        crop_regions=crop_regions_to_array(crop_regions),
+        timestamps=np.asarray(timestamps, dtype=np.float32),
+        metadata=np.array(json.dumps(metadata or {})),
+    )
+    logging.info(f"Saved keypoint artifacts to {output_file_path}")
+
+
+def load_keypoint_artifacts(file_path):
+    """Loads the keypoint artifacts written by save_keypoint_artifacts.
+
+    Args:
+        file_path: path of the .npz file
+    Returns:
+        dict with 'keypoints' [B, 17, 3], 'crop_regions' [B, 4], 'timestamps' [B]
+        and 'metadata'
+    """
+    with np.load(file_path) as artifacts:
+        return {
+            "keypoints": artifacts["keypoints"],
+            "crop_regions": artifacts["crop_regions"],
+            "timestamps": artifacts["timestamps"],
+            "metadata": json.loads(str(artifacts["metadata"])),
+        }
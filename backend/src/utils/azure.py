@@ -1,8 +1,11 @@
 """""" """""" """""" """""
 AZURE RELATED FUNCTIONS
 """ """""" """""" """""" ""
+import os
 import logging
 from utils.utils import timeit
+from utils.metrics import increment
+from utils.mp4 import fetch_video_window
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
 
@@ -24,10 +27,44 @@ def download_video_from_storageaccount(account_name, container, file_path):
 
     with open(file_path, "wb") as local_file:
         blob_data = blob_client.download_blob()
-        blob_data.readinto(local_file)
+        increment("bytes_downloaded", blob_data.readinto(local_file))
         logging.info(f"Downloaded {file_path} to local disk")
 
 
+def stream_video_from_storageaccount(account_name, container, file_path):
+    """Downloads a blob in chunks, every chunk is yielded as soon as it arrives"""
+    blob_service_client = _get_blob_service_client(account_name)
+    blob_client = blob_service_client.get_blob_client(
+        container=container, blob=file_path
+    )
+    for chunk in blob_client.download_blob().chunks():
+        increment("bytes_downloaded", len(chunk))
+        yield chunk
+
+
+@timeit
+def download_video_window_from_storageaccount(
+    account_name, container, file_path, max_duration
+):
+    """Downloads only the middle max_duration seconds of an mp4/mov blob with ranged
+    reads, see fetch_video_window.
+
+    Raises:
+        ValueError: when the blob is not an mp4/mov file
+    """
+    blob_service_client = _get_blob_service_client(account_name)
+    blob_client = blob_service_client.get_blob_client(
+        container=container, blob=file_path
+    )
+    size = blob_client.get_blob_properties().size
+    fetch_video_window(
+        lambda offset, length: blob_client.download_blob(offset, length).readall(),
+        size,
+        file_path,
+        max_duration,
+    )
+
+
 @timeit
 def upload_results_to_storageaccount(account_name, container, blobs):
     """Uploads the results to a blob storage. Overwrites if the blob already exists
@@ -44,6 +81,7 @@ def upload_results_to_storageaccount(account_name, container, blobs):
         )
         with open(blob_file_name, "rb") as blob:
             blob_client.upload_blob(blob, overwrite=True)
+        increment("bytes_uploaded", os.path.getsize(blob_file_name))
         logging.info(f"Uploaded {blob_file_name} to blob storage")
 
 
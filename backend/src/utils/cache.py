@@ -0,0 +1,229 @@
+"""""" """""" """""" """""
+RESULT CACHE FUNCTIONS
+""" """""" """""" """""" ""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from utils.utils import timeit
+from utils.mp4 import hash_video_window
+
+HASH_CHUNK_SIZE = 1024 * 1024
+RESULTS_FILE_NAME = "results.json"
+KEYPOINTS_FILE_NAME = "keypoints.npy"
+ANGLES_FILE_NAME = "angles.npy"
+ARTIFACTS_DIR_NAME = "artifacts"
+
+
+@timeit
+def hash_video_file(file_path, chunk_size=HASH_CHUNK_SIZE):
+    """Calculates the sha256 hash of the bytes of a video file.
+
+    Args:
+        file_path: path to the video on local disk
+        chunk_size: number of bytes read at once
+    Returns:
+        the hexadecimal digest of the file contents
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@timeit
+def hash_video(file_path, max_duration):
+    """Calculates the hash the cache key of a video is computed from. For an mp4/mov
+    that is the hash of the bytes its analysis window is decoded from (see
+    WindowHash), so the sparse file of a ranged download and a streamed video get
+    the same hash as the complete video, for other videos the hash of the file.
+
+    Args:
+        file_path: path to the video on local disk
+        max_duration: maximum duration in seconds of the analysis window
+    Returns:
+        the hexadecimal digest
+    """
+    try:
+        return hash_video_window(file_path, max_duration)
+    except ValueError:
+        return hash_video_file(file_path)
+
+
+def compute_cache_key(video_hash, pipeline_config):
+    """Combines the video hash with everything that influences the results.
+
+    Args:
+        video_hash: hash of the bytes of the video
+        pipeline_config: json serializable dict with the model name/version,
+          the preprocessing parameters and the ideal angle
+    Returns:
+        the hexadecimal cache key
+    """
+    config = json.dumps(pipeline_config, sort_keys=True)
+    return hashlib.sha256(f"{video_hash}:{config}".encode()).hexdigest()
+
+
+def _strip_file_name(path, file_name):
+    return path[len(file_name) :] if path.startswith(file_name) else path
+
+
+def _directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+class ResultCache:
+    """Content-addressed cache of pipeline results on local disk.
+
+    Every entry is a directory named after its cache key which holds the result json,
+    the keypoints and angles as .npy files and the rendered artifacts. Artifacts are
+    stored by their suffix (e.g. '_yvalues.png') so a hit can be restored under the
+    file name of the new upload. The least recently used entries are evicted once the
+    cache grows beyond max_bytes or max_entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3, max_entries=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """Looks up an entry and marks it as recently used.
+
+        Args:
+            key: cache key from compute_cache_key
+        Returns:
+            None on a miss, otherwise a dict with 'results', 'keypoints', 'angles'
+            and 'artifacts' (a {suffix: path} dict of the cached files)
+        """
+        entry_path = self._entry_path(key)
+        if not os.path.isdir(entry_path):
+            return None
+        try:
+            with open(os.path.join(entry_path, RESULTS_FILE_NAME), "r") as file:
+                results = json.load(file)
+            keypoints = np.load(os.path.join(entry_path, KEYPOINTS_FILE_NAME))
+            angles = np.load(os.path.join(entry_path, ANGLES_FILE_NAME))
+            artifacts_path = os.path.join(entry_path, ARTIFACTS_DIR_NAME)
+            artifacts = {
+                suffix: os.path.join(artifacts_path, suffix)
+                for suffix in os.listdir(artifacts_path)
+            }
+            # the modification time of the entry directory is used as LRU timestamp
+            os.utime(entry_path)
+        except (OSError, ValueError):
+            if not os.path.isdir(entry_path):
+                # evicted by another request since the lookup
+                return None
+            logging.warning(f"Dropping corrupt cache entry {key}")
+            shutil.rmtree(entry_path, ignore_errors=True)
+            return None
+        logging.info(f"Cache hit for {key}")
+        return {
+            "results": results,
+            "keypoints": keypoints,
+            "angles": angles,
+            "artifacts": artifacts,
+        }
+
+    def put(self, key, file_name, results, all_keypoints, all_angles, artifact_paths):
+        """Stores the results of a run and evicts old entries if needed.
+
+        Args:
+            key: cache key from compute_cache_key
+            file_name: name of the processed video without extension, all artifact
+              paths and result paths are expected to start with it
+            results: json serializable results dict
+            all_keypoints: [B, 17, 3] keypoints of the video
+            all_angles: [B, 2] (start_angle, knee_angle) values of the video
+            artifact_paths: local paths of the rendered artifacts
+        """
+        entry_path = self._entry_path(key)
+        if os.path.isdir(entry_path):
+            return
+        tmp_path = f"{entry_path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        artifacts_path = os.path.join(tmp_path, ARTIFACTS_DIR_NAME)
+        os.makedirs(artifacts_path)
+
+        results = {
+            k: _strip_file_name(v, file_name) if k.endswith("_file_path") else v
+            for k, v in results.items()
+        }
+        with open(os.path.join(tmp_path, RESULTS_FILE_NAME), "w") as file:
+            json.dump(results, file)
+        np.save(
+            os.path.join(tmp_path, KEYPOINTS_FILE_NAME),
+            np.asarray(all_keypoints, dtype=np.float32),
+        )
+        np.save(
+            os.path.join(tmp_path, ANGLES_FILE_NAME),
+            np.asarray(all_angles, dtype=np.float32),
+        )
+        for path in artifact_paths:
+            shutil.copyfile(
+                path, os.path.join(artifacts_path, _strip_file_name(path, file_name))
+            )
+
+        if self.max_bytes is not None and _directory_size(tmp_path) > self.max_bytes:
+            logging.info(f"Not caching {key}, entry is larger than the cache")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # another worker stored the same entry in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        logging.info(f"Stored {key} in cache")
+        self.evict()
+
+    def restore(self, entry, file_name):
+        """Copies the artifacts of a cached entry to the paths of a new upload.
+
+        Args:
+            entry: dict returned by get
+            file_name: name of the new video without extension
+        Returns:
+            the results dict pointing to the restored files
+            list of the restored local file paths
+        """
+        restored = []
+        for suffix, path in entry["artifacts"].items():
+            shutil.copyfile(path, f"{file_name}{suffix}")
+            restored.append(f"{file_name}{suffix}")
+        results = {
+            k: f"{file_name}{v}" if k.endswith("_file_path") else v
+            for k, v in entry["results"].items()
+        }
+        return results, restored
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits its limits."""
+        entries = [
+            self._entry_path(key)
+            for key in os.listdir(self.cache_dir)
+            if os.path.isdir(self._entry_path(key)) and ".tmp-" not in key
+        ]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        sizes = [_directory_size(path) for path in entries]
+        total_size = sum(sizes)
+        while entries and (
+            (self.max_bytes is not None and total_size > self.max_bytes)
+            or (self.max_entries is not None and len(entries) > self.max_entries)
+        ):
+            path = entries.pop()
+            total_size -= sizes.pop()
+            shutil.rmtree(path, ignore_errors=True)
+            logging.info(f"Evicted {os.path.basename(path)} from cache")
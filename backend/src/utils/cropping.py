@@ -1,5 +1,4 @@
 import numpy as np
-import tensorflow as tf
 from utils.keypoints import KEYPOINT_DICT
 
 # Confidence score to determine whether a keypoint prediction is reliable.
@@ -184,6 +183,8 @@ def crop_and_resize(image, crop_region, crop_size):
         crop_size: the size of the bounding box
     Returns:
         an image as a [256, 256, 3] tensor, cropped around the cyclist and resized to the correct input size"""
+    import tensorflow as tf
+
     boxes = [
         [
             crop_region["y_min"],
@@ -196,3 +197,88 @@ def crop_and_resize(image, crop_region, crop_size):
         image, box_indices=[0], boxes=boxes, crop_size=crop_size
     )
     return output_image
+
+
+def _interpolation_axis(start, end, in_size, out_size):
+    """Source coordinates along one axis of tf.image.crop_and_resize, computed in
+    float32 like the tensorflow kernel so the results are identical.
+
+    Returns:
+        the mask of coordinates inside the image, the indices of the pixels below
+        and above every coordinate and the interpolation weights of the latter
+    """
+    start, end = np.float32(start), np.float32(end)
+    if out_size > 1:
+        scale = (end - start) * np.float32(in_size - 1) / np.float32(out_size - 1)
+        coords = start * np.float32(in_size - 1) + scale * np.arange(
+            out_size, dtype=np.float32
+        )
+    else:
+        coords = np.full(
+            1, np.float32(0.5) * (start + end) * np.float32(in_size - 1), np.float32
+        )
+    inside = (coords >= 0) & (coords <= in_size - 1)
+    low = np.floor(coords)
+    weights = coords - low
+    low = np.clip(low, 0, in_size - 1).astype(np.intp)
+    high = np.clip(np.ceil(coords), 0, in_size - 1).astype(np.intp)
+    return inside, low, high, weights
+
+
+def crop_and_resize_numpy(image, crop_region, crop_size, out=None):
+    """Same as crop_and_resize followed by a cast to int32, in numpy. Crops, pads
+    and bilinearly resizes in a few vectorized passes without dispatching tensorflow
+    ops, and writes the model input into out.
+
+    Every source row is interpolated horizontally once, the rows are then
+    interpolated vertically, in the order of operations of tf.image.crop_and_resize
+    so the result is identical. Pixels outside the image are 0.
+
+    Args:
+        image: the image as a [H,W,3] uint8 array
+        crop_region: the dictionary representing the bounding box used to crop the image around the cyclist
+        crop_size: the (height, width) of the model input
+        out: optional [1, height, width, 3] int32 array that is reused between frames
+    Returns:
+        out, or a new [1, height, width, 3] int32 array
+    """
+    image = np.asarray(image)
+    image_height, image_width, channels = image.shape
+    height, width = crop_size
+    rows_inside, top, bottom, y_weights = _interpolation_axis(
+        crop_region["y_min"], crop_region["y_max"], image_height, height
+    )
+    columns_inside, left, right, x_weights = _interpolation_axis(
+        crop_region["x_min"], crop_region["x_max"], image_width, width
+    )
+    # index the rows of the image flattened to [H, W*3], per channel
+    channel_offsets = np.arange(channels)
+    left = (left[:, None] * channels + channel_offsets).ravel()
+    right = (right[:, None] * channels + channel_offsets).ravel()
+    x_weights = np.repeat(x_weights, channels)
+    # horizontal pass over the source rows that are needed
+    num_rows = int(rows_inside.sum())
+    rows, row_indices = np.unique(
+        np.concatenate([top[rows_inside], bottom[rows_inside]]), return_inverse=True
+    )
+    image_rows = image.reshape(image_height, image_width * channels).take(rows, axis=0)
+    left_pixels = image_rows.take(left, axis=1)
+    horizontal = np.subtract(
+        image_rows.take(right, axis=1), left_pixels, dtype=np.float32
+    )
+    horizontal *= x_weights
+    horizontal += left_pixels
+    # vertical pass
+    top_rows = horizontal.take(row_indices[:num_rows], axis=0)
+    output_rows = horizontal.take(row_indices[num_rows:], axis=0)
+    output_rows -= top_rows
+    output_rows *= y_weights[rows_inside, None]
+    output_rows += top_rows
+
+    if out is None:
+        out = np.empty((1, height, width, channels), dtype=np.int32)
+    output_image = out[0].reshape(height, width * channels)
+    output_image[~rows_inside] = 0
+    output_image[rows_inside] = output_rows
+    out[0, :, ~columns_inside] = 0
+    return out
@@ -0,0 +1,97 @@
+"""""" """""" """""" """""
+FRAME FUNCTIONS
+""" """""" """""" """""" ""
+import os
+import logging
+import weakref
+import tempfile
+import numpy as np
+
+# What happens to the frames of a video once the model ran on them, see retain_frames
+FRAME_RETENTION_POLICIES = ("memory", "none")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class FrameStore:
+    """Buffer the frames of a video are decoded into once, everything downstream
+    reads them from it as views without copying them.
+
+    The buffer is allocated for the maximum number of frames up front. When it
+    would take more than max_memory_bytes it is a np.memmap of a temporary file
+    instead of an array in memory, so the length of the analyzed window is not
+    limited by the memory of the service. The file is removed by close() (or when
+    the store is garbage collected): the views on its map stay readable until they
+    are garbage collected themselves.
+    """
+
+    def __init__(self, shape, max_memory_bytes=None, directory=None):
+        """
+        Args:
+            shape: (B, H, W, 3) shape of the buffer, B the maximum number of frames
+            max_memory_bytes: size in bytes above which the buffer is kept in a
+                memory-mapped file, None to always keep it in memory
+            directory: directory of the file, the system default if None
+        """
+        self.shape = tuple(int(size) for size in shape)
+        self.num_frames = 0
+        self.path = None
+        nbytes = int(np.prod(self.shape))
+        if max_memory_bytes is None or nbytes <= max_memory_bytes:
+            self._buffer = np.empty(self.shape, dtype=np.uint8)
+            return
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix=".frames")
+        os.close(fd)
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+        self._buffer = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=self.shape)
+        logging.info(f"Storing {self.shape[0]} frames of {self.shape[1:]} on disk")
+
+    @property
+    def on_disk(self):
+        return self.path is not None
+
+    @property
+    def frames(self):
+        """Read-only [num_frames, H, W, 3] view of the frames stored so far"""
+        frames = self._buffer[: self.num_frames]
+        frames.flags.writeable = False
+        return frames
+
+    def append(self, frame):
+        """Copies the next frame into the buffer"""
+        self._buffer[self.num_frames] = frame
+        self.num_frames += 1
+
+    def extend(self, frames):
+        """Copies the next frames into the buffer"""
+        self._buffer[self.num_frames : self.num_frames + len(frames)] = frames
+        self.num_frames += len(frames)
+
+    def close(self):
+        """Removes the file of the buffer, the frames stay readable"""
+        if self.on_disk:
+            self._finalizer()
+
+
+def retain_frames(frames, policy):
+    """Applies a frame retention policy to the frames of a video once the model ran
+    on them: "memory" keeps them where they were decoded to, in memory or in the
+    memory-mapped file of their FrameStore, and "none" drops them, when no output
+    needs them.
+
+    Args:
+        frames: [B, H, W, 3] frames, an array, tensor or list of frames
+        policy: one of FRAME_RETENTION_POLICIES
+    Returns:
+        the frames as an array (or tensor), None for "none"
+    """
+    if policy == "memory":
+        return frames if not isinstance(frames, list) else np.array(frames)
+    if policy == "none":
+        return None
+    raise ValueError(f"Unsupported frame retention policy: {policy}")
@@ -0,0 +1,156 @@
+"""""" """""" """""" """""
+GATING FUNCTIONS
+""" """""" """""" """""" ""
+import numpy as np
+from utils.cropping import torso_visible
+
+
+def thumbnail(frame, size=32):
+    """Grayscale version of the frame with about size pixels on its shortest side,
+    taken by striding over the frame (no interpolation).
+
+    Args:
+        frame: [H, W, C] uint8 frame
+        size: approximate size in pixels of the shortest side of the thumbnail
+    Returns:
+        [h, w] float32 array with values between 0 and 1
+    """
+    frame = np.asarray(frame)
+    step = max(1, min(frame.shape[:2]) // size)
+    return frame[::step, ::step].mean(axis=2, dtype=np.float32) / 255
+
+
+class FrameGate:
+    """Decides which frames are not worth running the model on.
+
+    After a frame in which the torso of the cyclist was not visible (the crop falls
+    back to the full image), the next frames are skipped as long as they hardly
+    differ from the last frame the model ran on: the cyclist is occluded or out of
+    frame and nothing has changed, so inference would not give a usable knee angle.
+    A pedaling cyclist changes about 1% of a low-res thumbnail per frame at 15 fps,
+    which always keeps the frame above the default motion_threshold. At most
+    max_skipped_frames consecutive frames are skipped, so a cyclist that comes back
+    without much motion is still found.
+
+    The keypoints of a skipped frame are not a pose of the cyclist, skipped is True
+    after such a frame so they can be left out of the analysis.
+    """
+
+    def __init__(
+        self, motion_threshold=0.005, max_skipped_frames=4, size=32, record_frames=True
+    ):
+        """
+        Args:
+            motion_threshold: mean absolute difference (between 0 and 1) between the
+                thumbnails of the frame and of the last inferred frame below which
+                the frame is skipped
+            max_skipped_frames: maximum number of consecutive skipped frames
+            size: approximate size in pixels of the shortest side of the thumbnails
+            record_frames: list the skipped frames in skipped_frames, when False
+                they are only counted in num_skipped (e.g. on an endless stream)
+        """
+        self.motion_threshold = motion_threshold
+        self.max_skipped_frames = max_skipped_frames
+        self.size = size
+        self.record_frames = record_frames
+        self.reset()
+
+    def reset(self):
+        self.frame_idx = -1
+        self.skipped_frames = [] if self.record_frames else None
+        self.num_skipped = 0
+        # whether the last frame was skipped
+        self.skipped = False
+        self._consecutive_skips = 0
+        self._reference = None
+
+    def advance(self):
+        """Moves on to the next frame without checking it, e.g. when the frame is a
+        duplicate of the previous frame"""
+        self.frame_idx += 1
+        self.skipped = False
+
+    def update(self, frame, previous_keypoints):
+        """Checks the next frame.
+
+        Args:
+            frame: [H, W, C] frame
+            previous_keypoints: (17, 3) keypoints the crop region of this frame is
+                determined from, None for the first frame
+        Returns:
+            True if inference can be skipped for this frame
+        """
+        self.frame_idx += 1
+        current = thumbnail(frame, self.size)
+        skip = (
+            previous_keypoints is not None
+            and self._reference is not None
+            and self._consecutive_skips < self.max_skipped_frames
+            and not torso_visible(previous_keypoints)
+            and np.mean(np.abs(current - self._reference)) < self.motion_threshold
+        )
+        if skip:
+            self._consecutive_skips += 1
+            self.num_skipped += 1
+            if self.record_frames:
+                self.skipped_frames.append(self.frame_idx)
+        else:
+            self._consecutive_skips = 0
+            self._reference = current
+        self.skipped = skip
+        return skip
+
+
+class DuplicateFrameDetector:
+    """Finds frames that are identical to the previous frame, e.g. the repeated
+    frames of a variable frame rate video that is resampled to a fixed frame rate.
+    The keypoints of the previous frame can be reused for them.
+
+    A sparse grid of pixels is compared first, so a frame that differs is usually
+    rejected after looking at a fraction of its pixels.
+    """
+
+    def __init__(self, step=16, record_frames=True):
+        """
+        Args:
+            step: distance in pixels between the pixels that are compared first
+            record_frames: list the duplicate frames in duplicate_frames, when False
+                they are only counted in num_duplicates (e.g. on an endless stream)
+        """
+        self.step = step
+        self.record_frames = record_frames
+        self.reset()
+
+    def reset(self):
+        self.frame_idx = -1
+        self.duplicate_frames = [] if self.record_frames else None
+        self.num_duplicates = 0
+        self._previous = None
+
+    def update(self, frame):
+        """Checks the next frame.
+
+        Args:
+            frame: [H, W, C] frame
+        Returns:
+            True if the frame is identical to the previous frame
+        """
+        self.frame_idx += 1
+        frame = np.asarray(frame)
+        previous, self._previous = self._previous, frame
+        duplicate = previous is not None and (
+            frame is previous
+            or (
+                frame.shape == previous.shape
+                and np.array_equal(
+                    frame[:: self.step, :: self.step],
+                    previous[:: self.step, :: self.step],
+                )
+                and np.array_equal(frame, previous)
+            )
+        )
+        if duplicate:
+            self.num_duplicates += 1
+            if self.record_frames:
+                self.duplicate_frames.append(self.frame_idx)
+        return duplicate
@@ -0,0 +1,294 @@
+"""""" """""" """""" """""
+METRICS FUNCTIONS
+""" """""" """""" """""" ""
+import os
+import time
+import logging
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ru_maxrss is reported in kilobytes on linux
+_RSS_UNIT_BYTES = 1024
+_PAGE_SIZE_BYTES = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+_current_metrics = contextvars.ContextVar("request_metrics", default=None)
+_current_span = contextvars.ContextVar("metrics_span", default=None)
+
+
+def _rss_bytes():
+    """Current resident set size of the process, the high-water mark where /proc is
+    not available"""
+    try:
+        with open("/proc/self/statm", "rb") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE_BYTES
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT_BYTES
+
+
+class _RssSampler:
+    """Samples the RSS of the process on a background thread while spans are open and
+    keeps the peak of every open span. The thread stops once no span is open."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self._spans = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, span):
+        with self._lock:
+            self._spans.add(span)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._sample, name="rss-sampler", daemon=True
+                )
+                self._thread.start()
+
+    def remove(self, span):
+        with self._lock:
+            self._spans.discard(span)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            rss = _rss_bytes()
+            with self._lock:
+                if not self._spans:
+                    self._thread = None
+                    return
+                for span in self._spans:
+                    span.max_rss = max(span.max_rss, rss)
+
+
+_rss_sampler = _RssSampler()
+
+
+def set_rss_sample_interval(interval):
+    """Sets the time in seconds between two RSS samples of the open spans, a shorter
+    interval catches shorter peaks at a higher cost"""
+    _rss_sampler.interval = interval
+
+
+class Span:
+    """Timing of one (possibly nested) stage of a request.
+
+    Wall time is measured with the monotonic perf_counter, cpu time with thread_time:
+    only the thread the span runs on is counted, not concurrent stages, other
+    requests or the threads TensorFlow runs ops on. The peak RSS is the largest
+    resident set size of the process sampled while the span was open, rss_growth is
+    how far it rose above the RSS at the start of the span.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.children = []
+        self.start = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.cpu_start = time.thread_time()
+        self.rss_start = _rss_bytes()
+        self.max_rss = self.rss_start
+        self.wall_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.rss_growth = None
+        _rss_sampler.add(self)
+
+    def finish(self):
+        self.wall_time = time.perf_counter() - self.start
+        self.cpu_time = time.thread_time() - self.cpu_start
+        _rss_sampler.remove(self)
+        self.peak_rss = max(self.max_rss, _rss_bytes())
+        self.rss_growth = self.peak_rss - self.rss_start
+
+    def elapsed_cpu_time(self):
+        """cpu time of the thread of the span so far, also from another thread where
+        the clock of that thread can be read, None otherwise"""
+        if threading.get_ident() == self.thread_id:
+            return time.thread_time() - self.cpu_start
+        try:
+            clock = time.pthread_getcpuclockid(self.thread_id)
+            return time.clock_gettime(clock) - self.cpu_start
+        except (AttributeError, OSError):
+            return None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "wall_time_s": self.wall_time,
+            "cpu_time_s": self.cpu_time,
+            "peak_rss_mb": None if self.peak_rss is None else self.peak_rss / 2 ** 20,
+            "rss_growth_mb": None
+            if self.rss_growth is None
+            else self.rss_growth / 2 ** 20,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+class RequestMetrics:
+    """Collects the spans and counters of a single request."""
+
+    def __init__(self, name="request"):
+        self.root = Span(name)
+        self.counters = {}
+        # stages that determined the wall time of the request, see StageGraph
+        self.critical_path = None
+        self._lock = threading.Lock()
+
+    def add_span(self, span, parent=None):
+        with self._lock:
+            (parent or self.root).children.append(span)
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def iter_spans(self):
+        """Yields (name, span) for every finished span, nested names joined by '/'"""
+        stack = [(child, child.name) for child in reversed(self.root.children)]
+        while stack:
+            span, path = stack.pop()
+            if span.wall_time is not None:
+                yield path, span
+            stack.extend(
+                (child, f"{path}/{child.name}") for child in reversed(span.children)
+            )
+
+    def summary(self):
+        """Returns a json serializable summary of the request so far."""
+        root = self.root.to_dict()
+        if self.root.wall_time is None:
+            root["wall_time_s"] = time.perf_counter() - self.root.start
+            root["cpu_time_s"] = self.root.elapsed_cpu_time()
+        summary = {"spans": root, "counters": dict(self.counters)}
+        if self.critical_path is not None:
+            summary["critical_path"] = self.critical_path
+        return summary
+
+
+@contextmanager
+def request_metrics(name="request"):
+    """Collects the metrics of everything that runs inside the context.
+    The finished request is added to the process wide registry."""
+    metrics = RequestMetrics(name)
+    metrics_token = _current_metrics.set(metrics)
+    span_token = _current_span.set(metrics.root)
+    try:
+        yield metrics
+    finally:
+        metrics.root.finish()
+        _current_span.reset(span_token)
+        _current_metrics.reset(metrics_token)
+        registry.observe(metrics)
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+@contextmanager
+def span(name):
+    """Times the code inside the context as a child of the enclosing span.
+    Does nothing when no request metrics are being collected."""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield None
+        return
+    new_span = Span(name)
+    metrics.add_span(new_span, parent=_current_span.get())
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    finally:
+        new_span.finish()
+        _current_span.reset(token)
+
+
+def increment(counter, value=1):
+    """Increments a counter of the current request, e.g. the number of decoded frames"""
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.increment(counter, value)
+
+
+def _prometheus_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name).strip("_").lower()
+
+
+class MetricsRegistry:
+    """Aggregates the metrics of all requests handled by this process."""
+
+    def __init__(self, namespace="bikefitting"):
+        self.namespace = namespace
+        self.requests = 0
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.peak_rss = 0
+        self._lock = threading.Lock()
+
+    def set_gauge(self, name, value):
+        """Sets a process level value, e.g. the time it took to load the model"""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, metrics):
+        with self._lock:
+            self.requests += 1
+            self.peak_rss = max(self.peak_rss, metrics.root.peak_rss or 0)
+            spans = [(metrics.root.name, metrics.root)] + list(metrics.iter_spans())
+            for name, stage_span in spans:
+                stage = self.stages.setdefault(
+                    name, {"count": 0, "wall_time": 0.0, "cpu_time": 0.0}
+                )
+                stage["count"] += 1
+                stage["wall_time"] += stage_span.wall_time
+                stage["cpu_time"] += stage_span.cpu_time
+            for counter, value in metrics.counters.items():
+                self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_prometheus(self):
+        """Renders the aggregated metrics in the prometheus text exposition format."""
+        ns = self.namespace
+        # observe updates everything under the lock, so a scrape never sees only
+        # part of a request
+        with self._lock:
+            lines = [
+                f"# HELP {ns}_requests_total Number of handled requests.",
+                f"# TYPE {ns}_requests_total counter",
+                f"{ns}_requests_total {self.requests}",
+                f"# HELP {ns}_peak_rss_bytes Largest resident set size seen in a "
+                "request.",
+                f"# TYPE {ns}_peak_rss_bytes gauge",
+                f"{ns}_peak_rss_bytes {self.peak_rss}",
+            ]
+            for metric, key, help_text in [
+                ("stage_calls_total", "count", "Number of times a stage ran."),
+                ("stage_wall_seconds_total", "wall_time", "Wall time per stage."),
+                ("stage_cpu_seconds_total", "cpu_time", "Cpu time per stage."),
+            ]:
+                lines.append(f"# HELP {ns}_{metric} {help_text}")
+                lines.append(f"# TYPE {ns}_{metric} counter")
+                for stage, values in sorted(self.stages.items()):
+                    lines.append(f'{ns}_{metric}{{stage="{stage}"}} {values[key]}')
+            for counter, value in sorted(self.counters.items()):
+                name = f"{ns}_{_prometheus_name(counter)}_total"
+                lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name} {value}")
+            for gauge, value in sorted(self.gauges.items()):
+                name = f"{ns}_{_prometheus_name(gauge)}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path):
+        """Atomically writes the metrics for the node exporter textfile collector."""
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, "w") as file:
+            file.write(self.to_prometheus())
+        os.replace(tmp_file_path, file_path)
+        logging.debug(f"Wrote prometheus metrics to {file_path}")
+
+
+registry = MetricsRegistry()
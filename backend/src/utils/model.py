@@ -1,8 +1,17 @@
+import time
 import logging
+import threading
+import numpy as np
 import tensorflow as tf
 import tensorflow_hub as tfhub
-from utils.cropping import init_crop_region, determine_crop_region, crop_and_resize
+from utils.cropping import (
+    init_crop_region,
+    determine_crop_region,
+    crop_and_resize,
+    crop_and_resize_numpy,
+)
 from utils.utils import timeit
+from utils.metrics import increment
 
 
 @timeit
@@ -35,6 +44,178 @@ def load_model_from_tfhub(model_name="movenet_thunder", version=4):
     return model, input_size
 
 
+class FakePoseModel:
+    """Stands in for the MoveNet signature without network access or inference cost.
+    Returns the pose of a cyclist pedaling at a constant cadence, in the coordinates
+    of the crop: the hips stay fixed, the upper body leans forward to the handlebar,
+    the ankles go around the crank and the knees follow from two equally long leg
+    segments. The crank advances by one frame for
+    every image the model runs on, regardless of its content, so the keypoints only
+    depend on the number of images run before. KeypointTracker runs every video on
+    its own model from start_video, so the keypoints of a video do not depend on
+    the warmup, earlier or concurrent videos. A little noise, seeded by the frame
+    number, is added so consecutive strokes do not give equal angles.
+
+    Accepts [B, H, W, 3] inputs of any batch size.
+    """
+
+    # (y, x) of the nose, eyes, ears, shoulders, elbows and wrists (left before
+    # right) of a cyclist facing right, leaning forward to the handlebar. The nose
+    # is the highest keypoint, 0.5 / 1.2 above the hips, and the shoulders are close
+    # enough to the hips that the nose alone sets the crop size
+    UPPER_BODY = np.array(
+        [
+            [0.5 - 0.5 / 1.2, 0.74],
+            [0.09, 0.72],
+            [0.09, 0.71],
+            [0.1, 0.66],
+            [0.1, 0.65],
+            [0.27, 0.66],
+            [0.27, 0.64],
+            [0.36, 0.78],
+            [0.36, 0.76],
+            [0.42, 0.88],
+            [0.42, 0.86],
+        ]
+    )
+
+    def __init__(self, fps=15, cadence=90, noise=0.003):
+        """
+        Args:
+            fps: frame rate of the frames the model runs on
+            cadence: pedaling cadence in revolutions per minute
+            noise: standard deviation of the noise on the keypoints
+        """
+        self.fps = fps
+        self.cadence = cadence
+        self.noise = noise
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def start_video(self):
+        """Returns a FakePoseModel with the same parameters whose crank starts at
+        the first frame, for the frames of a single video"""
+        return FakePoseModel(fps=self.fps, cadence=self.cadence, noise=self.noise)
+
+    def pose(self, frame_idx):
+        """Returns the [17, 3] keypoints of the frame_idx-th frame"""
+        crank_angle = 2 * np.pi * self.cadence / 60 * frame_idx / self.fps
+        jitter = np.random.RandomState(frame_idx).normal(0, self.noise, (17, 2))
+        keypoints = np.full((17, 3), 0.8, dtype=np.float32)
+        # the hips stay in the center of the crop and the nose sets the crop size,
+        # this keeps the crop region of get_keypoints_from_video from drifting
+        keypoints[:11, :2] = self.UPPER_BODY
+        for side in [0, 1]:
+            angle = crank_angle + side * np.pi
+            hip = np.array([0.5, 0.5])
+            ankle = np.array([0.82, 0.55]) + 0.08 * np.array(
+                [np.sin(angle), np.cos(angle)]
+            )
+            # two equally long leg segments, the knee points forward
+            distance = np.linalg.norm(ankle - hip)
+            unit = (ankle - hip) / distance
+            offset = np.sqrt(max(0.21 ** 2 - (distance / 2) ** 2, 0.0))
+            knee = (hip + ankle) / 2 + offset * np.array([-unit[1], unit[0]])
+            keypoints[11 + side, :2] = hip
+            keypoints[13 + side, :2] = knee
+            keypoints[15 + side, :2] = ankle
+        keypoints[:, :2] += jitter
+        return keypoints
+
+    def __call__(self, input):
+        batch_size = len(input)
+        with self._lock:
+            first = self.calls
+            self.calls += batch_size
+        keypoints = np.stack(
+            [self.pose(frame_idx) for frame_idx in range(first, first + batch_size)]
+        )
+        return {"output_0": tf.constant(keypoints[:, None])}
+
+
+def load_fake_model(model_name="movenet_thunder", fps=15, cadence=90):
+    """Loads a FakePoseModel in place of a movenet model, for tests and benchmarks
+    that run offline.
+
+    Args:
+      model_name: the movenet model whose input size is used, either
+        'movenet_thunder' or 'movenet_lighting'
+      fps: frame rate of the frames the model runs on
+      cadence: pedaling cadence in revolutions per minute
+    Returns:
+      A model object and an input size int
+    """
+    input_sizes = {"movenet_lightning": 192, "movenet_thunder": 256}
+    if model_name not in input_sizes:
+        raise ValueError("Unsupported model name: %s" % model_name)
+    return FakePoseModel(fps=fps, cadence=cadence), input_sizes[model_name]
+
+
+# where the model is loaded from, "fake" loads a FakePoseModel
+MODEL_BACKENDS = ("tfhub", "fake")
+
+
+def load_model(backend="tfhub", model_name="movenet_thunder", version=4):
+    """Loads the model from one of MODEL_BACKENDS.
+
+    Args:
+      backend: one of MODEL_BACKENDS
+      model_name: either 'movenet_thunder' or 'movenet_lighting'
+      version: version of the model, not used by the fake backend
+    Returns:
+      A model object and an input size int
+    """
+    if backend == "tfhub":
+        return load_model_from_tfhub(model_name=model_name, version=version)
+    if backend == "fake":
+        return load_fake_model(model_name=model_name)
+    raise ValueError(f"Unsupported model backend: {backend}")
+
+
+# implementations of the crop and resize of the frames before inference, "numpy"
+# writes into an int32 buffer that is reused for every frame of a video
+CROP_BACKENDS = ("tf", "numpy")
+
+
+@timeit
+def warmup_model(
+    model,
+    input_size,
+    batch_sizes=(1,),
+    frame_shapes=((256, 455),),
+    crop_backend="tf",
+):
+    """Runs inference on synthetic frames so the first request does not pay for
+    graph tracing, kernel selection and memory allocation.
+
+    Args:
+      model: model object to warm up
+      input_size: input size of the model
+      batch_sizes: batch sizes the model will be called with
+      frame_shapes: (height, width) of the videos that will be processed, the crop
+        and resize ops are warmed up for each of them
+      crop_backend: crop backend the videos will be processed with
+    Returns:
+      the duration in seconds of every warmup inference, in order
+    """
+    durations = []
+    random_state = np.random.RandomState(0)
+    for batch_size in batch_sizes:
+        input_image = random_state.randint(
+            0, 256, size=(batch_size, input_size, input_size, 3), dtype=np.int32
+        )
+        start = time.perf_counter()
+        model(input=tf.constant(input_image))
+        durations.append(time.perf_counter() - start)
+    for height, width in frame_shapes:
+        video = random_state.randint(0, 256, size=(2, height, width, 3), dtype=np.uint8)
+        start = time.perf_counter()
+        get_keypoints_from_video(video, model, input_size, crop_backend=crop_backend)
+        durations.append(time.perf_counter() - start)
+    logging.info(f"Warmed up the model in {len(durations)} inferences")
+    return durations
+
+
 def _movenet(model, input_image):
     """Runs detection on an input image.
 
@@ -47,14 +228,16 @@ def _movenet(model, input_image):
       coordinates and scores. The keypoint-order is shown in KEYPOINT_DICT.
       The 3 results are {y, x, confidence}.
     """
-    # SavedModel format expects tensor type of int32.
-    outputs = model(input=tf.cast(input_image, dtype=tf.int32))
+    # SavedModel format expects tensor type of int32, a numpy input already is
+    if not isinstance(input_image, np.ndarray):
+        input_image = tf.cast(input_image, dtype=tf.int32)
+    outputs = model(input=input_image)
     # output_0 is a [1,1,17, 3] array
     keypoint_with_scores = outputs["output_0"].numpy()
     return keypoint_with_scores.squeeze()
 
 
-def _run_inference(model, image, crop_region, crop_size):
+def _run_inference(model, image, crop_region, crop_size, input_buffer=None):
     """Runs model inferece on the cropped region. The function runs the model inference on the cropped region and updates the
     model output to the original image coordinate system.
 
@@ -63,13 +246,20 @@ def _run_inference(model, image, crop_region, crop_size):
       image: the image to run inference on
       crop_region: the region of the image to crop the image to
       crop_size: the size
+      input_buffer: optional [1, height, width, 3] int32 array, the image is then
+        cropped with numpy into the buffer instead of with tensorflow ops
     Returns:
       (17,3) array of the keypoints
     """
     image_height, image_width, _ = image.shape
-    input_image = crop_and_resize(
-        tf.expand_dims(image, axis=0), crop_region, crop_size=crop_size
-    )
+    if input_buffer is None:
+        input_image = crop_and_resize(
+            tf.expand_dims(image, axis=0), crop_region, crop_size=crop_size
+        )
+    else:
+        input_image = crop_and_resize_numpy(
+            image, crop_region, crop_size, out=input_buffer
+        )
     # Run model inference.
     keypoints_with_scores = _movenet(model, input_image)
     # Update the coordinates.
@@ -85,32 +275,168 @@ def _run_inference(model, image, crop_region, crop_size):
     return keypoints_with_scores
 
 
+class KeypointTracker:
+    """Runs the model on consecutive frames of a video, cropping every frame around
+    the cyclist found in the previous frame."""
+
+    def __init__(
+        self,
+        model,
+        input_size,
+        image_height,
+        image_width,
+        smoother=None,
+        frame_gate=None,
+        duplicate_detector=None,
+        crop_backend="tf",
+    ):
+        """
+        Args:
+          model: model object to use for inference
+          input_size: input size of the model (used for cropping and resizing)
+          image_height: height of the frames in pixels
+          image_width: width of the frames in pixels
+          smoother: optional KeypointSmoother, the crop region of the next frame is
+            then determined from the smoothed keypoints
+          frame_gate: optional FrameGate, the keypoints of the previous frame are
+            reused for the frames it skips
+          duplicate_detector: optional DuplicateFrameDetector, the keypoints of the
+            previous frame are reused for frames identical to it
+          crop_backend: one of CROP_BACKENDS, how the frames are cropped and resized
+        """
+        if crop_backend not in CROP_BACKENDS:
+            raise ValueError(f"Unsupported crop backend: {crop_backend}")
+        # models with state that depends on the frames run before (FakePoseModel)
+        # start over for every video
+        start_video = getattr(model, "start_video", None)
+        self.model = start_video() if start_video is not None else model
+        self.input_size = input_size
+        self.image_height = image_height
+        self.image_width = image_width
+        self.smoother = smoother
+        self.frame_gate = frame_gate
+        self.duplicate_detector = duplicate_detector
+        self.input_buffer = (
+            np.empty((1, input_size, input_size, 3), dtype=np.int32)
+            if crop_backend == "numpy"
+            else None
+        )
+        self.default_crop_region = init_crop_region(image_height, image_width)
+        self.crop_region = self.default_crop_region
+        # number of frames that were cropped with the full image crop region
+        self.fallbacks = 0
+        self.keypoints_with_scores = None
+        # keypoints the crop region of the next frame was determined from
+        self.keypoints = None
+
+    def update(self, frame, dt=None):
+        """Runs inference on the next frame.
+
+        Args:
+          frame: [H, W, C] frame
+          dt: optional seconds since the previous frame for the smoother, when the
+            frames are not equally spaced
+        Returns:
+          the raw (17, 3) keypoints of the frame, those of the previous frame if
+          it is a duplicate of the previous frame or the frame gate skipped it
+        """
+        if self.duplicate_detector is not None and self.duplicate_detector.update(
+            frame
+        ):
+            keypoints_with_scores = self.keypoints_with_scores
+            if self.frame_gate is not None:
+                self.frame_gate.advance()
+        elif self.frame_gate is not None and self.frame_gate.update(
+            frame, self.keypoints
+        ):
+            keypoints_with_scores = self.keypoints_with_scores
+        else:
+            keypoints_with_scores = _run_inference(
+                self.model,
+                frame,
+                self.crop_region,
+                crop_size=[self.input_size, self.input_size],
+                input_buffer=self.input_buffer,
+            )
+        self.keypoints_with_scores = keypoints_with_scores
+        keypoints = keypoints_with_scores
+        if self.smoother is not None:
+            keypoints = self.smoother.update(keypoints, dt=dt)
+        self.crop_region = determine_crop_region(
+            keypoints, self.image_height, self.image_width
+        )
+        self.fallbacks += self.crop_region == self.default_crop_region
+        self.keypoints = keypoints
+        return keypoints_with_scores
+
+
 @timeit
-def get_keypoints_from_video(video_tensor, model, input_size):
+def get_keypoints_from_video(
+    video_tensor,
+    model,
+    input_size,
+    return_crop_regions=False,
+    smoother=None,
+    on_frame=None,
+    frame_gate=None,
+    duplicate_detector=None,
+    crop_backend="tf",
+):
     """Runs model inference on each frame of a video, returning a list of keypoints.
 
     Args:
-      video_tensor: input tensor for the model of shape [B, H, W, C]
+      video_tensor: input tensor for the model of shape [B, H, W, C], or any iterable
+        of [H, W, C] frames (e.g. frames that are decoded while inference runs)
       model: model object to use for frame-by-frame inference
       input_size: input size of the model (used for cropping and resizing)
+      return_crop_regions: also return the crop region used for every frame
+      smoother: optional KeypointSmoother, the crop region of the next frame is then
+        determined from the smoothed keypoints (the returned keypoints stay raw)
+      on_frame: optional function called as on_frame(frame_idx, keypoints) as soon
+        as the keypoints of a frame are known, e.g. to start postprocessing early.
+        Inference stops after the frame when it returns True
+      frame_gate: optional FrameGate, the frames it skips get the keypoints of the
+        previous frame and are listed in frame_gate.skipped_frames
+      duplicate_detector: optional DuplicateFrameDetector, frames identical to the
+        previous frame get its keypoints and are listed in
+        duplicate_detector.duplicate_frames
+      crop_backend: one of CROP_BACKENDS, how the frames are cropped and resized
     Returns:
       a [B, 17, 3] list of keypoint arrays, one array per frame in the video
+      a list of B crop region dicts if return_crop_regions is True
     """
-    num_frames, video_height, video_width, _ = video_tensor.shape
     all_keypoints_with_scores = []
-    crop_region = init_crop_region(video_height, video_width)
-    for frame_idx in range(num_frames):
-        all_keypoints_with_scores.append(
-            _run_inference(
+    crop_regions = []
+    tracker = None
+    for frame_idx, frame in enumerate(video_tensor):
+        if tracker is None:
+            video_height, video_width, _ = frame.shape
+            tracker = KeypointTracker(
                 model,
-                video_tensor[frame_idx, :, :, :],
-                crop_region,
-                crop_size=[input_size, input_size],
+                input_size,
+                video_height,
+                video_width,
+                smoother=smoother,
+                frame_gate=frame_gate,
+                duplicate_detector=duplicate_detector,
+                crop_backend=crop_backend,
             )
-        )
-        crop_region = determine_crop_region(
-            all_keypoints_with_scores[frame_idx], video_height, video_width
-        )
+        crop_regions.append(tracker.crop_region)
+        keypoints = tracker.update(frame)
+        all_keypoints_with_scores.append(keypoints)
+        if on_frame is not None and on_frame(frame_idx, keypoints):
+            break
 
+    skipped = frame_gate.num_skipped if frame_gate is not None else 0
+    duplicates = (
+        duplicate_detector.num_duplicates if duplicate_detector is not None else 0
+    )
+    increment("frames_inferred", len(all_keypoints_with_scores) - skipped - duplicates)
+    increment("frames_skipped", skipped)
+    increment("frames_duplicate", duplicates)
+    if tracker is not None:
+        increment("crop_region_fallbacks", tracker.fallbacks)
     logging.info("Calculated all keypoints")
+    if return_crop_regions:
+        return all_keypoints_with_scores, crop_regions
     return all_keypoints_with_scores
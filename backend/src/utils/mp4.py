@@ -0,0 +1,423 @@
+"""""" """""" """""" """""
+MP4 FUNCTIONS
+""" """""" """""" """""" ""
+import os
+import math
+import struct
+import hashlib
+import logging
+import numpy as np
+from utils.metrics import increment
+
+# bytes read to find the top level boxes, usually enough for a moov at the start
+HEAD_SIZE = 64 * 1024
+# ranges of samples closer together than this are fetched with a single request
+MAX_RANGE_GAP = 256 * 1024
+
+
+def iter_boxes(data, start=0, end=None):
+    """Iterates over the ISO base media (mp4/mov) boxes in data[start:end].
+
+    Args:
+        data: bytes of the file, or of a box
+        start: offset of the first box
+        end: offset where the boxes end, the end of data by default
+    Yields:
+        (type, offset of the box, offset of its payload, offset of its end), the end
+        can lie beyond data for a box that was only partially read
+    """
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, offset)
+        payload = offset + 8
+        if size == 1:
+            if offset + 16 > end:
+                return
+            (size,) = struct.unpack_from(">Q", data, payload)
+            payload += 8
+        elif size == 0:
+            # the box runs until the end of the file
+            size = math.inf
+        if size < payload - offset:
+            raise ValueError(f"Invalid size of box {box_type} at offset {offset}")
+        yield box_type, offset, payload, offset + size
+        offset += size
+
+
+def find_top_level_box(head):
+    """Finds which of the moov (index) and mdat (samples) boxes comes first.
+
+    Args:
+        head: the first bytes of the file
+    Returns:
+        (type, offset, end) of the first moov or mdat box, None when head is too
+        short to tell
+    Raises:
+        ValueError: when the file does not start with an ftyp box (not an mp4/mov)
+    """
+    if len(head) >= 8 and head[4:8] != b"ftyp":
+        raise ValueError("Not an ISO base media file")
+    for box_type, offset, _, end in iter_boxes(head):
+        if box_type in (b"moov", b"mdat"):
+            return box_type, offset, end
+    return None
+
+
+def _find_child(data, start, end, box_type):
+    for child_type, _, payload, child_end in iter_boxes(data, start, end):
+        if child_type == box_type:
+            return payload, child_end
+    return None
+
+
+def _full_box_version(data, payload):
+    return data[payload], payload + 4
+
+
+def _parse_mvhd(data, payload):
+    version, offset = _full_box_version(data, payload)
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, offset + 16)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, offset + 8)
+    return duration / timescale
+
+
+def _parse_tkhd(data, payload):
+    version, offset = _full_box_version(data, payload)
+    # creation/modification time, track id, reserved, duration
+    offset += 32 if version == 1 else 20
+    # reserved, layer, alternate group, volume, reserved
+    offset += 16
+    # the rotation of the video is in the first column of the transformation matrix
+    a, b = struct.unpack_from(">2i", data, offset)
+    width, height = struct.unpack_from(">II", data, offset + 36)
+    rotation = round(math.degrees(math.atan2(b, a))) % 360
+    return width >> 16, height >> 16, rotation
+
+
+def _parse_mdhd(data, payload):
+    version, offset = _full_box_version(data, payload)
+    if version == 1:
+        timescale, duration = struct.unpack_from(">IQ", data, offset + 16)
+    else:
+        timescale, duration = struct.unpack_from(">II", data, offset + 8)
+    return timescale, duration
+
+
+def _parse_table(data, payload, columns, dtype=">u4"):
+    """Returns the entries of a full box with an entry count followed by a table"""
+    _, offset = _full_box_version(data, payload)
+    (entries,) = struct.unpack_from(">I", data, offset)
+    return np.frombuffer(
+        data, dtype=dtype, count=entries * columns, offset=offset + 4
+    ).reshape(entries, columns)
+
+
+def _parse_stts(data, payload):
+    """Returns the (sample count, sample duration) runs of the decoding times"""
+    return [
+        tuple(int(value) for value in run) for run in _parse_table(data, payload, 2)
+    ]
+
+
+def _parse_stsz(data, payload):
+    """Returns the size in bytes of every sample"""
+    _, offset = _full_box_version(data, payload)
+    sample_size, sample_count = struct.unpack_from(">II", data, offset)
+    if sample_size != 0:
+        return np.full(sample_count, sample_size, dtype=np.int64)
+    return np.frombuffer(
+        data, dtype=">u4", count=sample_count, offset=offset + 8
+    ).astype(np.int64)
+
+
+def _sample_offsets(sample_sizes, sample_to_chunk, chunk_offsets):
+    """Calculates the offset in the file of every sample from the chunk offsets and
+    the number of samples in every chunk, samples of a chunk follow each other"""
+    num_chunks = len(chunk_offsets)
+    # the runs of sample_to_chunk hold for the chunks up to the next run
+    first_chunks = sample_to_chunk[:, 0].astype(np.int64) - 1
+    run_lengths = np.diff(np.append(first_chunks, num_chunks))
+    samples_per_chunk = np.repeat(sample_to_chunk[:, 1].astype(np.int64), run_lengths)
+    chunk_of_sample = np.repeat(np.arange(num_chunks), samples_per_chunk)
+    chunk_of_sample = chunk_of_sample[: len(sample_sizes)]
+    first_sample_of_chunk = np.cumsum(samples_per_chunk) - samples_per_chunk
+    # bytes before every sample, minus those before the first sample of its chunk
+    before = np.cumsum(sample_sizes) - sample_sizes
+    before -= before[first_sample_of_chunk[chunk_of_sample]]
+    return chunk_offsets.astype(np.int64)[chunk_of_sample] + before
+
+
+def parse_moov(moov, start=0, end=None):
+    """Reads the duration and the first video track from a moov box.
+
+    Args:
+        moov: bytes that contain the moov box
+        start: offset of the moov box in moov
+        end: offset of the end of the moov box in moov
+    Returns:
+        dict with the 'duration' of the file in seconds and the 'width', 'height'
+        (as displayed, so after rotation), 'rotation', 'timescale',
+        'num_frames', 'fps' and 'time_to_sample' table of the video track, and the
+        file 'sample_offsets', 'sample_sizes', decoding 'sample_times' in seconds
+        and 'sync_samples' (the indices of the keyframes) of its frames
+    Raises:
+        ValueError: when there is no video track
+    """
+    end = len(moov) if end is None else end
+    for box_type, _, payload, box_end in iter_boxes(moov, start, end):
+        if box_type == b"moov":
+            start, end = payload, box_end
+            break
+    mvhd, _ = _find_child(moov, start, end, b"mvhd")
+    duration = _parse_mvhd(moov, mvhd)
+    for box_type, _, trak, trak_end in iter_boxes(moov, start, end):
+        if box_type != b"trak":
+            continue
+        mdia, mdia_end = _find_child(moov, trak, trak_end, b"mdia")
+        hdlr, _ = _find_child(moov, mdia, mdia_end, b"hdlr")
+        if moov[hdlr + 8 : hdlr + 12] != b"vide":
+            continue
+        width, height, rotation = _parse_tkhd(
+            moov, _find_child(moov, trak, trak_end, b"tkhd")[0]
+        )
+        if rotation in (90, 270):
+            width, height = height, width
+        timescale, media_duration = _parse_mdhd(
+            moov, _find_child(moov, mdia, mdia_end, b"mdhd")[0]
+        )
+        minf, minf_end = _find_child(moov, mdia, mdia_end, b"minf")
+        stbl, stbl_end = _find_child(moov, minf, minf_end, b"stbl")
+        time_to_sample = _parse_stts(
+            moov, _find_child(moov, stbl, stbl_end, b"stts")[0]
+        )
+        num_frames = sum(count for count, _ in time_to_sample)
+        counts, deltas = np.array(time_to_sample, dtype=np.int64).reshape(-1, 2).T
+        durations = np.repeat(deltas, counts)
+        sample_sizes = _parse_stsz(moov, _find_child(moov, stbl, stbl_end, b"stsz")[0])
+        stco = _find_child(moov, stbl, stbl_end, b"stco")
+        chunk_offsets = (
+            _parse_table(moov, stco[0], 1)[:, 0]
+            if stco is not None
+            else _parse_table(
+                moov, _find_child(moov, stbl, stbl_end, b"co64")[0], 1, ">u8"
+            )[:, 0]
+        )
+        sample_to_chunk = _parse_table(
+            moov, _find_child(moov, stbl, stbl_end, b"stsc")[0], 3
+        )
+        # without a stss box every sample is a keyframe
+        stss = _find_child(moov, stbl, stbl_end, b"stss")
+        sync_samples = (
+            _parse_table(moov, stss[0], 1)[:, 0].astype(np.int64) - 1
+            if stss is not None
+            else np.arange(num_frames)
+        )
+        return {
+            "duration": duration,
+            "width": width,
+            "height": height,
+            "rotation": rotation,
+            "timescale": timescale,
+            "num_frames": num_frames,
+            "fps": num_frames * timescale / media_duration,
+            "time_to_sample": time_to_sample,
+            "sample_offsets": _sample_offsets(
+                sample_sizes, sample_to_chunk, chunk_offsets
+            ),
+            "sample_sizes": sample_sizes,
+            "sample_times": (np.cumsum(durations) - durations) / timescale,
+            "sync_samples": sync_samples,
+        }
+    raise ValueError("No video track in the moov box")
+
+
+def window_byte_ranges(info, windows, max_gap=MAX_RANGE_GAP):
+    """Calculates which bytes of the samples are needed to decode the frames of the
+    windows. For every window that is from the keyframe at or before its start up
+    to and including the first keyframe after its end, as frames can refer to the
+    frames after them.
+
+    Args:
+        info: the video track, see parse_moov
+        windows: list of (start, end) times in seconds
+        max_gap: ranges closer together than this number of bytes are merged
+    Returns:
+        sorted list of (offset, end offset) byte ranges
+    """
+    times, syncs = info["sample_times"], info["sync_samples"]
+    samples = np.zeros(len(times), dtype=bool)
+    for start, end in windows:
+        first = syncs[max(np.searchsorted(times[syncs], start, side="right") - 1, 0)]
+        after = np.searchsorted(times[syncs], end, side="right")
+        last = syncs[after] if after < len(syncs) else len(times) - 1
+        samples[first : last + 1] = True
+    offsets = info["sample_offsets"][samples]
+    ends = offsets + info["sample_sizes"][samples]
+    order = np.argsort(offsets)
+    ranges = []
+    for offset, range_end in zip(offsets[order], ends[order]):
+        if ranges and offset - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = max(ranges[-1][1], range_end)
+        else:
+            ranges.append([offset, range_end])
+    return [(int(offset), int(range_end)) for offset, range_end in ranges]
+
+
+def analysis_byte_ranges(moov, max_duration):
+    """Calculates which bytes of the samples are needed to decode the middle
+    max_duration seconds of a video with reduce_video_quality.
+
+    Args:
+        moov: bytes of the moov box
+        max_duration: maximum duration in seconds, the middle is kept
+    Returns:
+        sorted list of (offset, end offset) byte ranges, see window_byte_ranges
+    """
+    info = parse_moov(moov)
+    mid_point = info["duration"] / 2
+    start = max(mid_point - max_duration / 2, 0)
+    end = min(mid_point + max_duration / 2, info["duration"])
+    # VideoFileClip decodes the first frame when it is opened. It reads on from
+    # there to a frame up to 100 frames further, and otherwise seeks to a second
+    # before the frame
+    if int(info["fps"] * start + 0.00001) > 100:
+        windows = [(0, 0), (start - 1, end)]
+    else:
+        windows = [(0, end)]
+    return window_byte_ranges(info, windows)
+
+
+class WindowHash:
+    """sha256 of the bytes the analysis window of a video is decoded from: the moov
+    box and the bytes of analysis_byte_ranges. The complete video, the sparse file
+    of fetch_video_window and a video that is streamed all give the same hash, and
+    the results of a video only depend on these bytes.
+    """
+
+    def __init__(self, moov, max_duration):
+        """
+        Args:
+            moov: bytes of the moov box
+            max_duration: maximum duration in seconds, the middle is kept
+        """
+        self._sha = hashlib.sha256(moov)
+        self._ranges = analysis_byte_ranges(moov, max_duration)
+
+    def update(self, data, offset):
+        """Hashes the part of data that lies in the byte ranges, must be called in
+        the order of the offsets of the data.
+
+        Args:
+            data: bytes of the video
+            offset: offset of data in the video
+        """
+        end = offset + len(data)
+        for range_start, range_end in self._ranges:
+            start, stop = max(range_start, offset), min(range_end, end)
+            if start < stop:
+                self._sha.update(data[start - offset : stop - offset])
+
+    @property
+    def ranges(self):
+        return list(self._ranges)
+
+    def hexdigest(self):
+        return self._sha.hexdigest()
+
+
+def hash_video_window(file_path, max_duration):
+    """Computes the WindowHash of an mp4/mov file on disk.
+
+    Args:
+        file_path: path of the video, can be a sparse file of fetch_video_window
+        max_duration: maximum duration in seconds, the middle is kept
+    Returns:
+        the hexadecimal digest
+    Raises:
+        ValueError: when the video is not an mp4/mov file
+    """
+    with open(file_path, "rb") as file:
+
+        def read(offset, length):
+            file.seek(offset)
+            return file.read(length)
+
+        size = os.fstat(file.fileno()).st_size
+        _, moov, _ = _find_moov(read, size)
+        window_hash = WindowHash(moov, max_duration)
+        for offset, range_end in window_hash.ranges:
+            window_hash.update(read(offset, range_end - offset), offset)
+    return window_hash.hexdigest()
+
+
+def _find_moov(read_range, size):
+    """Walks over the top level boxes with ranged reads until the moov box is found.
+
+    Returns:
+        the offset and the bytes of the moov box, and the list of (offset, end) of
+        the other boxes (ftyp, free, ...) and of the headers of the mdat boxes
+    """
+    head = read_range(0, min(size, HEAD_SIZE))
+    find_top_level_box(head)
+    header_ranges = []
+    offset = 0
+    while offset < size:
+        if offset + 16 <= len(head):
+            header = head[offset : offset + 16]
+        else:
+            header = read_range(offset, min(16, size - offset))
+        box_type, _, payload, box_size = next(iter_boxes(header, end=len(header)))
+        end = min(offset + box_size, size)
+        if box_type == b"moov":
+            if end <= len(head):
+                return offset, head[offset:end], header_ranges
+            return offset, read_range(offset, end - offset), header_ranges
+        # only the header of a mdat box, the samples are read per window
+        header_ranges.append((offset, offset + payload if box_type == b"mdat" else end))
+        offset = end
+    raise ValueError("No moov box in the file")
+
+
+def fetch_video_window(read_range, size, file_path, max_duration):
+    """Fetches only the bytes of an mp4/mov that are needed to decode its middle
+    max_duration seconds (see reduce_video_quality), with a few ranged reads.
+
+    The boxes before the samples and the moov box are read first, the byte ranges
+    of the frames in the window follow from the sample tables in the moov box. The
+    bytes are written at their offsets in a sparse file of the size of the video,
+    which can be opened like the complete video as long as only the window is read.
+
+    Args:
+        read_range: function that returns the bytes of the video from an offset,
+            called as read_range(offset, length)
+        size: size of the video in bytes
+        file_path: where the sparse video is written
+        max_duration: maximum duration in seconds, the middle is kept
+    Returns:
+        the number of bytes that were read
+    Raises:
+        ValueError: when the video is not an mp4/mov file
+    """
+    fetched = 0
+
+    def read(offset, length):
+        nonlocal fetched
+        data = read_range(offset, length)
+        fetched += len(data)
+        return data
+
+    moov_offset, moov, header_ranges = _find_moov(read, size)
+    ranges = analysis_byte_ranges(moov, max_duration)
+    with open(file_path, "wb") as file:
+        file.truncate(size)
+        file.seek(moov_offset)
+        file.write(moov)
+        for offset, range_end in header_ranges + ranges:
+            file.seek(offset)
+            file.write(read(offset, range_end - offset))
+    increment("bytes_downloaded", fetched)
+    logging.info(f"Fetched {fetched} of {size} bytes of {file_path}")
+    return fetched
@@ -0,0 +1,144 @@
+"""""" """""" """""" """""
+PIPELINE FUNCTIONS
+""" """""" """""" """""" ""
+import time
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils.metrics import current_metrics
+from utils.profiling import profile_thread
+
+
+class _Stage:
+    def __init__(self, name, function, after, group):
+        self.name = name
+        self.function = function
+        self.after = after
+        self.group = group
+        self.start = None
+        self.end = None
+        # stage that finished last before this stage could start
+        self.blocked_by = None
+
+
+class StageGraph:
+    """Runs the stages of a request as a DAG on a thread pool, every stage starts as
+    soon as the stages it depends on have finished.
+
+    A stage is called with the return values of the stages it runs after, in the
+    order they were given. Stages of the same group never run at the same time (e.g.
+    everything that draws with matplotlib, which is not thread safe), ready stages
+    are started in the order they were added. The stages run in a copy of the
+    context of run(), so their timings end up in the metrics of the request and
+    they are profiled with it.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.stages = {}
+
+    def add(self, name, function, after=(), group=None):
+        """Adds a stage.
+
+        Args:
+            name: unique name of the stage
+            function: called with the return values of the stages in after
+            after: names of the stages that have to finish before this one starts
+            group: optional name of a group of stages that run one at a time
+        Returns:
+            the name of the stage
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage {name} was already added")
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} runs after unknown stage {dependency}")
+        self.stages[name] = _Stage(name, function, list(after), group)
+        return name
+
+    def _run_stage(self, stage, args):
+        stage.start = time.perf_counter()
+        try:
+            with profile_thread():
+                return stage.function(*args)
+        finally:
+            stage.end = time.perf_counter()
+
+    def run(self):
+        """Runs all stages. When a stage raises, no new stages are started and the
+        exception is raised once the running stages have finished.
+
+        Returns:
+            dict with the return value of every stage
+        """
+        self.start = time.perf_counter()
+        results = {}
+        pending = list(self.stages.values())
+        running = {}
+        # the stage that last finished in every group, None while a stage runs
+        groups = {}
+        error = None
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="stage"
+        ) as executor:
+            while pending or running:
+                for stage in list(pending) if error is None else []:
+                    if any(dependency not in results for dependency in stage.after):
+                        continue
+                    if stage.group is not None and stage.group in groups:
+                        if groups[stage.group] is None:
+                            continue
+                        previous = [groups[stage.group]]
+                    else:
+                        previous = []
+                    stage.blocked_by = max(
+                        [self.stages[name] for name in stage.after] + previous,
+                        key=lambda blocking: blocking.end,
+                        default=None,
+                    )
+                    if stage.group is not None:
+                        groups[stage.group] = None
+                    pending.remove(stage)
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        self._run_stage,
+                        stage,
+                        [results[dependency] for dependency in stage.after],
+                    )
+                    running[future] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if stage.group is not None:
+                        groups[stage.group] = stage
+                    if future.exception() is not None:
+                        logging.error(f"Stage {stage.name} failed")
+                        error = error or future.exception()
+                    else:
+                        results[stage.name] = future.result()
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.critical_path = self.critical_path()
+        if error is not None:
+            raise error
+        return results
+
+    def critical_path(self):
+        """Returns the chain of stages that determined the duration of the last run,
+        from the first to the last stage, as dicts with the name, start (relative to
+        the start of the run) and wall time of the stage."""
+        finished = [stage for stage in self.stages.values() if stage.end is not None]
+        stage = max(finished, key=lambda stage: stage.end, default=None)
+        path = []
+        while stage is not None:
+            path.append(
+                {
+                    "name": stage.name,
+                    "start_s": stage.start - self.start,
+                    "wall_time_s": stage.end - stage.start,
+                }
+            )
+            stage = stage.blocked_by
+        return path[::-1]
@@ -3,7 +3,6 @@
 """ """""" """""" """""" """"""
 import math
 import numpy as np
-from scipy.signal import find_peaks
 from utils.keypoints import KEYPOINT_DICT
 
 
@@ -29,14 +28,210 @@ def get_front_leg_keypoint_indices(facing_dir):
     return hip_index, knee_index, ankle_index
 
 
-def get_lowest_pedal_frames(all_keypoints, hipkneeankleindices):
+def get_lowest_pedal_frames(all_keypoints, hipkneeankleindices, invalid_frames=()):
+    """invalid_frames optionally are the indices of the frames without a pose of the
+    cyclist, they are never a lowest pedal point (see LowestPedalPointDetector)"""
+    # scipy.signal takes close to a second to import
+    from scipy.signal import find_peaks
+
     ankle_index = hipkneeankleindices[2]
     ankle_y_values = []
     for frame_idx in range(len(all_keypoints)):
         ankle_y_values.append(all_keypoints[frame_idx][ankle_index][0])
     # the distance variable lets you to easily pick only the highest peak values and ignore local jitters in a pedal rotation
     peak_indices = find_peaks(ankle_y_values, distance=10)[0]
-    return peak_indices
+    return peak_indices[~np.isin(peak_indices, list(invalid_frames))]
+
+
+class StreamingPeakDetector:
+    """Incremental version of scipy.signal.find_peaks(values, distance=distance).
+
+    A local maximum is a sample that is higher than its left neighbour and at least
+    as high as its right one, a flat peak is reported at its (rounded down) midpoint.
+    Going from the highest to the lowest peak, every peak closer than distance
+    samples to a kept peak is removed. A peak is confirmed (kept or removed) as soon
+    as that no longer depends on peaks that can still come: when it is at least
+    distance samples before the earliest possible next peak and all higher peaks
+    around it are confirmed, or when a higher kept peak is close to it.
+    """
+
+    def __init__(self, distance=10):
+        self.distance = distance
+        self.num_values = 0
+        self._previous = None
+        # start of the flat top after the last rising edge, None when falling
+        self._rise_start = None
+        # (index, value) of the local maxima that are not confirmed yet
+        self._pending = []
+        self._earliest_peak = 0
+
+    @property
+    def first_unconfirmed(self):
+        """The lowest index that can still be returned as a peak"""
+        if self._pending:
+            return min(self._pending[0][0], self._earliest_peak)
+        return self._earliest_peak
+
+    def update(self, value):
+        """Adds the next value.
+
+        Args:
+            value: next value of the series
+        Returns:
+            sorted list of the indices of the peaks that got confirmed
+        """
+        index = self.num_values
+        self.num_values += 1
+        if self._previous is not None:
+            if value > self._previous:
+                self._rise_start = index
+            elif value < self._previous and self._rise_start is not None:
+                self._pending.append(
+                    ((self._rise_start + index - 1) // 2, self._previous)
+                )
+                self._rise_start = None
+        self._previous = value
+        # the earliest index where a peak can still be found
+        self._earliest_peak = (
+            self.num_values
+            if self._rise_start is None
+            else (self._rise_start + index) // 2
+        )
+        if self._pending and self._earliest_peak - self._pending[0][0] >= self.distance:
+            return self._confirm(self._earliest_peak)
+        return []
+
+    def flush(self):
+        """Ends the series, returns the indices of the remaining peaks."""
+        self._rise_start = None
+        self._earliest_peak = self.num_values
+        return self._confirm(None)
+
+    def _confirm(self, earliest_peak):
+        # the highest peak first like scipy, equally high peaks are taken from the
+        # right (scipy leaves their order to an unstable sort)
+        order = sorted(
+            range(len(self._pending)),
+            key=lambda i: (self._pending[i][1], self._pending[i][0]),
+            reverse=True,
+        )
+        # True when kept, False when removed, None when not confirmed yet
+        kept = {}
+        for i in order:
+            peak = self._pending[i][0]
+            higher = [
+                kept[j] for j in kept if abs(self._pending[j][0] - peak) < self.distance
+            ]
+            if True in higher:
+                kept[i] = False
+            elif None in higher or (
+                earliest_peak is not None and earliest_peak - peak < self.distance
+            ):
+                kept[i] = None
+            else:
+                kept[i] = True
+        peaks = [peak for i, (peak, _) in enumerate(self._pending) if kept[i]]
+        self._pending = [
+            pending for i, pending in enumerate(self._pending) if kept[i] is None
+        ]
+        return peaks
+
+
+class LowestPedalPointDetector:
+    """Finds the lowest pedal points and their knee angles while the keypoints of a
+    video come in, giving the same frames as get_lowest_pedal_frames. Only the
+    keypoints of frames that can still become a lowest pedal point are kept, so
+    it can run on an endless stream. Frames without a pose of the cyclist (e.g.
+    the frames the FrameGate skips) never become a lowest pedal point."""
+
+    def __init__(self, distance=10):
+        self.peaks = StreamingPeakDetector(distance=distance)
+        self.facing_direction = None
+        self.hipkneeankleindices = None
+        self.lowest_pedal_point_indices = []
+        self._keypoints = {}
+
+    def update(self, keypoints, valid=True):
+        """Adds the keypoints of the next frame.
+
+        Args:
+            keypoints: a [17, 3] keypoint numpy array
+            valid: False when the keypoints are not a pose of the cyclist
+        Returns:
+            list of (frame index, hipkneeankle coordinates, (start angle, knee angle))
+            of the confirmed lowest pedal points
+        """
+        if self.facing_direction is None:
+            self.facing_direction = find_camera_facing_side(keypoints)
+            self.hipkneeankleindices = get_front_leg_keypoint_indices(
+                self.facing_direction
+            )
+        self._keypoints[self.peaks.num_values] = keypoints if valid else None
+        return self._confirmed(
+            self.peaks.update(keypoints[self.hipkneeankleindices[2]][0])
+        )
+
+    def flush(self):
+        return self._confirmed(self.peaks.flush())
+
+    def _confirmed(self, frame_indices):
+        frame_indices = [i for i in frame_indices if self._keypoints[i] is not None]
+        self.lowest_pedal_point_indices = sorted(
+            self.lowest_pedal_point_indices + frame_indices
+        )
+        confirmed = []
+        for i in frame_indices:
+            coordinates = get_hipkneeankle_coords(
+                self._keypoints[i], self.hipkneeankleindices
+            )
+            confirmed.append((i, coordinates, calc_knee_angle(coordinates)))
+        first_unconfirmed = self.peaks.first_unconfirmed
+        for i in [i for i in self._keypoints if i < first_unconfirmed]:
+            del self._keypoints[i]
+        return confirmed
+
+
+class AngleConvergence:
+    """Follows the 95% confidence interval of the mean knee angle at the lowest pedal
+    points (after filter_bad_angles) while strokes come in, to stop analyzing a
+    video as soon as the estimate is precise enough."""
+
+    def __init__(self, threshold=1.0, min_strokes=6, min_angle=130, max_angle=170):
+        """
+        Args:
+            threshold: half width in degrees the confidence interval has to be below
+            min_strokes: minimum number of kept angles before it can converge
+            min_angle: angles below this value are never plausible
+            max_angle: angles above this value are never plausible
+        """
+        self.threshold = threshold
+        self.min_strokes = min_strokes
+        self.min_angle = min_angle
+        self.max_angle = max_angle
+        self.angles = []
+        self.num_angles = 0
+        self.half_width = math.inf
+
+    @property
+    def converged(self):
+        return self.num_angles >= self.min_strokes and self.half_width < self.threshold
+
+    def update(self, angle):
+        """Adds the knee angle of the next lowest pedal point, returns converged"""
+        self.angles.append(angle)
+        if any(self.min_angle < angle < self.max_angle for angle in self.angles):
+            angles, _ = filter_bad_angles(
+                self.angles,
+                range(len(self.angles)),
+                min_angle=self.min_angle,
+                max_angle=self.max_angle,
+            )
+            self.num_angles = len(angles)
+            if self.num_angles > 1:
+                self.half_width = (
+                    1.96 * np.std(angles, ddof=1) / math.sqrt(self.num_angles)
+                )
+        return self.converged
 
 
 def get_hipkneeankle_coords(keypoint, indices):
@@ -101,19 +296,21 @@ def calc_knee_angle(hipkneeankle_coords):
     return start_angle, knee_angle
 
 
-def filter_bad_angles(angles, indices, m=2.0):
+def filter_bad_angles(angles, indices, m=2.0, min_angle=130, max_angle=170):
     """Filters out outliers from the passed list.
     Args:
         angles: list of angles to filter
         indices: original indices in the video to which the angles correspond
         m: the maximum distance
+        min_angle: angles below this value are never plausible
+        max_angle: angles above this value are never plausible
     Returns:
         list of angles that were kept
         list of indices that were kept
     """
     indices = np.array(indices)
     angles = np.array(angles)
-    mask = (130 < angles) & (angles < 170)
+    mask = (min_angle < angles) & (angles < max_angle)
     angles = angles[mask]
     indices = indices[mask]
     # calc dist to median (median is more robust to outliers than mean)
@@ -2,10 +2,37 @@
 PREPROCESSING FUNCTIONS
 """ """""" """""" """""" ""
 import logging
+import itertools
+import threading
+import subprocess
+import contextvars
+import multiprocessing
 import numpy as np
-import tensorflow as tf
-from moviepy.editor import VideoFileClip
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.video.fx.resize import resize, resizer
+from utils.mp4 import find_top_level_box, parse_moov, WindowHash
+from utils.frames import FrameStore
 from utils.utils import timeit
+from utils.metrics import increment
+
+
+def _middle_window(duration, max_duration):
+    """Start and end in seconds of the middle max_duration seconds of a video"""
+    mid_point = duration / 2
+    return (
+        max(mid_point - max_duration / 2, 0),
+        min(mid_point + max_duration / 2, duration),
+    )
+
+
+def _reduced_size(width, height, max_pixels):
+    """(width, height) of the frames after the resize of reduce_video_quality"""
+    max_pixels = min(min(height, width), max_pixels)
+    if height < width:
+        return int(width * max_pixels / height), max_pixels
+    return max_pixels, int(height * max_pixels / width)
 
 
 @timeit
@@ -17,26 +44,541 @@ def reduce_video_quality(video_path, max_pixels, max_fps, max_duration):
     # Reduce resolution
     max_pixels = min(min(clip.h, clip.w), max_pixels)
     clip = (
-        clip.resize(height=max_pixels)
+        clip.fx(resize, height=max_pixels)
         if clip.h < clip.w
-        else clip.resize(width=max_pixels)
+        else clip.fx(resize, width=max_pixels)
     )
     # Reduce duration
-    mid_point = clip.duration / 2
-    lower_point = mid_point - max_duration / 2
-    upper_point = mid_point + max_duration / 2
-    clip = clip.subclip(lower_point, upper_point)
+    clip = clip.subclip(*_middle_window(clip.duration, max_duration))
     print(
         f"Clip with fps: {clip.fps} - width: {clip.w} - height: {clip.h} - duration: {clip.duration}"
     )
     return clip
 
 
+def _decode_at(video_path, source_idx, source_fps, num_frames, w, h):
+    """Decodes num_frames frames from source frame source_idx on, at size (w, h)"""
+    import imageio_ffmpeg
+
+    # seeking to the time of the frame can give the next one, from half a frame
+    # earlier the first frame ffmpeg outputs is the frame
+    seek_time = max((source_idx - 0.5) / source_fps, 0)
+    process = subprocess.run(
+        [
+            imageio_ffmpeg.get_ffmpeg_exe(),
+            "-loglevel",
+            "error",
+            "-ss",
+            f"{seek_time:.6f}",
+            "-i",
+            video_path,
+            "-map",
+            "0:v:0",
+            "-frames:v",
+            str(num_frames),
+            "-vf",
+            f"scale={w}:{h}:flags=lanczos",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "pipe:1",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if process.returncode != 0 or len(process.stdout) < w * h * 3:
+        raise IOError(
+            f"ffmpeg failed to decode frame {source_idx}: {process.stderr.decode()}"
+        )
+    frames = np.frombuffer(process.stdout, dtype=np.uint8)
+    return frames[: len(frames) // (w * h * 3) * w * h * 3].reshape(-1, h, w, 3)
+
+
+@timeit
+def extract_frames(
+    video_path, frames, max_pixels, max_fps, max_duration, search_frames=1
+):
+    """Decodes only some frames of the clip of reduce_video_quality again, at a
+    different resolution, e.g. to render the frames the results are shown on at a
+    higher resolution than the model ran on. Every frame is decoded by seeking to
+    the keyframe before it, so the cost does not depend on the length of the clip.
+
+    The source frame of a frame of the clip follows from its time, but the reader
+    of VideoFileClip can be a frame off after it seeked (and variable frame rate
+    videos drift), so the search_frames frames around it are decoded as well and
+    the one that looks most like the frame of the clip is kept.
+
+    Args:
+        video_path: path of the video
+        frames: dict mapping indices of frames of the clip to the frames
+        max_pixels: maximum size of the shortest side of the extracted frames
+        max_fps: max_fps of the clip
+        max_duration: max_duration of the clip
+        search_frames: number of frames before and after the expected source frame
+            that are considered
+    Returns:
+        dict mapping the frame indices to [H, W, 3] uint8 frames
+    Raises:
+        IOError: when ffmpeg can not decode a frame
+    """
+    from PIL import Image
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+    # the size, fps and duration VideoFileClip uses
+    infos = ffmpeg_parse_infos(video_path)
+    width, height = infos["video_size"]
+    source_fps = infos["video_fps"]
+    fps = min(source_fps, max_fps)
+    lower_point, _ = _middle_window(infos["duration"], max_duration)
+    w, h = _reduced_size(width, height, max_pixels)
+    extracted = {}
+    for frame_idx, frame in frames.items():
+        frame = np.asarray(frame)
+        # VideoFileClip shows source frame int(fps * t) at t
+        source_idx = int(source_fps * (lower_point + frame_idx / fps) + 0.00001)
+        first = max(source_idx - search_frames, 0)
+        candidates = _decode_at(
+            video_path, first, source_fps, source_idx + search_frames + 1 - first, w, h
+        )
+        differences = [
+            np.mean(
+                np.abs(
+                    np.asarray(
+                        Image.fromarray(candidate).resize(
+                            (frame.shape[1], frame.shape[0]), Image.BILINEAR
+                        ),
+                        dtype=np.int16,
+                    )
+                    - frame
+                )
+            )
+            for candidate in candidates
+        ]
+        extracted[frame_idx] = candidates[int(np.argmin(differences))]
+    return extracted
+
+
+def frame_count(clip):
+    """Number of frames iter_frames gives for the clip (or StreamedVideo)"""
+    return len(np.arange(0, clip.duration, 1.0 / clip.fps))
+
+
 @timeit
-def load_tensors_from_clip(videofileclip):
-    # convert to uint8 array of frames
-    video = tf.convert_to_tensor(
-        np.array(list(videofileclip.iter_frames())), dtype=tf.uint8
+def load_frames_from_clip(videofileclip, max_memory_bytes=None):
+    """Decodes the frames of the clip into a FrameStore.
+
+    Args:
+        videofileclip: the clip, see reduce_video_quality
+        max_memory_bytes: size in bytes of the frames above which they are stored in
+            a memory-mapped file, None to always keep them in memory
+    Returns:
+        a read-only [B, H, W, 3] uint8 array of the frames
+    """
+    store = FrameStore(
+        (frame_count(videofileclip), videofileclip.h, videofileclip.w, 3),
+        max_memory_bytes,
     )
-    logging.info("Converted video to tf.Tensor")
-    return video
+    try:
+        for frame in videofileclip.iter_frames():
+            store.append(frame)
+    finally:
+        store.close()
+    increment("frames_decoded", store.num_frames)
+    return store.frames
+
+
+def _iter_source_frames(video_path, source_idx, source_fps, size):
+    """Yields the frames of the video from source frame source_idx on, at the given
+    (width, height), converted the same way the reader of VideoFileClip converts
+    them. Like that reader, the last frame is repeated once the video ended."""
+    import imageio_ffmpeg
+
+    w, h = size
+    frame_bytes = w * h * 3
+    # seeking to the time of the frame can give the next one, from half a frame
+    # earlier the first frame ffmpeg outputs is the frame
+    seek_time = max((source_idx - 0.5) / source_fps, 0)
+    process = subprocess.Popen(
+        [
+            imageio_ffmpeg.get_ffmpeg_exe(),
+            "-loglevel",
+            "error",
+            "-ss",
+            f"{seek_time:.6f}",
+            "-i",
+            video_path,
+            "-map",
+            "0:v:0",
+            "-vf",
+            f"scale={w}:{h}",
+            "-sws_flags",
+            "bicubic",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgb24",
+            "pipe:1",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        frame = None
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) == frame_bytes:
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(h, w, 3)
+            elif frame is None:
+                raise IOError(f"ffmpeg failed to decode frame {source_idx}")
+            yield frame
+    finally:
+        process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def _start_decode_worker():
+    """Does nothing, submitted once per worker so create_decode_pool returns once
+    the workers have started and imported this module"""
+
+
+def create_decode_pool(workers):
+    """Starts the worker processes of decode_video_segments, which can then be
+    reused for every video instead of starting fresh interpreters per video.
+
+    Args:
+        workers: number of worker processes
+    Returns:
+        a ProcessPoolExecutor whose workers are started
+    """
+    # tensorflow is not fork safe, start the workers from a fresh interpreter
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+    for future in [executor.submit(_start_decode_worker) for _ in range(workers)]:
+        future.result()
+    return executor
+
+
+def _seek_offset(clip, video_path, start_time):
+    """Number of frames the reader of the clip of reduce_video_quality is ahead of
+    the source frame at start_time, where the clip starts. The reader only seeks
+    when that frame is more than 100 frames in, but then ffmpeg can give a later
+    frame"""
+    reader = clip.reader
+    source_idx = int(reader.fps * start_time + 0.00001)
+    if source_idx <= 100:
+        return 0
+    first = reader.get_frame(start_time)
+    source_frames = _iter_source_frames(
+        video_path, source_idx, reader.fps, tuple(reader.size)
+    )
+    try:
+        for offset in range(3):
+            if np.array_equal(next(source_frames), first):
+                return offset
+    finally:
+        source_frames.close()
+    return 0
+
+
+def _decode_segment(
+    shm_name, path, shape, video_path, source_fps, source_size, source_indices, start
+):
+    """Decodes the source frames source_indices of the video into the frames from
+    start on of the shared buffer or the memory-mapped file at path, resized like
+    the clip of reduce_video_quality. Runs in a worker process of
+    decode_video_segments"""
+    shm = SharedMemory(name=shm_name) if path is None else None
+    try:
+        if shm is None:
+            frames = np.memmap(path, dtype=np.uint8, mode="r+", shape=shape)
+        else:
+            frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        source_frames = _iter_source_frames(
+            video_path, source_indices[0], source_fps, source_size
+        )
+        try:
+            frame, position = next(source_frames), source_indices[0]
+            for i, source_idx in enumerate(source_indices):
+                for _ in range(source_idx - position):
+                    frame = next(source_frames)
+                position = source_idx
+                frames[start + i] = resizer(frame, (shape[2], shape[1]))
+        finally:
+            source_frames.close()
+        if shm is None:
+            frames.flush()
+        del frames
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+@timeit
+def decode_video_segments(
+    video_path,
+    max_pixels,
+    max_fps,
+    max_duration,
+    executor,
+    workers,
+    max_memory_bytes=None,
+    min_segment_frames=1,
+):
+    """Decodes the frames of reduce_video_quality in parallel, by splitting the clip
+    into segments of consecutive frames that are each decoded by a worker process
+    of executor, which seeks to the start of its segment with ffmpeg.
+
+    The workers write their frames in place into a buffer in shared memory, or
+    straight into the file of the FrameStore when the frames are too large to keep
+    in memory, so the frames are not pickled. Gives exactly the frames of reading
+    the clip from the start with iter_frames. Clips too short to give every worker
+    min_segment_frames frames are split into fewer segments, and decoded in this
+    process with a single reader when that leaves only one.
+
+    Args:
+        video_path: path of the video
+        max_pixels: maximum size of the shortest side of the frames
+        max_fps: maximum frame rate
+        max_duration: maximum duration in seconds, the middle is kept
+        executor: the worker processes, see create_decode_pool, None decodes the
+            clip in this process with a single reader
+        workers: maximum number of segments, the number of workers of executor
+        max_memory_bytes: size in bytes of the frames above which they are stored in
+            a memory-mapped file, None to always keep them in memory
+        min_segment_frames: minimum number of frames of a segment
+    Returns:
+        the clip of reduce_video_quality and a read-only [B, H, W, 3] uint8 array of
+        its frames
+    """
+    clip = reduce_video_quality(video_path, max_pixels, max_fps, max_duration)
+    num_frames = frame_count(clip)
+    segments = min(workers, num_frames // max(min_segment_frames, 1))
+    if executor is None or segments <= 1:
+        return clip, load_frames_from_clip(clip, max_memory_bytes)
+    # the source frames VideoFileClip shows at the times of clip.iter_frames
+    source = clip.reader
+    lower_point, _ = _middle_window(source.duration, max_duration)
+    times = np.arange(0, clip.duration, 1.0 / clip.fps)
+    source_indices = [int(source.fps * (lower_point + t) + 0.00001) for t in times]
+    offset = _seek_offset(clip, video_path, lower_point)
+    source_indices = [source_idx + offset for source_idx in source_indices]
+    shape = (num_frames, clip.h, clip.w, 3)
+    store = FrameStore(shape, max_memory_bytes)
+    shm = None
+    if not store.on_disk:
+        shm = SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+    try:
+        bounds = np.linspace(0, num_frames, segments + 1).astype(int)
+        futures = [
+            executor.submit(
+                _decode_segment,
+                shm.name if shm is not None else None,
+                store.path,
+                shape,
+                video_path,
+                source.fps,
+                tuple(source.size),
+                source_indices[start:stop],
+                start,
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        for future in futures:
+            future.result()
+        if shm is None:
+            # the workers wrote the frames into the file of the store
+            store.num_frames = num_frames
+        else:
+            shared_frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            store.extend(shared_frames)
+            del shared_frames
+    finally:
+        store.close()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+    increment("frames_decoded", num_frames)
+    logging.info(f"Decoded {num_frames} frames in {segments} segments")
+    return clip, store.frames
+
+
+class StreamedVideo:
+    """Decodes the frames reduce_video_quality would give for an mp4 while its bytes
+    are still being downloaded, by piping them into ffmpeg.
+
+    This only works when the moov box (the index of the samples) comes before the
+    samples, see open_video_stream. The same source frames are picked as the
+    VideoFileClip of reduce_video_quality would, only the resampling of the pixels
+    differs slightly. Has the fps, w, h and duration of the reduced clip.
+    """
+
+    def __init__(self, head, chunks, moov, max_pixels, max_fps, max_duration):
+        """
+        Args:
+            head: the first bytes of the video, which contain the moov box
+            chunks: iterable of the remaining bytes of the video
+            moov: bytes of the moov box
+            max_pixels: maximum size of the shortest side of the frames
+            max_fps: maximum frame rate
+            max_duration: maximum duration in seconds, the middle is kept
+        """
+        import imageio_ffmpeg
+
+        info = parse_moov(moov)
+        self.fps = min(info["fps"], max_fps)
+        self.w, self.h = _reduced_size(info["width"], info["height"], max_pixels)
+        lower_point, upper_point = _middle_window(info["duration"], max_duration)
+        self.duration = upper_point - lower_point
+        # source frame of every frame, VideoFileClip shows frame int(fps * t) at t
+        timestamps = lower_point + np.arange(0, self.duration, 1.0 / self.fps)
+        self.frame_indices = np.minimum(
+            (info["fps"] * timestamps + 0.00001).astype(int), info["num_frames"] - 1
+        )
+        first, last = self.frame_indices[0], self.frame_indices[-1]
+        # frames before the window are decoded (a pipe can not seek) but not scaled,
+        # ffmpeg stops reading once the last frame of the window is out
+        self._process = subprocess.Popen(
+            [
+                imageio_ffmpeg.get_ffmpeg_exe(),
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                "-map",
+                "0:v:0",
+                "-vf",
+                f"select='between(n,{first},{last})'"
+                f",scale={self.w}:{self.h}:flags=lanczos",
+                "-vsync",
+                "passthrough",
+                "-frames:v",
+                str(last - first + 1),
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgb24",
+                "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._hash = WindowHash(moov, max_duration)
+        self._error = None
+        # the download runs in the context of the request, so it is counted in its
+        # metrics
+        self._feeder = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(self._feed, head, chunks),
+            name="video-feeder",
+            daemon=True,
+        )
+        self._feeder.start()
+
+    def _feed(self, head, chunks):
+        stdin = self._process.stdin
+        try:
+            offset = 0
+            for chunk in itertools.chain([head], chunks):
+                self._hash.update(chunk, offset)
+                offset += len(chunk)
+                if stdin is None:
+                    continue
+                try:
+                    stdin.write(chunk)
+                except BrokenPipeError:
+                    # ffmpeg has all frames, the rest is only downloaded for the hash
+                    stdin = None
+        except Exception as e:
+            self._error = e
+        finally:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def iter_frames(self):
+        """Yields the [H, W, 3] uint8 frames of the window, can be iterated once"""
+        frame_size = self.w * self.h * 3
+        source_idx = self.frame_indices[0]
+        frame = None
+        i = 0
+        while i < len(self.frame_indices):
+            next_frame = np.empty((self.h, self.w, 3), dtype=np.uint8)
+            if self._process.stdout.readinto(next_frame.data.cast("B")) < frame_size:
+                break
+            frame = next_frame
+            while i < len(self.frame_indices) and self.frame_indices[i] == source_idx:
+                yield frame
+                i += 1
+            source_idx += 1
+        if i < len(self.frame_indices):
+            # ffmpeg stopped early, because the download or the decoding failed or
+            # because the video has less frames than its index says
+            self._process.wait()
+            self.hexdigest()
+            if self._process.returncode != 0 or frame is None:
+                raise IOError(f"ffmpeg failed: {self._process.stderr.read().decode()}")
+        # like VideoFileClip, the last frame is repeated when frames are missing
+        for _ in range(i, len(self.frame_indices)):
+            yield frame
+
+    def hexdigest(self):
+        """Waits for the download to finish, returns the WindowHash of the video"""
+        self._feeder.join()
+        if self._error is not None:
+            raise self._error
+        return self._hash.hexdigest()
+
+    def close(self):
+        """Stops the decoder, the download continues in the background"""
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+
+def open_video_stream(chunks, file_path, max_pixels, max_fps, max_duration):
+    """Starts decoding a video while it is downloaded, when its container allows it.
+
+    Only mp4/mov files with the moov box before the mdat box (e.g. written with
+    ffmpeg -movflags +faststart) can be decoded from a pipe. Other videos, like
+    most phone recordings which have the moov box at the end, are written to
+    file_path so they can be opened with reduce_video_quality.
+
+    Args:
+        chunks: iterable of the bytes of the video, e.g. the chunks of a download
+        file_path: where the video is written when it can not be streamed
+        max_pixels: maximum size of the shortest side of the frames
+        max_fps: maximum frame rate
+        max_duration: maximum duration in seconds, the middle is kept
+    Returns:
+        a StreamedVideo, or None when the video was written to file_path
+    """
+    chunks = iter(chunks)
+    head = bytearray()
+    box = None
+    try:
+        for chunk in chunks:
+            head += chunk
+            box = find_top_level_box(head)
+            if box is not None and (box[0] == b"mdat" or box[2] <= len(head)):
+                break
+        if box is not None and box[0] == b"moov":
+            moov = bytes(head[box[1] : box[2]])
+            logging.info(f"Decoding {file_path} while it is downloaded")
+            return StreamedVideo(
+                bytes(head), chunks, moov, max_pixels, max_fps, max_duration
+            )
+    except ValueError as e:
+        logging.info(f"Can not decode {file_path} from a stream: {e}")
+    with open(file_path, "wb") as file:
+        file.write(head)
+        for chunk in chunks:
+            file.write(chunk)
+    logging.info(f"Downloaded {file_path} to local disk")
+    return None
@@ -0,0 +1,107 @@
+"""""" """""" """""" """""
+PROFILING FUNCTIONS
+""" """""" """""" """""" ""
+import io
+import pstats
+import logging
+import cProfile
+import contextvars
+import tracemalloc
+from contextlib import contextmanager
+
+# number of entries written to the human readable reports
+PROFILE_TOP_ENTRIES = 50
+TRACEMALLOC_FRAMES = 10
+
+# profilers of the threads of the request that is being profiled, see profile_thread
+_thread_profilers = contextvars.ContextVar("thread_profilers", default=None)
+
+
+def _write_cpu_profile(profilers, output_prefix):
+    stats = pstats.Stats(profilers[0])
+    stats.add(*profilers[1:])
+    profile_file_path = f"{output_prefix}_profile.prof"
+    stats.dump_stats(profile_file_path)
+    report_file_path = f"{output_prefix}_profile.txt"
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+    with open(report_file_path, "w") as file:
+        file.write(stream.getvalue())
+    return [profile_file_path, report_file_path]
+
+
+def _write_memory_snapshot(snapshot, peak, output_prefix):
+    report_file_path = f"{output_prefix}_memory.txt"
+    with open(report_file_path, "w") as file:
+        file.write(f"Peak traced memory: {peak / 2 ** 20:.1f} MB\n")
+        file.write(f"Top {PROFILE_TOP_ENTRIES} allocations still alive at the end:\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ENTRIES]:
+            file.write(f"{stat}\n")
+    return [report_file_path]
+
+
+@contextmanager
+def profile_request(output_prefix, enabled=False):
+    """Profiles the code inside the context with cProfile and tracemalloc.
+
+    When disabled the context does nothing. When enabled it writes
+    {output_prefix}_profile.prof (loadable with pstats/snakeviz),
+    {output_prefix}_profile.txt (top functions by cumulative time) and
+    {output_prefix}_memory.txt (peak and largest live allocations).
+    cProfile only sees the thread that entered the context, code that runs on other
+    threads is profiled when it runs inside profile_thread in a copy of the context
+    (like the stages of a StageGraph), their profiles are merged into the report.
+    tracemalloc traces the whole process so concurrent requests show up in the
+    memory report.
+
+    Args:
+        output_prefix: path prefix of the written files
+        enabled: whether to profile
+    Returns:
+        a list which is filled with the written file paths when the context exits
+    """
+    profile_files = []
+    if not enabled:
+        yield profile_files
+        return
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    elif hasattr(tracemalloc, "reset_peak"):
+        # python 3.9+
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profilers = [profiler]
+    token = _thread_profilers.set(profilers)
+    profiler.enable()
+    try:
+        yield profile_files
+    finally:
+        profiler.disable()
+        _thread_profilers.reset(token)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        profile_files.extend(_write_cpu_profile(profilers, output_prefix))
+        profile_files.extend(_write_memory_snapshot(snapshot, peak, output_prefix))
+        logging.info(f"Wrote profile of {output_prefix} to {profile_files}")
+
+
+@contextmanager
+def profile_thread():
+    """Profiles the code inside the context on the current thread when it runs for a
+    request that is being profiled (see profile_request), does nothing otherwise."""
+    profilers = _thread_profilers.get()
+    if profilers is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profilers.append(profiler)
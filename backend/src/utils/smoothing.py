@@ -0,0 +1,69 @@
+"""""" """""" """""" """""
+SMOOTHING FUNCTIONS
+""" """""" """""" """""" ""
+import numpy as np
+
+
+def _smoothing_factor(dt, cutoff):
+    """Weight of a new sample in an exponential low-pass filter with the given cutoff
+    frequency in Hz, for samples dt seconds apart."""
+    r = 2 * np.pi * cutoff * dt
+    return r / (r + 1)
+
+
+class KeypointSmoother:
+    """One-Euro filter over the [17, 3] keypoints of consecutive frames.
+
+    Each coordinate goes through a low-pass filter whose cutoff frequency grows with
+    the speed of the keypoint: slow keypoints are smoothed a lot (removing the jitter
+    of the model), fast keypoints hardly lag behind. The confidence scores are
+    filtered with the fixed min_cutoff, so a single frame with a low score does not
+    make the torso disappear. Every update costs O(1) per keypoint.
+    See Casiez et al., 1€ Filter: A Simple Speed-based Low-pass Filter for Noisy
+    Input in Interactive Systems (CHI 2012).
+    """
+
+    def __init__(self, fps, min_cutoff=1.0, beta=10.0, d_cutoff=1.0):
+        """
+        Args:
+            fps: frame rate of the video, the frames are equally spaced unless
+                update is given the time since the previous frame
+            min_cutoff: cutoff frequency in Hz of a keypoint that does not move
+            beta: increase of the cutoff frequency per unit of speed (in image
+                heights/widths per second)
+            d_cutoff: cutoff frequency in Hz of the filter on the speed
+        """
+        self.dt = 1 / fps
+        self.min_cutoff = min_cutoff
+        # the cutoff of the scores does not depend on their speed
+        self.beta = np.array([beta, beta, 0.0])
+        self.d_cutoff = d_cutoff
+        self.reset()
+
+    def reset(self):
+        self._keypoints = None
+        self._speed = None
+
+    def update(self, keypoints, dt=None):
+        """Adds the keypoints of the next frame.
+
+        Args:
+            keypoints: a [17, 3] keypoint numpy array {y, x, confidence}
+            dt: seconds since the previous frame, 1 / fps if None (e.g. more when
+                frames in between were dropped)
+        Returns:
+            the smoothed [17, 3] keypoints of the frame
+        """
+        keypoints = np.asarray(keypoints, dtype=np.float64)
+        if self._keypoints is None:
+            self._keypoints = keypoints.copy()
+            self._speed = np.zeros_like(keypoints)
+            return keypoints.copy()
+        dt = self.dt if dt is None else dt
+        speed = (keypoints - self._keypoints) / dt
+        alpha_speed = _smoothing_factor(dt, self.d_cutoff)
+        self._speed = alpha_speed * speed + (1 - alpha_speed) * self._speed
+        cutoff = self.min_cutoff + self.beta * np.abs(self._speed)
+        alpha = _smoothing_factor(dt, cutoff)
+        self._keypoints = alpha * keypoints + (1 - alpha) * self._keypoints
+        return self._keypoints.copy()
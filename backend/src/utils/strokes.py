@@ -0,0 +1,63 @@
+"""""" """""" """""" """""
+STROKE FUNCTIONS
+""" """""" """""" """""" ""
+import numpy as np
+
+
+def _none_if_nan(value):
+    return None if np.isnan(value) else float(value)
+
+
+def segment_strokes(knee_angles, stroke_boundaries, timestamps):
+    """Splits the video into pedal strokes, each running from a lowest pedal point up
+    to the next one, and summarizes the knee angles of every stroke.
+    Runs in O(B) with a single pass of numpy reductions over the frames.
+
+    Args:
+        knee_angles: [B] inner knee angle of every frame in degrees, NaN for the
+            frames without a pose of the cyclist
+        stroke_boundaries: sorted frame indices of the lowest pedal points
+        timestamps: [B] timestamp in seconds of every frame
+    Returns:
+        json serializable dict with the number of strokes, the cadence in rpm, the
+        start, duration, minimum and maximum knee angle of every stroke and the
+        stroke-to-stroke variability
+    """
+    knee_angles = np.asarray(knee_angles, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    boundaries = np.asarray(stroke_boundaries, dtype=np.int64)
+    if len(boundaries) < 2:
+        return {
+            "count": 0,
+            "cadence_rpm": None,
+            "start_times": [],
+            "durations_s": [],
+            "min_angles": [],
+            "max_angles": [],
+            "variability": None,
+        }
+    durations = np.diff(timestamps[boundaries])
+    # frames from the first up to (not including) the last boundary, every stroke
+    # is reduced over [boundary, next boundary)
+    angles = knee_angles[boundaries[0] : boundaries[-1]]
+    offsets = boundaries[:-1] - boundaries[0]
+    # the boundaries are never NaN, so every stroke has a minimum and maximum
+    min_angles = np.fmin.reduceat(angles, offsets)
+    max_angles = np.fmax.reduceat(angles, offsets)
+    return {
+        "count": len(durations),
+        "cadence_rpm": float(60 / np.median(durations)),
+        "start_times": timestamps[boundaries[:-1]].tolist(),
+        "durations_s": durations.tolist(),
+        "min_angles": min_angles.tolist(),
+        "max_angles": max_angles.tolist(),
+        "variability": {
+            "duration_cv": float(np.std(durations) / np.mean(durations)),
+            "min_angle_std": float(np.std(min_angles)),
+            "max_angle_std": float(np.std(max_angles)),
+            # mean change of the maximum angle from one stroke to the next
+            "max_angle_successive_diff": _none_if_nan(
+                np.mean(np.abs(np.diff(max_angles))) if len(max_angles) > 1 else np.nan
+            ),
+        },
+    }
@@ -1,5 +1,9 @@
 import time
 import logging
+import functools
+import importlib
+import threading
+from utils.metrics import span
 
 LOGGING_TIMING_LEVEL_NUM = 42
 logging.addLevelName(LOGGING_TIMING_LEVEL_NUM, "TIMING")
@@ -13,10 +17,35 @@ logging.timing = logging_timing_level
 
 
 def timeit(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        t1 = time.time()
-        result = func(*args, **kwargs)
-        logging.timing(f"{func.__name__!r} executed in {(time.time()-t1):.3f}s")
+        # the span also records the stage in the metrics of the current request
+        with span(func.__name__):
+            t1 = time.perf_counter()
+            result = func(*args, **kwargs)
+            logging.timing(
+                f"{func.__name__!r} executed in {(time.perf_counter()-t1):.3f}s"
+            )
         return result
 
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+
+def import_modules_in_background(module_names):
+    """Imports modules that the utils only import when they are first needed.
+    This lets the imports overlap with other startup work (e.g. loading the model)
+    instead of slowing down the first request.
+
+    Args:
+        module_names: list of module names
+    Returns:
+        the started thread, join it to wait for the imports
+    """
+
+    def import_modules():
+        for module_name in module_names:
+            importlib.import_module(module_name)
+
+    thread = threading.Thread(target=import_modules, daemon=True)
+    thread.start()
+    return thread
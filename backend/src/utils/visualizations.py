@@ -1,16 +1,17 @@
 import numpy as np
-import pandas as pd
-import seaborn as sns
-from scipy.stats import norm
-import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
-from moviepy.editor import ImageSequenceClip
 
 from utils.utils import timeit
 from utils.keypoints import KEYPOINT_DICT
 
+# matplotlib, seaborn, pandas, scipy.stats and moviepy are imported inside the functions
+# that use them: together they take seconds to import and are only needed for rendering
+
 
 def plot_y_values(all_keypoints, facing_direction, peak_indices, output_file_path=None):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     ankle_index = KEYPOINT_DICT[f"{facing_direction}_ankle"]
     ankle_y_values = [1 - kp[ankle_index][0] for kp in all_keypoints]
     peak_values = [ankle_y_values[i] for i in peak_indices]
@@ -35,6 +36,9 @@ def plot_y_values(all_keypoints, facing_direction, peak_indices, output_file_pat
 
 
 def plot_angle_values(angles, peak_indices, output_file_path=None):
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     angles = [angle[1] for angle in angles]
     peak_angles = [angles[i] for i in peak_indices]
     sns.lineplot(x=list(range(len(angles))), y=angles)
@@ -111,22 +115,27 @@ def draw_angle_on_image(
         image.save(output_file_path)
     return np.array(image)
 
-@timeit
 def draw_plot_of_angles(
-    results, clip
+    results, clip, frame_idx
 ):
+    """Draws the plot of the angles around the timestamp of frame frame_idx, the
+    frame_idx-th frame of the left side of the angle video. Frames without an
+    angle are not in results["timestamped_angles"]"""
+    import matplotlib.pyplot as plt
+
     timestamps, angles = zip(*results["timestamped_angles"])
     timestamps_used, angles_used = zip(*results["used_timestamped_angles"])
     px = 1/plt.rcParams['figure.dpi']
     width, height = clip.w, clip.h
-    return [
-        draw_plot_of_angle(timestamp, timestamps, angles, timestamps_used, angles_used, px, width, height)
-        for timestamp in timestamps
-    ]
+    return draw_plot_of_angle(
+        frame_idx / clip.fps, timestamps, angles, timestamps_used, angles_used, px, width, height
+    )
 
 def draw_plot_of_angle(
     timestamp, timestamps, angles, timestamps_used, angles_used, px, width, height
 ):
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(width*px, height*px))
     plt.xlim(-1, 1)
     x = [t - timestamp for t in timestamps]
@@ -151,6 +160,10 @@ def plotting_angles(angles_at_peaks, lower_bound, upper_bound, output_file_path)
     Returns:
         a plot that shows the peak angles over time
     """
+    import pandas as pd
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     peak_indices = range(len(angles_at_peaks))
     lower_bound = [lower_bound] * len(angles_at_peaks)
     upper_bound = [upper_bound] * len(angles_at_peaks)
@@ -195,6 +208,10 @@ def plot_normal_distribution(
     Returns:
         a plot that shows the a distribution of peak angles with density
     """
+    import pandas as pd
+    import seaborn as sns
+    from scipy.stats import norm
+    import matplotlib.pyplot as plt
 
     sns.set(rc={"figure.figsize": (15, 8)})
     df = pd.DataFrame(list(zip(values)), columns=["vals"])
@@ -215,5 +232,7 @@ def plot_normal_distribution(
 
 @timeit
 def write_video_to_files(images, fps, output_file_path):
+    from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
+
     clip = ImageSequenceClip(images, fps)
     clip.write_videofile(output_file_path, audio=False, verbose=False, logger=None)